@@ -5,8 +5,11 @@
 # This module provides connection-management helpers for gateways with
 # long-lived stateful connections.
 
+import collections
+import errno
 import logging
 import os
+import Queue
 import select
 import socket
 import threading
@@ -17,6 +20,161 @@ logger = logging.getLogger(__name__)
 logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
 
 
+class TokenBucket(object):
+	# Classic token bucket rate limiter: holds up to 'burst' tokens, refilled at 'rate' tokens
+	# per second. Thread-safe.
+	def __init__(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = float(burst)
+		self.tokens = self.burst
+		self.stamp = time.time()
+		self.lock = threading.Lock()
+
+	def _refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+
+	def delay(self, count = 1):
+		# seconds until 'count' tokens are available (0 if they are now); doesn't consume anything
+		with self.lock:
+			self._refill(time.time())
+			if self.tokens >= count:
+				return 0
+			return (count - self.tokens) / self.rate
+
+	def try_consume(self, count = 1):
+		# take 'count' tokens if they're available now; returns whether it did
+		with self.lock:
+			self._refill(time.time())
+			if self.tokens >= count:
+				self.tokens -= count
+				return True
+			return False
+
+
+class Priority(object):
+	# Priority classes for commands queued to a gateway connection (see PrioritySendQueue).
+	# Commands that someone is waiting on go first, then automated reactions to events, and
+	# then background chatter like cache refreshes and reflected traffic.
+	INTERACTIVE = 0
+	AUTOMATION = 1
+	BACKGROUND = 2
+
+_thread_priority = threading.local()
+
+def set_thread_priority(priority):
+	# Set the default priority for commands queued by the current thread. Threads that exist to
+	# react to events (listeners, timers) call this so that anything they cause to be sent is
+	# queued as automation; web request threads leave it alone and get the interactive default.
+	_thread_priority.priority = priority
+
+def get_thread_priority():
+	return getattr(_thread_priority, 'priority', Priority.INTERACTIVE)
+
+
+class PrioritySendQueue(object):
+	# Replacement for Queue.Queue as a gateway connection's send_queue, with a FIFO per Priority
+	# class. get() always returns the most urgent command waiting, and rate-limits background
+	# commands so a refresh storm can't monopolize the connection. put() takes an optional
+	# priority, defaulting to the calling thread's priority.
+	def __init__(self, background_rate = 30, background_burst = 10):
+		self.queues = [collections.deque() for p in (Priority.INTERACTIVE, Priority.AUTOMATION, Priority.BACKGROUND)]
+		self.cond = threading.Condition()
+		self.background_bucket = TokenBucket(background_rate, background_burst)
+
+	def put(self, cmd, priority = None):
+		if priority is None:
+			priority = get_thread_priority()
+		with self.cond:
+			self.queues[priority].append(cmd)
+			self.cond.notify()
+
+	def get(self, block = True):
+		with self.cond:
+			while True:
+				cmd = self._pop()
+				if cmd is not None:
+					return cmd
+				if not block:
+					raise Queue.Empty
+				# wait for a put, or for the background rate limit to let something through
+				if self.queues[Priority.BACKGROUND]:
+					self.cond.wait(self.background_bucket.delay())
+				else:
+					self.cond.wait()
+
+	def get_nowait(self):
+		return self.get(False)
+
+	def qsize(self):
+		with self.cond:
+			return sum([len(q) for q in self.queues])
+
+	def _pop(self):
+		# called with self.cond held
+		for priority in (Priority.INTERACTIVE, Priority.AUTOMATION):
+			if self.queues[priority]:
+				return self.queues[priority].popleft()
+		if self.queues[Priority.BACKGROUND] and self.background_bucket.try_consume():
+			return self.queues[Priority.BACKGROUND].popleft()
+		return None
+
+
+class ConnectionState(object):
+	# Lifecycle of a gateway connection. A connection starts DOWN, goes through CONNECTING and
+	# AUTHENTICATING while the socket opens and logs in, is SYNCING while it refreshes cached
+	# state, and is LIVE after that. The watchdog marks a LIVE connection DEGRADED while a
+	# heartbeat goes unanswered, and DOWN when it gives up on it and restarts it.
+	CONNECTING = 'connecting'
+	AUTHENTICATING = 'authenticating'
+	SYNCING = 'syncing'
+	LIVE = 'live'
+	DEGRADED = 'degraded'
+	DOWN = 'down'
+
+	@staticmethod
+	def is_online(state):
+		# online means commands will go out and replies will come back, even if the cache is still filling in
+		return state in (ConnectionState.SYNCING, ConnectionState.LIVE, ConnectionState.DEGRADED)
+
+
+class GatewayConnection(object):
+	# Base class for gateway connection objects (the delegates for ListenerThread/SenderThread/SgWatchdog),
+	# which tracks the connection lifecycle and link activity times.
+	def __init__(self):
+		self.connection_state = ConnectionState.DOWN
+		self.connection_state_time = time.time()
+		self.connection_state_listeners = []
+		self.last_rx_time = None # set by ListenerThread
+		self.last_tx_time = None # set by SenderThread
+
+	def get_connection_state(self):
+		return self.connection_state
+
+	def is_online(self):
+		return ConnectionState.is_online(self.connection_state)
+
+	def get_link_times(self):
+		return (self.last_rx_time, self.last_tx_time)
+
+	def add_connection_state_listener(self, listener):
+		# listener(old_state, new_state) is called on whatever thread changed the state
+		self.connection_state_listeners.append(listener)
+
+	def set_connection_state(self, state):
+		old_state = self.connection_state
+		if state == old_state:
+			return
+		self.connection_state = state
+		self.connection_state_time = time.time()
+		logger.warn('%s: connection state %s -> %s' % (self.__class__.__name__, old_state, state))
+		for listener in self.connection_state_listeners:
+			try:
+				listener(old_state, state)
+			except:
+				logger.exception('exception in connection state listener')
+
+
 class CrlfSocketBuffer(object):
 	def __init__(self, socket):
 		self.socket = socket
@@ -41,6 +199,8 @@ class ListenerThread(threading.Thread):
 		self.logger.info('%s: init for listener with level %s' % (self.logger.name, logging.getLevelName(self.logger.level)))
 		
 	def run(self):
+		# whatever our delegate's event handlers send in response to what we receive is automation
+		set_thread_priority(Priority.AUTOMATION)
 		try:
 			sock = self.delegate.socket
 			buffer = CrlfSocketBuffer(sock)
@@ -51,7 +211,9 @@ class ListenerThread(threading.Thread):
 					raise Exception('socket in error state')
 				assert readable == [sock]
 				self.logger.debug('wake for input')
-				for line in buffer.read_lines():
+				lines = buffer.read_lines()
+				self.delegate.last_rx_time = time.time()
+				for line in lines:
 					self.delegate.receive_from_listener(line)
 		except:
 			self.logger.exception('listener thread exiting')
@@ -60,6 +222,17 @@ class ListenerThread(threading.Thread):
 
 
 class SenderThread(threading.Thread):
+	# Drains delegate.send_queue and writes to delegate.socket. Everything already queued
+	# when we wake up goes out in one write, with two hooks for delegates whose device can't
+	# take commands that quickly:
+	# - pace_send(cmd): returns how many seconds to wait before cmd may be written, or 0 if
+	#   it may go now (in which case the delegate should count it as sent). We flush what
+	#   we've batched so far, wait, and ask again.
+	# - separate_sends(): called after each write, and then we write one command at a time.
+	# Once the connection is DOWN (CleanupAndRestart wakes us with an empty command), we stop;
+	# commands we'd taken off the queue but didn't write are logged, not silently lost.
+	max_batch = 64 # commands per write, so one huge backlog doesn't become one huge buffer
+
 	def __init__(self, delegate, name_prefix):
 		super(SenderThread, self).__init__(name = name_prefix + '_sender')
 		self.delegate = delegate
@@ -68,35 +241,175 @@ class SenderThread(threading.Thread):
 		self.logger.info('%s: init for sender with level %s' % (self.logger.name, logging.getLevelName(self.logger.level)))
 
 	def run(self):
+		sock = self.delegate.socket
+		self.unsent = [] # commands taken off the queue and not yet written
 		try:
-			sock = self.delegate.socket
+			separate_sends = getattr(self.delegate, 'separate_sends', None)
+			pace_send = getattr(self.delegate, 'pace_send', None)
 			while True:
-				cmd = self.delegate.send_queue.get()
-				self.logger.debug('debug: dequeue and send command: ' + cmd)
-				sent = sock.send(cmd + '\r\n')
-				if sent != len(cmd) + 2:
-					logger.warning('send dequeued command: sent %d of %d bytes' % (sent, 2 + len(cmd)))
-				if hasattr(self.delegate, 'separate_sends'):
-					self.delegate.separate_sends()
+				self.unsent = [self.delegate.send_queue.get()]
+				if self._connection_lost():
+					self.unsent.extend(self._drain_queue(self.delegate.send_queue.qsize()))
+					self.logger.info('sender thread exiting: connection down')
+					break
+				if not separate_sends:
+					self.unsent.extend(self._drain_queue(self.max_batch - 1))
+				batch = []
+				for cmd in list(self.unsent):
+					if not cmd:
+						self.unsent.remove(cmd) # wakeup; nothing to send
+						continue
+					if pace_send:
+						delay = pace_send(cmd)
+						while delay > 0:
+							self._write(sock, batch)
+							batch = []
+							time.sleep(delay)
+							delay = pace_send(cmd)
+					batch.append(cmd)
+				self._write(sock, batch)
+				if separate_sends:
+					separate_sends()
 		except:
 			self.logger.exception('sender thread exiting')
-			# close socket so watchdog notices; exit and let watchdog restart us
-			sock.close()
+		dropped = [cmd for cmd in self.unsent if cmd]
+		if dropped:
+			self.logger.warning('dropping %d unsent command(s): %s' % (len(dropped), dropped))
+		# close socket so watchdog notices; exit and let watchdog restart us
+		sock.close()
+
+	def _connection_lost(self):
+		return isinstance(self.delegate, GatewayConnection) and self.delegate.get_connection_state() == ConnectionState.DOWN
+
+	def _write(self, sock, cmds):
+		if not cmds:
+			return
+		self.logger.debug('debug: dequeue and send %d command(s): %s' % (len(cmds), cmds))
+		send_all(sock, ''.join([cmd + '\r\n' for cmd in cmds]))
+		self.delegate.last_tx_time = time.time()
+		del self.unsent[:len(cmds)] # (batches go out in the order they were taken)
+
+	def _drain_queue(self, limit):
+		cmds = []
+		while len(cmds) < limit:
+			try:
+				cmds.append(self.delegate.send_queue.get_nowait())
+			except Queue.Empty:
+				break
+		return cmds
+
+
+def send_all(sock, data):
+	# Like sock.sendall(), but for the nonblocking sockets our gateways use: wait for the
+	# socket to become writable rather than failing with EAGAIN when the send buffer fills.
+	while data:
+		(readable, writable, errored) = select.select([], [sock], [sock])
+		if errored:
+			raise Exception('socket in error state')
+		try:
+			sent = sock.send(data)
+		except socket.error as se:
+			if se[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+				continue
+			raise
+		data = data[sent:]
+
+
+def is_closed_socket_error(ex):
+	# select() on a closed socket fails with EBADF, or with ValueError for a -1 fileno
+	return isinstance(ex, ValueError) or ex[0] == socket.EBADF
+
+
+def enable_keepalive(sock, idle = 10, interval = 5, count = 3):
+	# Turn on TCP keepalive so the kernel notices a dead peer even if we never send anything.
+	# The per-socket tuning knobs are platform specific, so set whichever ones exist here.
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+	if hasattr(socket, 'TCP_KEEPIDLE'):
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+	elif hasattr(socket, 'TCP_KEEPALIVE'): # OS X name for the same thing
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+	if hasattr(socket, 'TCP_KEEPINTVL'):
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+	if hasattr(socket, 'TCP_KEEPCNT'):
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+class BufferedClientWriter(threading.Thread):
+	# Writes to a downstream client's socket (a reflector's chained client, say) from its own
+	# thread, through a bounded queue, so a slow or stuck client can never block whoever is
+	# producing data for it -- typically a gateway's listener thread, fanning out to several
+	# clients. If the client falls max_queued writes behind, we either drop what doesn't fit
+	# (drop_when_full) or give up on the client and shut its socket down, which its reader
+	# notices.
+	max_batch = 64
+
+	def __init__(self, sock, name, max_queued = 1000, drop_when_full = False):
+		super(BufferedClientWriter, self).__init__(name = name + '_writer')
+		self.daemon = True
+		self.sock = sock
+		self.queue = Queue.Queue(max_queued)
+		self.drop_when_full = drop_when_full
+		self.closed = False
+		self.stats = { 'queued': 0, 'sent': 0, 'dropped': 0 }
+
+	def write(self, data):
+		# never blocks; returns whether data was queued
+		if self.closed:
+			return False
+		try:
+			self.queue.put_nowait(data)
+			self.stats['queued'] += 1
+			return True
+		except Queue.Full:
+			self.stats['dropped'] += 1
+			if not self.drop_when_full:
+				logger.warning('%s: client fell %d writes behind; disconnecting' % (self.name, self.queue.maxsize))
+				self.close()
+			return False
+
+	def close(self):
+		self.closed = True
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except (socket.error, ValueError):
+			pass
+
+	def run(self):
+		while not self.closed:
+			try:
+				chunks = [self.queue.get(timeout = 1)]
+			except Queue.Empty:
+				continue
+			# and anything else already waiting, as one write
+			try:
+				while len(chunks) < self.max_batch:
+					chunks.append(self.queue.get_nowait())
+			except Queue.Empty:
+				pass
+			try:
+				send_all(self.sock, ''.join(chunks))
+				self.stats['sent'] += len(chunks)
+			except Exception as ex:
+				logger.info('%s: write failed (%s); closing' % (self.name, ex))
+				self.close()
 
 
 class CleanupAndRestart(threading.Thread):
 	def __init__(self, handler):
 		super(CleanupAndRestart, self).__init__(name = 'conn_reconnect')
 		self.daemon = True
-		(self.threads, self.reconnect) = handler
+		(self.threads, self.reconnect, self.delegate) = handler
 
 	def run(self):
+		if isinstance(self.delegate, GatewayConnection):
+			self.delegate.set_connection_state(ConnectionState.DOWN)
 		logger.warn('watched socket closed; waiting for %d threads' % len(self.threads))
 		for t in self.threads:
 			# XXX horrible hack to force instances of SenderThread to exit
 			if isinstance(t, SenderThread):
+				# (at the front of the queue, so it doesn't wait behind commands we can't send)
 				logger.debug('sending SenderThread null request to force wakeup')
-				t.delegate.send_queue.put('')
+				t.delegate.send_queue.put('', Priority.INTERACTIVE)
 			t.join()
 		logger.warn('threads exited; ready to reconnect')
 
@@ -115,6 +428,8 @@ class CleanupAndRestart(threading.Thread):
 				break
 			except:
 				logger.exception('failure in gateway device reconnect attempt')
+				if isinstance(self.delegate, GatewayConnection):
+					self.delegate.set_connection_state(ConnectionState.DOWN)
 				delay = delay * backoff_factor
 				if delay > max_delay:
 					delay = max_delay
@@ -123,20 +438,67 @@ class CleanupAndRestart(threading.Thread):
 
 
 class SgWatchdog(threading.Thread):
+	# Watches gateway connections and restarts them when they die. A connection is dead when
+	# its listener or sender thread closes the socket, or (for watches that supply a delegate
+	# with send_heartbeat()) when nothing has been received on it for idle_timeout seconds.
+	# Idle connections get a heartbeat command every heartbeat_interval seconds so that a
+	# healthy but quiet link still produces traffic. The delegate tracks last_rx_time and
+	# last_tx_time (set by ListenerThread/SenderThread), and may override the defaults below.
+	heartbeat_interval = 5 # seconds of receive silence before we send a heartbeat
+	idle_timeout = 15      # seconds of receive silence before we declare the link dead
+	check_interval = 1     # how often to check liveness, in seconds
+
 	def __init__(self):
 		super(SgWatchdog, self).__init__(name = 'conn_watcher')
 		self.daemon = True
 		self.watches = {}
+		self.last_heartbeat = {} # map from socket to time we last sent a heartbeat on it
 		self.lock = threading.RLock()
 		(self.read_wake, self.write_wake) = os.pipe() # Use pipe as select-able event object
 
-	def add(self, threads, socket, reconnect):
+	def add(self, threads, socket, reconnect, delegate = None):
 		with self.lock:
-			self.watches[socket] = (threads, reconnect)
+			self.watches[socket] = (threads, reconnect, delegate)
+			self.last_heartbeat[socket] = time.time()
 		# poke self to redo run loop noticing new add
 		logger.debug('prod watchdog thread to recalculate watchee list')
 		os.write(self.write_wake, '1')
 
+	def check_liveness(self):
+		now = time.time()
+		with self.lock:
+			watches = self.watches.items()
+		for (sock, (threads, reconnect, delegate)) in watches:
+			if not hasattr(delegate, 'send_heartbeat'):
+				continue
+			heartbeat_interval = getattr(delegate, 'heartbeat_interval', self.heartbeat_interval)
+			idle_timeout = getattr(delegate, 'idle_timeout', self.idle_timeout)
+			idle = now - (getattr(delegate, 'last_rx_time', None) or now)
+			if isinstance(delegate, GatewayConnection):
+				# a heartbeat has gone unanswered for a whole interval: not dead yet, but suspect
+				state = delegate.get_connection_state()
+				if state == ConnectionState.LIVE and idle > 2 * heartbeat_interval:
+					delegate.set_connection_state(ConnectionState.DEGRADED)
+				elif state == ConnectionState.DEGRADED and idle <= heartbeat_interval:
+					delegate.set_connection_state(ConnectionState.LIVE)
+			if idle > idle_timeout:
+				logger.warn('nothing received on %s for %d seconds; declaring connection dead' % (sock, idle))
+				if isinstance(delegate, GatewayConnection):
+					delegate.set_connection_state(ConnectionState.DOWN)
+				# Shutting down the socket wakes the listener with EOF; it closes the socket,
+				# and we find that out (EBADF) and restart the connection the usual way.
+				try:
+					sock.shutdown(socket.SHUT_RDWR)
+				except socket.error:
+					logger.debug('shutdown of %s failed; probably already closed' % sock)
+			elif idle > heartbeat_interval and now - self.last_heartbeat.get(sock, 0) > heartbeat_interval:
+				logger.debug('connection %s idle for %d seconds; sending heartbeat' % (sock, idle))
+				self.last_heartbeat[sock] = now
+				try:
+					delegate.send_heartbeat()
+				except:
+					logger.exception('failed to send heartbeat')
+
 	def run(self):
 		def detect_bad_sockets(socket_list):
 			closed = []
@@ -145,8 +507,8 @@ class SgWatchdog(threading.Thread):
 					try:
 						select.select([], [], [fd], 0)
 						logger.debug('fd %s is ok (fd %d)' % (fd, fd.fileno()))
-					except (select.error, socket.error) as se:
-						if se[0] == socket.EBADF:
+					except (select.error, socket.error, ValueError) as se:
+						if is_closed_socket_error(se):
 							logger.debug('fd %s got EBADF; pruning' % fd)
 							closed.append(fd)
 						else:
@@ -163,25 +525,31 @@ class SgWatchdog(threading.Thread):
 				# by one looking for that exception.
 				with self.lock:
 					socket_list = self.watches.keys()
+					probing = any(hasattr(delegate, 'send_heartbeat') for (threads, reconnect, delegate) in self.watches.values())
+				timeout = self.check_interval if probing else None
 				logger.debug('sleep on %d sockets' % len(socket_list))
 				try:
-					(readable, writable, errored) = select.select([self.read_wake], [], socket_list)
+					(readable, writable, errored) = select.select([self.read_wake], [], socket_list, timeout)
 					logger.debug('wake: count r/w/e = %d/%d/%d' % (len(readable), len(writable), len(errored)))
 					if len(readable):
 						os.read(self.read_wake, 1)
-				except (select.error, socket.error) as se:
+				except (select.error, socket.error, ValueError) as se:
 					# This is kind of weird. The first time I select() on a closed socket I get a select.error,
 					# and after that for the same socket, I get a socket.error. There's probably a reason for
 					# this, but it seems confusing and fragile, and hopefully less so if I just catch whichever
-					# one happens first and treat them the same.
-					if se[0] == socket.EBADF:
+					# one happens first and treat them the same. (Newer Python 2.7 releases give a closed socket
+					# a fileno of -1, and select raises ValueError instead; same thing.)
+					if is_closed_socket_error(se):
 						errored = detect_bad_sockets(socket_list)
 					else:
 						raise se;
 				logger.debug('invoking %d cleanups' % len(errored))
 				for bad in errored:
 					with self.lock:
+						self.last_heartbeat.pop(bad, None)
 						CleanupAndRestart(self.watches.pop(bad)).start()
 				logger.debug('done with cleanup; looping')
+				if probing:
+					self.check_liveness()
 			except:
 				logger.exception('exception in watchdog thread')
@@ -4,6 +4,7 @@
 
 import importlib
 import logging
+import threading
 import sg_util
 
 logger = logging.getLogger(__name__)
@@ -13,6 +14,11 @@ logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger
 def load_all(sg_house, gateways_config):
 	sg_house.gateways = {}
 
+	# Each section of gateways_config is a gateway instance; its name is the instance name (which is
+	# what the house, persistence and other gateways know it by), and its 'type' says which plugin
+	# module implements it, defaulting to the instance name. So the same plugin can be loaded more
+	# than once (say, two radiora2 repeaters), and dependencies are on instance names.
+	#
 	# To load gateways in correct dependency order, this proceeds in 3 phases.
 	# 1) Load all gateways, query their dependencies
 	# 2) Build dependency graph, and disable any gateways with broken dependencies
@@ -20,22 +26,24 @@ def load_all(sg_house, gateways_config):
 
 	# 1: iterate configured gateways, load modules and query dependencies
 	gateway_info_map = {}
-	for gateway_module_name in gateways_config.keys():
+	for instance_name in gateways_config.keys():
 		# Locate gateway configuration
-		config = gateways_config[gateway_module_name]
+		config = gateways_config[instance_name]
 		if config.get('disabled', False):
-			logger.info('ignoring disabled gateway "%s"' % gateway_module_name)
+			logger.info('ignoring disabled gateway "%s"' % instance_name)
 			continue
 
 		try:
-			logger.info('loading gateway "%s"' % gateway_module_name)
+			gateway_type = config.get('type', instance_name)
+			logger.info('loading gateway "%s" (type %s)' % (instance_name, gateway_type))
 			# Load gateway plugin code
-			gateway_module = importlib.import_module('.' + gateway_module_name, __name__)
+			gateway_module = importlib.import_module('.' + gateway_type, __name__)
 			# query dependencies
 			deps = gateway_module.get_dependencies(config);
 
-			gateway_info_map[gateway_module_name] = sg_util.AttrDict({
-				'name': gateway_module_name,
+			gateway_info_map[instance_name] = sg_util.AttrDict({
+				'name': instance_name,
+				'type': gateway_type,
 				'config': config,
 				'module': gateway_module,
 				'deps': deps,
@@ -43,7 +51,7 @@ def load_all(sg_house, gateways_config):
 			})
 
 		except Exception as ex:
-			logger.error('gateway "%s" failed to load at all' % gateway_module_name)
+			logger.error('gateway "%s" failed to load at all' % instance_name)
 			logger.exception(ex)
 
 	# 2: build "dependency graph" -- not much fancier than we already have, but add reverse pointers,
@@ -68,42 +76,64 @@ def load_all(sg_house, gateways_config):
 	# and then apply it, but we do it this way so that if a gateway fails to initialize,  we don't even try
 	# to initialize anything that depends on it.
 
+	# Gateways that are ready at the same time don't depend on each other, so we initialize each such
+	# batch in parallel: init typically blocks on connecting to hardware and reading its layout, and
+	# there's no reason for one slow repeater to hold up the rest of the house.
+
 	# Repeat till we end up with an empty list:
 	while ready:
-		# Grab any ready gateway
-		gateway_info = ready.pop()
-		assert(not gateway_info.deps)
+		# Initialize the whole ready batch
+		batch = ready
+		ready = list()
+		threads = [GatewayInitThread(sg_house, gateway_info) for gateway_info in batch]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		for gateway_info in batch:
+			assert(not gateway_info.deps)
+			if gateway_info.gateway is None:
+				continue # failed, and already logged
 
-		# Initialize it
-		try:
-			logger.info('initialize gateway "%s"' % gateway_info.name)
-			# Construct gateway
-			gateway = gateway_info.module.init(sg_house, gateway_info.name, gateway_info.config)
-			
 			# Once gateway is initialized, immediately add it to the house, so that further gateways can find it
-			sg_house.gateways[gateway_info.name] = gateway
-
-		except Exception as ex:
-			logger.error('gateway "%s" failed to initialize and will not be loaded' % gateway_info.name)
-			logger.exception(ex)
-			continue
+			sg_house.gateways[gateway_info.name] = gateway_info.gateway
 
-		# Update progress of topological sort: remove any satisfied dependency links
-		for depname in gateway_info.reverse_deps:
-			source = gateway_info_map[depname]
-			assert gateway_info.name in source.deps
-			source.deps.remove(gateway_info.name)
+			# Update progress of topological sort: remove any satisfied dependency links
+			for depname in gateway_info.reverse_deps:
+				source = gateway_info_map[depname]
+				assert gateway_info.name in source.deps
+				source.deps.remove(gateway_info.name)
 
-			# And if that clears the way for another module, move it from pending to ready
-			if not source.deps:
-				pending.remove(source)
-				ready.append(source)
+				# And if that clears the way for another module, move it from pending to ready
+				if not source.deps:
+					pending.remove(source)
+					ready.append(source)
 
-		# Just for cleanliness, clear this module's reverse_deps since we've handled them
-		# (Nothing will look at this again, so it doesn't actually matter.)
-		gateway_info.reverse_deps.clear()
+			# Just for cleanliness, clear this module's reverse_deps since we've handled them
+			# (Nothing will look at this again, so it doesn't actually matter.)
+			gateway_info.reverse_deps.clear()
 
 	# If anything is still pending, too bad.
 	for gateway_info in pending:
 		assert(gateway_info.deps)
 		logger.error('gateway "%s" ignored due to broken dependencies %s' % (gateway_info.name, gateway_info.deps))
+
+
+class GatewayInitThread(threading.Thread):
+	def __init__(self, sg_house, gateway_info):
+		super(GatewayInitThread, self).__init__(name = 'gateway_init_' + gateway_info.name)
+		self.daemon = True
+		self.sg_house = sg_house
+		self.gateway_info = gateway_info
+		gateway_info.gateway = None
+
+	def run(self):
+		gateway_info = self.gateway_info
+		try:
+			logger.info('initialize gateway "%s"' % gateway_info.name)
+			# Construct gateway
+			gateway_info.gateway = gateway_info.module.init(self.sg_house, gateway_info.name, gateway_info.config)
+		except Exception as ex:
+			logger.error('gateway "%s" failed to initialize and will not be loaded' % gateway_info.name)
+			logger.exception(ex)
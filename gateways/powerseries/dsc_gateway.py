@@ -52,7 +52,9 @@ class DscPartition(sg_house.StargateDevice):
 			return 'armed'
 		if level == PartitionStatus.READY:
 			return 'ready'
-		return 'busy'
+		if level == PartitionStatus.BUSY:
+			return 'busy'
+		return 'unknown'
 
 	def is_armed(self):
 		return self.get_level() == PartitionStatus.ARMED
@@ -90,13 +92,15 @@ class DscClosureSensor(DscZoneSensor):
 		super(DscClosureSensor, self).__init__(gateway, area, zone_number, name);
 
 	def get_name_for_level(self, level):
+		if level is None:
+			return 'unknown'
 		return 'open' if level else 'closed'
 
 	def is_open(self):
 		return self.get_level() == 1
 		
 	def is_closed(self):
-		return not self.is_open()
+		return self.get_level() == 0
 
 
 class DscMotionSensor(DscZoneSensor):
@@ -107,13 +111,15 @@ class DscMotionSensor(DscZoneSensor):
 		super(DscMotionSensor, self).__init__(gateway, area, zone_number, name);
 
 	def get_name_for_level(self, level):
+		if level is None:
+			return 'unknown'
 		return 'occupied' if level else 'vacant'
 
 	def is_occupied(self):
 		return self.get_level() == 1
 		
 	def is_vacant(self):
-		return not self.is_occupied()
+		return self.get_level() == 0
 
 
 def create_device_for_zone(gateway, area, zone_number, zoneInfo):
@@ -162,9 +168,12 @@ class DscGateway(sg_house.StargateGateway):
 			self.partitions_by_id[partition_num] = DscPartition(self, partition_num, config.partition_names[partition_num])
 
 		# set up network connections
-		self.panel_server = DscPanelServer(self, self.house.watchdog, config.gateway.hostname, 4025, config.gateway.password)
+		self.panel_server = DscPanelServer(self, self.house.watchdog, self.house.timer, config.gateway.hostname, 4025, config.gateway.password,
+			config.gateway.get('query_timeout', 5))
 		if config.gateway.has_key('reflector_port'):
-			self.reflector = Reflector(self, config.gateway.reflector_port, config.gateway.password)
+			self.reflector = Reflector(self, config.gateway.reflector_port, config.gateway.password,
+				config.gateway.get('reflector_max_queued', 1000), config.gateway.get('reflector_slow_clients') == 'drop',
+				config.gateway.get('reflector_rate', 2), config.gateway.get('reflector_burst', 10))
 		else:
 			self.reflector = None
 
@@ -182,6 +191,9 @@ class DscGateway(sg_house.StargateGateway):
 		else:
 			raise Error('whoops')
 
+	def get_connection_state(self):
+		return self.panel_server.get_connection_state()
+
 	def crack_dsc_devid(self, gateway_devid):
 		cracked = gateway_devid.split(':')
 		assert len(cracked) == 2
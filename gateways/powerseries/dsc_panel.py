@@ -13,11 +13,12 @@
 # - clean up/flesh out cache; settle on way of doing device ids across zone/partition/other
 
 import logging
-import Queue
 import socket
+import threading
 import time
 
 import connections
+import dsc_tpi
 
 
 logger = logging.getLogger(__name__)
@@ -30,61 +31,174 @@ class PartitionStatus(object):
 	BUSY = 2
 
 
+class DscSendPacer(object):
+	# Decides how soon each outgoing command may go to the panel (see connections.SenderThread.pace_send).
+	#
+	# The panel gets confused if we fire keypad-style commands at a partition faster than it can
+	# process them, but it's fine with status queries and such in quick succession. So commands
+	# addressed to a partition (command output, arm, disarm, keystrokes) wait until that partition
+	# is neither busy (673, until it reports ready or armed) nor still digesting the last command
+	# we sent it (until it reports any status, or settle_time passes). Everything is also
+	# subject to an overall rate limit.
+	partition_cmds = (20, 30, 31, 32, 33, 40, 71) # commands whose first data byte is a partition number
+	settle_time = 1.0   # max seconds to wait for a partition to react to a command we sent it
+	busy_time = 5.0     # max seconds to believe a partition is busy without hearing otherwise
+	poll_interval = 0.05 # how often to recheck a partition we're waiting for
+
+	def __init__(self, rate = 10, burst = 5):
+		self.bucket = connections.TokenBucket(rate, burst)
+		self.lock = threading.Lock()
+		self.blocked_until = {} # map from partition number to time before which we won't send to it
+
+	def pace_send(self, cmdline):
+		partition = self._get_partition(cmdline)
+		with self.lock:
+			now = time.time()
+			if partition is not None and self.blocked_until.get(partition, 0) > now:
+				return min(self.poll_interval, self.blocked_until[partition] - now)
+			if not self.bucket.try_consume():
+				return self.bucket.delay()
+			if partition is not None:
+				self.blocked_until[partition] = now + self.settle_time
+			return 0
+
+	def on_partition_status(self, partition, busy):
+		# called by DscPanelServer for every partition status report
+		with self.lock:
+			if busy:
+				self.blocked_until[partition] = time.time() + self.busy_time
+			else:
+				self.blocked_until.pop(partition, None)
+
+	def _get_partition(self, cmdline):
+		# cmdline is 3 digit command, data, and 2 character checksum
+		try:
+			if int(cmdline[:3]) in self.partition_cmds:
+				return int(cmdline[3])
+		except (ValueError, IndexError):
+			pass
+		return None
+
+
 class DscPanelCache(object):
-	def __init__(self, event_sink):
+	# Zone and partition statuses, as last reported by the panel. Entries are 'stale' until the
+	# panel reports them; readers wait (on self.updated) up to a timeout for that, and get None,
+	# meaning unknown, if it doesn't happen.
+	#
+	# The TPI has no per-zone or per-partition status query, just the global status request (001),
+	# so that's how we chase stale entries: at most one outstanding at a time no matter how many
+	# readers are waiting, and not more often than requery_interval. Readers only wait while a
+	# request is outstanding; if the panel's answer didn't include an entry (a zone it doesn't
+	# have, say), later readers get None right away until it's time to ask again, rather than
+	# every page render waiting out the timeout.
+	requery_interval = 60.0
+
+	def __init__(self, event_sink, query_timeout = 5):
 		self.zone_status = {}
 		self.partition_status = {}
 		self.event_sink = event_sink
+		self.query_timeout = query_timeout
+		self.server = None
+		self.updated = threading.Condition() # notified whenever a status is recorded
+		self.last_requery = 0
+		self.resyncing = set() # (dev_type, dev_id) pairs whose next report is a resync, not news
 
 	def mark_all_stale(self):
-		for i in range(1, 65):
-			self.zone_status[i] = 'stale'
-		for i in range(1, 9):
-			self.partition_status[i] = 'stale'
-
-	def get_zone_status(self, zone_num):
-		status = self.zone_status[zone_num]
-		while status == 'stale':
-			time.sleep(0.1)
-			status = self.zone_status[zone_num]
-		return status
-
-	def get_partition_status(self, partition_num):
-		status = self.partition_status[partition_num]
-		while status == 'stale':
-			time.sleep(0.1)
-			status = self.partition_status[partition_num]
-		return status
+		with self.updated:
+			for i in range(1, 65):
+				self.zone_status[i] = 'stale'
+			for i in range(1, 9):
+				self.partition_status[i] = 'stale'
+
+	def begin_resync(self):
+		# Called on reconnect. Keep serving the statuses we knew before we lost the connection,
+		# but treat the panel's next report for each of them as a refresh unless it actually
+		# changed while we weren't listening. (Anything never reported is still stale.)
+		self.resyncing = set([('zone', i) for i in self.zone_status if self.zone_status[i] != 'stale'] +
+			[('partition', i) for i in self.partition_status if self.partition_status[i] != 'stale'])
+
+	def get_zone_status(self, zone_num, timeout = None):
+		# Returns None if the status is unknown (still unknown after timeout seconds, default
+		# query_timeout; or right away if the panel is offline).
+		return self._wait_for_value(self.zone_status, zone_num, timeout)
+
+	def get_partition_status(self, partition_num, timeout = None):
+		# Returns None if the status is unknown, as for get_zone_status.
+		return self._wait_for_value(self.partition_status, partition_num, timeout)
+
+	def _wait_for_value(self, statuses, num, timeout):
+		status = statuses[num]
+		if status != 'stale':
+			return status
+		if self.server is None or not self.server.is_online():
+			return None
+		if timeout is None:
+			timeout = self.query_timeout
+		deadline = time.time() + timeout
+		with self.updated:
+			while True:
+				status = statuses[num]
+				if status != 'stale':
+					return status
+				now = time.time()
+				if now >= deadline:
+					logger.warning('no status from panel for %d after %g seconds' % (num, timeout))
+					return None
+				if now - self.last_requery > self.requery_interval:
+					self.last_requery = now
+					self.server.send_dsc_command(001)
+				wait_until = min(deadline, self.last_requery + self.query_timeout)
+				if now >= wait_until:
+					return None
+				self.updated.wait(wait_until - now)
 
 	# DscPanelServer private interface
+	def _bind_server(self, server):
+		self.server = server
+
 	def _record_zone_status(self, zone_num, status):
 		# should be called only by DscPanelServer._receive_dsc_cmd()
 		logger.info('_record_zone_state: zone %d status %d' % (zone_num, status))
-		old_status = self.zone_status[zone_num]
-		self.zone_status[zone_num] = status
+		with self.updated:
+			old_status = self.zone_status[zone_num]
+			self.zone_status[zone_num] = status
+			self.updated.notify_all()
 		self._broadcast_change('zone', zone_num, status, old_status)
 
 	def _record_partition_status(self, partition_num, status):
 		# should be called only by DscPanelServer._receive_dsc_cmd()
 		logger.info('_record_partition_state: partition %d status %d' % (partition_num, status))
-		old_status = self.partition_status[partition_num]
-		self.partition_status[partition_num] = status
+		with self.updated:
+			old_status = self.partition_status[partition_num]
+			self.partition_status[partition_num] = status
+			self.updated.notify_all()
 		self._broadcast_change('partition', partition_num, status, old_status)
 
 	def _broadcast_change(self, dev_type, dev_id, state, old_status):
 		refresh = (old_status == 'stale')
+		if (dev_type, dev_id) in self.resyncing:
+			self.resyncing.discard((dev_type, dev_id))
+			refresh = (old_status == state)
 		logger.debug('broadcast_change: sending on_user_action(dev_id=%s:%s, refresh=%s)' % (dev_type, dev_id, str(refresh)))
 		self.event_sink.on_user_action(dev_type, dev_id, state, refresh)
 
 
-class DscPanelServer(object):
-	def __init__(self, gateway, watchdog, hostname, port, password):
+class DscPanelServer(connections.GatewayConnection):
+	sync_timeout = 10 # seconds to wait for the panel to ack the global status request after login
+	sync_attempts = 3 # status requests to try before giving up on the connection
+
+	def __init__(self, gateway, watchdog, timer, hostname, port, password, query_timeout = 5):
+		super(DscPanelServer, self).__init__()
 		self.gateway = gateway
 		self.watchdog = watchdog
+		self.timer = timer # SgTimer, for checking on the status request after login
 		self.hostname = hostname
 		self.port = port
 		self.password = password
-		self.cache = DscPanelCache(gateway)
+		self.cache = DscPanelCache(gateway, query_timeout)
+		self.cache.mark_all_stale()
+		self.cache._bind_server(self)
+		self.pacer = DscSendPacer()
 
 	def connect(self):
 		# Right now, this only knows how to connect over a TCP socket
@@ -93,130 +207,167 @@ class DscPanelServer(object):
 		# talk to a TCP->serial gateway to an IT-100, and without too many
 		# more changes, could talk to a serial port connected to an IT-100
 		# if one exists. For now, just use weakly-authenticated-TCP.
+		self.set_connection_state(connections.ConnectionState.CONNECTING)
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket.connect((self.hostname, self.port))
+		connections.enable_keepalive(self.socket)
 		self.socket.setblocking(0)
+		self.last_rx_time = self.last_tx_time = time.time()
 		self.listen_thread = connections.ListenerThread(self, 'dsc')
 		self.listen_thread.start()
-		self.send_queue = Queue.Queue()
+		self.send_queue = connections.PrioritySendQueue()
 		self.send_thread = connections.SenderThread(self, 'dsc')
 		self.send_thread.start()
 
 		# enable automatic reconnect
-		self.watchdog.add([self.listen_thread, self.send_thread], self.socket, self.connect)
+		self.watchdog.add([self.listen_thread, self.send_thread], self.socket, self.connect, self)
 
-		# log in
-		self.send_dsc_command(005, self.password)
-		# empty the cache, and issue the global-status command to repopulate it
-		self.cache.mark_all_stale()
-		self.send_dsc_command(001)
+		# log in; _do_login continues from there
+		self.set_connection_state(connections.ConnectionState.AUTHENTICATING)
+		self.send_dsc_command(005, self.password, connections.Priority.INTERACTIVE)
 
 	# following 2 methods are for connections.ListenerThread and SenderThread
 	def receive_from_listener(self, cmd):
 		self._receive_dsc_cmd(cmd)
 
-	def separate_sends(self):
-		# Called by connections.SenderThread after each write to the socket.
-		time.sleep(0.5) # XXX prevent panel from getting confused with burst of commands. the ugly way
+	def send_heartbeat(self):
+		# Called by connections.SgWatchdog when the panel has been quiet; 000 (poll) gets a 500 ack.
+		self.send_dsc_command(000, priority = connections.Priority.INTERACTIVE)
 
-	# Can be called on any stargate thread; will send data over network socket to DSC system
-	def send_dsc_command(self, command, data_bytes = []):
-		cmdline = self._encode_dsc_command(command, data_bytes)
-		self._send_dsc_cmdline(cmdline)
+	def pace_send(self, cmdline):
+		# Called by connections.SenderThread before each write to the socket.
+		return self.pacer.pace_send(cmdline)
+
+	# Can be called on any stargate thread; will send data over network socket to DSC system.
+	# priority is a connections.Priority; default depends on the calling thread.
+	def send_dsc_command(self, command, data_bytes = [], priority = None):
+		assert type(command) == int
+		cmdline = dsc_tpi.encode(command, data_bytes)
+		self._send_dsc_cmdline(cmdline, priority)
 
 	# private helpers for command send/receive
-	def _send_dsc_cmdline(self, cmdline):
+	def _send_dsc_cmdline(self, cmdline, priority = None):
 		# Send over network to panel.
-		# XXX serializing requests with a lock is not enough; we need to enforce some delay between,
-		# because the panel can't handle us bombarding it with requests too quickly. Ideally we would
-		# tag cmds with partition id and only send cmds to ready partitions; for now we'll just send
-		# them to a worker thread that won't dequeue them too quickly.
+		# Serializing requests is not enough; the panel can't handle us bombarding a partition with
+		# requests too quickly. The worker thread asks DscSendPacer when each one may go.
 		logger.debug('debug: enqueue command: ' + str(cmdline))
-		self.send_queue.put(str(cmdline))
+		self.send_queue.put(str(cmdline), priority)
 
 	def _receive_dsc_cmd(self, cmdline):
 		# Called on listener thread when panel says something.
 
-		# Parse, and broadcast any interesting event notifications to the SG devices we created
-		(cmd_num, cmd_data, checksum) = (int(cmdline[:3]), cmdline[3:-2], cmdline[-2:])
-		if cmdline != self._encode_dsc_command(cmd_num, cmd_data):
-			logger.warning('response with bad checksum: %s' % cmdline)
+		# Parse (once; the reflector gets the same record), and broadcast any interesting event
+		# notifications to the SG devices we created
+		record = dsc_tpi.parse(cmdline)
+		if record is None:
+			logger.warning('response with bad checksum or format: %s' % cmdline)
 			return
 		
-		logger.debug('dsc panel sent cmd: %s' % cmdline)
-		if self._response_cmd_map.has_key(cmd_num):
-			self._response_cmd_map[cmd_num](self, cmd_data)
+		logger.debug('dsc panel sent cmd: %s', cmdline)
+		handler = self._response_cmd_map.get(record.code)
+		if handler:
+			handler(self, record)
 		else:
-			logger.debug('ignoring command %d (no handler)' % cmd_num)
+			logger.debug('ignoring command %d %s (no handler)', record.code, record.name)
 
 		# pass on to reflector (except for authentication response)
-		if self.gateway.reflector and cmd_num != 505:
-			self.gateway.reflector.to_children(cmdline)
-
-	def _encode_dsc_command(self, command, data_bytes):
-		# Encode command: 3-digit number as ascii, then any arguments/data
-		assert type(command) == int
-		cmd_bytes = '%03d' % command
-		cmd = []
-		checksum = 0
-		for byte in cmd_bytes:
-			cmd.append(byte)
-			checksum += ord(byte)
-		for byte in data_bytes:
-			cmd.append(byte)
-			checksum += ord(byte)
-		# add checksum and CRLF terminator
-		checksum = checksum % 256
-		cmd.extend([hex(nibble)[-1].upper() for nibble in [ checksum / 16, checksum % 16]])
-		return ''.join(cmd)
-	
-	# private handlers for _receive_dsc_cmd
-	def _do_invalid_cmd(self, data):
+		if self.gateway.reflector and record.code != 505:
+			self.gateway.reflector.to_children(record)
+
+	# private handlers for _receive_dsc_cmd; each gets a dsc_tpi.TpiRecord
+	def _do_cmd_ack(self, record): # handler for 500
+		logger.debug('panel acknowledged command %s' % record.data)
+		# The panel acks the global status request before it sends the statuses, which follow
+		# right away; cache entries each stay stale until their own status arrives.
+		if record.value == 1 and self.connection_state == connections.ConnectionState.SYNCING:
+			self.set_connection_state(connections.ConnectionState.LIVE)
+
+	def _do_invalid_cmd(self, record):
+		# (if it was the status request, _check_sync will send it again)
 		logger.warning('panel complains of invalid command')
 
-	def _do_login(self, data):
-		logger.info('login response: %d' % int(data))
-		assert int(data) > 0 # XXX temporary
-		# XXX should have a concept of gateway online/offline/error
+	def _do_login(self, record):
+		data = record.value
+		logger.info('login response: %d' % data)
+		if data == 3:
+			# envisalink's greeting, asking for the password we already sent
+			return
+		if data != 1:
+			# 0 is a bad password, 2 is a login timeout. The envisalink hangs up on us after this,
+			# and the watchdog will retry the connection with backoff.
+			logger.error('panel rejected login (response %s)' % data)
+			self.set_connection_state(connections.ConnectionState.DOWN)
+			return
+		# catch up on status: issue the global-status command to (re)populate the cache
+		self.set_connection_state(connections.ConnectionState.SYNCING)
+		self.cache.begin_resync()
+		self._request_sync()
+
+	def _request_sync(self, attempt = 1):
+		# Send the global status request, and check back in sync_timeout seconds: only its ack takes
+		# us from SYNCING to LIVE, so if that's lost (or the panel answers 501/502), ask again, and
+		# after sync_attempts, hang up so the watchdog reconnects.
+		sock = self.socket
+		self.cache.last_requery = time.time()
+		self.send_dsc_command(001)
+		self.timer.add_event(self.sync_timeout, lambda: self._check_sync(sock, attempt))
+
+	def _check_sync(self, sock, attempt):
+		if sock is not self.socket or self.connection_state != connections.ConnectionState.SYNCING:
+			return # went live, or this connection is gone (a new one checks its own sync)
+		if attempt < self.sync_attempts:
+			logger.warning('panel did not acknowledge status request after %g seconds; asking again' % self.sync_timeout)
+			self._request_sync(attempt + 1)
+			return
+		logger.error('panel did not acknowledge %d status requests; reconnecting' % attempt)
+		self.set_connection_state(connections.ConnectionState.DOWN)
+		# like the watchdog does for a dead link: the listener sees EOF and closes the socket, and
+		# the watchdog restarts the connection
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			logger.debug('shutdown of %s failed; probably already closed' % sock)
 		
-	def _do_zone_open(self, data): # handler for 609
-		zone = int(data) # 3 data bytes: 3-digit zone number
+	def _do_zone_open(self, record): # handler for 609
+		zone = record.zone
 		logger.info('zone %d: open' % zone)
 		self.cache._record_zone_status(zone, 1)
 
-	def _do_zone_closed(self, data): # handler for 610
-		zone = int(data) # 3 data bytes: 3-digit zone number
+	def _do_zone_closed(self, record): # handler for 610
+		zone = record.zone
 		logger.info('zone %d: closed' % zone)
 		self.cache._record_zone_status(zone, 0)
 
-	def _do_partition_ready(self, data): # handler for 650
-		partition = int(data) # 1 data byte: partition number
+	def _do_partition_ready(self, record): # handler for 650
+		partition = record.partition
 		logger.info('partition %d: ready' % partition)
+		self.pacer.on_partition_status(partition, False)
 		self.cache._record_partition_status(partition, PartitionStatus.READY)
 
-	def _do_partition_armed(self, data): # handler for 652
-		partition = int(data[0]) # 2 data bytes: partion number
-		mode = int(data[1])      # followed by arming mode code
+	def _do_partition_armed(self, record): # handler for 652
+		partition = record.partition
+		mode = record.value # arming mode code
 		logger.info('partition %d: closed (armed) mode %d' % (partition, mode))
+		self.pacer.on_partition_status(partition, False)
 		self.cache._record_partition_status(partition, PartitionStatus.ARMED)
 
-	def _do_partition_busy(self, data): # handler for 673
-		partition = int(data) # 1 data byte: partition number
+	def _do_partition_busy(self, record): # handler for 673
+		partition = record.partition
 		logger.info('partition %d: busy' % partition)
+		self.pacer.on_partition_status(partition, True)
 		self.cache._record_partition_status(partition, PartitionStatus.BUSY)
 
-	def _do_partition_trouble_on(self, data): # handler for 840
-		partition = int(data) # 1 data byte: partition number
+	def _do_partition_trouble_on(self, record): # handler for 840
+		partition = record.partition
 		logger.info('partition %d: TROUBLE' % partition)
 
-	def _do_partition_trouble_off(self, data): # handler for 841
-		partition = int(data) # 1 data byte: partition number
+	def _do_partition_trouble_off(self, record): # handler for 841
+		partition = record.partition
 		logger.info('partition %d: no trouble' % partition)
 
-	def _do_user_command_invoked(self, data):
-		assert len(data) == 2
-		partition_num = int(data[0])
-		command_num = int(data[1])
+	def _do_user_command_invoked(self, record): # handler for 912
+		partition_num = record.partition
+		command_num = record.value
 		logger.info('user command %d on partition %d' % (command_num, partition_num))
 
 	# A note on DSC integration responses, especially for partition status.
@@ -227,6 +378,7 @@ class DscPanelServer(object):
 	# even when the status changes. It may be necessary to handle everything in the 650-673
 	# range to avoid getting wedged on 'stale' after a global query.
 	_response_cmd_map = {
+		500: _do_cmd_ack,
 		501: _do_invalid_cmd,
 		505: _do_login,
 		# zone status updates
@@ -6,16 +6,27 @@
 # interface, by chaining through the one we control (since the Envisalink 2DS allows only
 # one client at a time).
 #
-# Terminology note: 'cmdline' variable holds encoded command with checksum but no CRLF terminator
+# Each client gets its own thread reading (and checksum-checking) what it sends us, and its
+# own connections.BufferedClientWriter for what we send it, so the envisalink listener thread
+# only ever queues data for the children and a slow or stuck client can't hold up the panel
+# for the rest of the house. A client that falls too far behind is either disconnected or,
+# with drop_when_full, just misses what doesn't fit.
+#
+# What clients send the panel has to share its (paced) send queue with stargate's own commands,
+# so clients' commands go at background priority, each client is rate limited, and we answer
+# what we can ourselves: polls (000) always, and global status requests (001) from the panel's
+# latest status reports while our connection to it is live. Status requests we do pass on are
+# collapsed: the panel's answer goes to every client anyway, so one per status_window is enough.
 #
-# BUGS:
-# - reflector is largely untested
+# Terminology note: 'cmdline' variable holds encoded command with checksum but no CRLF terminator
 
 import connections
 import logging
-import select
 import socket
 import threading
+import time
+
+import dsc_tpi
 
 
 logger = logging.getLogger(__name__)
@@ -31,42 +42,60 @@ class ReflectorThread(threading.Thread):
 		self.connected_socket = socket
 		self.client_address = client_address
 		self.authenticated = False
+		self.writer = connections.BufferedClientWriter(socket, 'dsc_reflector', self.reflector.max_queued,
+			self.reflector.drop_when_full)
+		self.bucket = connections.TokenBucket(self.reflector.rate, self.reflector.burst)
+		self.stats = { 'connected': time.time(), 'commands': 0, 'bad_commands': 0, 'answered': 0, 'collapsed': 0, 'throttled': 0 }
 
 	def run(self):
-		self.connected_socket.send('5053CD\r\n') # XXX hardcoded "authentication required" introduction
-		s = self.connected_socket
-		buffer = connections.CrlfSocketBuffer(s)
+		self.writer.start()
+		self.send(dsc_tpi.encode(505, '3')) # login interaction: password required
+		buffer = connections.CrlfSocketBuffer(self.connected_socket)
 
 		try:
 			while True:
-				(readable, writable, errored) = select.select([s], [], [s])
-				if errored:
-					logger.warning('reflector child reported error in select()')
-					break
-				assert readable == [s]
 				for line in buffer.read_lines():
-					# XXX we should crack the command, check the checksum, ignore if invalid instead of spamming other clients
-					if line[:3] == '005':
-						auth_response = self.attempt_auth(line)
-						s.send(auth_response + '\r\n')
-					elif self.authenticated:
-						self.reflector.from_child(line)
-					else:
-						logger.warning('DSC reflector: child attempted command %s in unauthenticated state' % line[:3])
+					self.handle_line(line)
 		except:
-			logger.exception('error in reflector child')
+			logger.info('DSC reflector: child %s went away' % str(self.client_address))
 
+		self.writer.close()
 		self.parent.child_exit(self)
-	
-	def attempt_auth(self, line):
+
+	def handle_line(self, line):
+		record = dsc_tpi.parse(line)
+		if record is None:
+			# answer like the envisalink does, rather than passing garbage to the panel
+			logger.warning('DSC reflector: child %s sent bad command %s' % (str(self.client_address), repr(line)))
+			self.stats['bad_commands'] += 1
+			self.send(dsc_tpi.encode(501))
+		elif record.code == 5:
+			self.send(self.attempt_auth(record))
+		elif self.authenticated:
+			self.stats['commands'] += 1
+			self.reflector.from_child(self, record)
+		else:
+			logger.warning('DSC reflector: child attempted command %03d in unauthenticated state' % record.code)
+
+	def attempt_auth(self, record):
 		# XXX: should be more careful with state machine, i.e. multiple auth commands. See what real one does and if it matters.
-		if line[3:-2] == self.reflector.password: # XXX ignore checksum; we should use a common cmdline cracker and check it
+		if record.data == self.reflector.password:
 			self.authenticated = True
 			logger.info('DSC reflector: child connection authenticated')
-			return '5051CB' # XXX hardcoded authentication success response
+			return dsc_tpi.encode(505, '1')
 		else:
 			logger.warning('DSC reflector: child connection failed authentication')
-			return '5050CA' # XXX hardcoded authentication failure response
+			return dsc_tpi.encode(505, '0')
+
+	def send(self, cmdline):
+		self.writer.write(cmdline + '\r\n')
+
+	def get_stats(self):
+		stats = dict(self.stats)
+		stats.update(self.writer.stats)
+		stats['address'] = self.client_address
+		stats['authenticated'] = self.authenticated
+		return stats
 
 
 class ReflectorParentThread(threading.Thread):
@@ -77,8 +106,9 @@ class ReflectorParentThread(threading.Thread):
 		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		self.listen_socket.bind(('', self.reflector.port))
-		self.listen_socket.listen(1)
+		self.listen_socket.listen(5)
 		self.children = []
+		self.lock = threading.Lock()
 
 	def run(self):
 		# Listen for connections, and handle them in new threads
@@ -86,22 +116,27 @@ class ReflectorParentThread(threading.Thread):
 			connected_socket, client_address = self.listen_socket.accept()
 			logger.info('reflector accepted chained connection from %s' % str(client_address))
 			child = ReflectorThread(self, connected_socket, client_address)
-			self.children.append(child)
-			child.run()
+			with self.lock:
+				self.children.append(child)
+			child.start()
 
-	def to_children(self, cmdLine):
-		logger.debug('send to %d children: %s' % (len(self.children), cmdLine))
-		for child in self.children:
-			logger.debug('to child %s' % str(child.client_address))
+	def to_children(self, cmdline):
+		# Only queues; each child's writer thread does the actual sending.
+		with self.lock:
+			children = list(self.children)
+		logger.debug('send to %d children: %s', len(children), cmdline)
+		for child in children:
 			if child.authenticated:
-				try:
-					child.connected_socket.send(cmdLine + '\r\n')
-				except:
-					logger.exception('unable to send to child %s' % str(child.client_address))
+				child.send(cmdline)
 
 	def child_exit(self, child):
-		logger.info('reflector lost chained connection to %s' % str(child.client_address))
-		self.children.remove(child)
+		logger.info('reflector lost chained connection to %s: %s' % (str(child.client_address), child.get_stats()))
+		with self.lock:
+			self.children.remove(child)
+
+	def get_client_stats(self):
+		with self.lock:
+			return [child.get_stats() for child in self.children]
 
 
 class Reflector(object):
@@ -109,24 +144,85 @@ class Reflector(object):
 	# better, and/or at least a different password, and/or at least restrict the listening address
 	# (assuming that stargate may be running on a box more widely network-accessible than the 2DS
 	# itself, for which the only reasonable strategy is to keep it far from the internet).
-	def __init__(self, gateway, port, password):
+	status_window = 2.0 # seconds during which another client's 001 is answered by the one in flight
+	# partition reports that are statuses (what 001 answers with), rather than one-time events
+	partition_status_codes = (650, 651, 652, 653, 654, 656, 657, 658, 659, 660, 673, 674)
+
+	def __init__(self, gateway, port, password, max_queued = 1000, drop_when_full = False, rate = 2, burst = 10):
 		self.gateway = gateway
 		self.port = port
 		self.password = password
+		self.max_queued = max_queued
+		self.drop_when_full = drop_when_full
+		self.rate = rate
+		self.burst = burst
+		self.status_lines = {} # map from ('zone'|'partition', number) to the panel's latest status report for it
+		self.last_status_request = 0
+		self.lock = threading.Lock()
 		self.reflect_thread = None
-		
+
 		if self.port:
+			gateway.panel_server.add_connection_state_listener(self._on_panel_state)
 			self.reflect_thread = ReflectorParentThread(self)
-			self.send_lock = threading.RLock()
 			self.reflect_thread.start()
-			
-	def to_children(self, cmdline):
+
+	def to_children(self, record):
+		# record is the dsc_tpi.TpiRecord DscPanelServer parsed; called on its listener thread
 		if self.reflect_thread:
-			with self.send_lock:
-				self.reflect_thread.to_children(cmdline)
-				
-	def from_child(self, cmdline):
-		# Child gave command; pass along to DSC
-		if cmdline[:3] == '005': # make sure children don't mess with parent authentication state
+			if record.code in (609, 610):
+				self.status_lines[('zone', record.zone)] = record.cmdline
+			elif record.code in self.partition_status_codes:
+				self.status_lines[('partition', record.partition)] = record.cmdline
+			self.reflect_thread.to_children(record.cmdline)
+
+	def _on_panel_state(self, old_state, new_state):
+		# Once the connection isn't live, the reports we kept may already be out of date (and
+		# we might not hear about it when they are); start over with what the panel sends in
+		# answer to the status request the next login makes.
+		if new_state != connections.ConnectionState.LIVE:
+			self.status_lines = {}
+
+	def from_child(self, child, record):
+		# Child gave command (already checksum-verified); answer it or pass it along to DSC
+		if record.code == 0:
+			# poll: we're talking to the panel (the watchdog sees to that), so just ack it
+			child.stats['answered'] += 1
+			child.send(dsc_tpi.encode(500, '000'))
+			return
+		if record.code == 1:
+			if self._answer_status_request(child):
+				child.stats['answered'] += 1
+				return
+			with self.lock:
+				# (including the ones stargate sends, on login or chasing stale cache entries)
+				now = time.time()
+				last_request = max(self.last_status_request, self.gateway.panel_server.cache.last_requery)
+				if now - last_request < self.status_window:
+					child.stats['collapsed'] += 1
+					return
+				self.last_status_request = now
+		if not child.bucket.try_consume():
+			logger.warning('DSC reflector: child %s over rate limit; rejecting %03d' % (str(child.client_address), record.code))
+			child.stats['throttled'] += 1
+			child.send(dsc_tpi.encode(501))
 			return
-		self.gateway.panel_server._send_dsc_cmdline(cmdline)
+		self.gateway.panel_server._send_dsc_cmdline(record.cmdline, connections.Priority.BACKGROUND)
+
+	def _answer_status_request(self, child):
+		# The cache (and our copy of the reports behind it) is only good while we're live; while
+		# syncing or reconnecting, let the panel answer.
+		if self.gateway.panel_server.get_connection_state() != connections.ConnectionState.LIVE or not self.status_lines:
+			return False
+		lines = [self.status_lines[key] for key in sorted(self.status_lines.keys())]
+		child.send(dsc_tpi.encode(500, '001'))
+		for cmdline in lines:
+			child.send(cmdline)
+		return True
+
+	def get_client_stats(self):
+		# list of dicts, one per connected client: address, authenticated, connected (time),
+		# commands, bad_commands, answered (by us), collapsed (status requests), throttled, and
+		# its writer's queued/sent/dropped counts
+		if self.reflect_thread:
+			return self.reflect_thread.get_client_stats()
+		return []
@@ -0,0 +1,142 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Control of DSC PowerSeries system.
+#
+# This module provides a local stand-in for the Envisalink TPI (the panel's integration
+# interface), for exercising DscPanelServer without a real panel. It implements just enough
+# of the protocol to log in, answer polls and global status requests, and react to command
+# output (020) requests the way a partition does: busy for a little while, then ready. A
+# partition command that arrives while the partition is still busy counts as "confused".
+#
+# Run as a script (from the stargate directory: python -m gateways.powerseries.dsc_simulator)
+# to benchmark how quickly DscPanelServer drains a burst of bridged commands.
+#
+# Terminology note: 'cmdline' variable holds encoded command with checksum but no CRLF terminator
+
+import logging
+import select
+import socket
+import threading
+import time
+
+import connections
+from dsc_tpi import encode, verify
+
+
+logger = logging.getLogger(__name__)
+logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
+
+
+class TpiSimulator(threading.Thread):
+	def __init__(self, password = 'user', port = 0, partitions = (1, 2), zones = range(1, 9), busy_time = 0.15):
+		super(TpiSimulator, self).__init__(name = 'dsc_simulator')
+		self.daemon = True
+		self.password = password
+		self.partitions = partitions
+		self.zones = zones
+		self.busy_time = busy_time
+		self.busy_until = {} # map from partition number to time it stops being busy
+		self.stats = { 'commands': 0, 'user_commands': 0, 'confused': 0 }
+		self.lock = threading.Lock()
+		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listen_socket.bind(('localhost', port))
+		self.listen_socket.listen(1)
+		self.port = self.listen_socket.getsockname()[1]
+
+	def run(self):
+		while True:
+			conn, address = self.listen_socket.accept()
+			logger.info('simulator accepted connection from %s' % str(address))
+			t = threading.Thread(target = self.serve, args = (conn,), name = 'dsc_simulator_client')
+			t.daemon = True
+			t.start()
+
+	def serve(self, conn):
+		conn.send(encode(505, '3') + '\r\n')
+		buffer = connections.CrlfSocketBuffer(conn)
+		authenticated = False
+		try:
+			while True:
+				select.select([conn], [], [])
+				for line in buffer.read_lines():
+					if not verify(line):
+						self._reply(conn, 502, '020') # API command syntax error
+						continue
+					if line[:3] == '005':
+						authenticated = (line[3:-2] == self.password)
+						self._reply(conn, 505, '1' if authenticated else '0')
+					elif authenticated:
+						self.handle(conn, int(line[:3]), line[3:-2])
+		except:
+			logger.info('simulator client went away')
+		conn.close()
+
+	def handle(self, conn, command, data):
+		with self.lock:
+			self.stats['commands'] += 1
+		self._reply(conn, 500, '%03d' % command)
+		if command == 1: # global status
+			for zone in self.zones:
+				self._reply(conn, 610, '%03d' % zone)
+			for partition in self.partitions:
+				self._reply(conn, 650, str(partition))
+		elif command == 20: # command output
+			partition = int(data[0])
+			now = time.time()
+			with self.lock:
+				self.stats['user_commands'] += 1
+				if self.busy_until.get(partition, 0) > now:
+					self.stats['confused'] += 1
+					return
+				self.busy_until[partition] = now + self.busy_time
+			self._reply(conn, 673, str(partition))
+			def finish():
+				time.sleep(self.busy_time)
+				self._reply(conn, 912, data)
+				self._reply(conn, 650, str(partition))
+			t = threading.Thread(target = finish)
+			t.daemon = True
+			t.start()
+
+	def _reply(self, conn, command, data):
+		connections.send_all(conn, encode(command, data) + '\r\n')
+
+
+if __name__ == '__main__':
+	# Benchmark: time to drain a burst of bridged (020) commands through DscPanelServer, paced
+	# by DscSendPacer, versus the old fixed half-second gap between commands.
+	import dsc_panel
+	import timer
+
+	logging.basicConfig(level = logging.ERROR)
+
+	class StubGateway(object):
+		reflector = None
+		def on_user_action(self, dev_type, dev_id, state, refresh):
+			pass
+
+	class FixedDelayPanelServer(dsc_panel.DscPanelServer):
+		pace_send = None
+		def separate_sends(self):
+			time.sleep(0.5)
+
+	watchdog = connections.SgWatchdog()
+	watchdog.start()
+	sg_timer = timer.SgTimer()
+	for (label, cls) in (('fixed 0.5s gap', FixedDelayPanelServer), ('DscSendPacer', dsc_panel.DscPanelServer)):
+		sim = TpiSimulator()
+		sim.start()
+		server = cls(StubGateway(), watchdog, sg_timer, 'localhost', sim.port, sim.password)
+		server.connect()
+		# wait for the global status dump to finish, so its 650s don't arrive mid-benchmark
+		while 'stale' in [server.cache.partition_status[p] for p in sim.partitions]:
+			time.sleep(0.01)
+		count = 8
+		start = time.time()
+		for i in range(count):
+			server.send_dsc_command(20, [str(1 + i % 2), str(1 + i % 4)])
+		while sim.stats['user_commands'] < count:
+			time.sleep(0.005)
+		elapsed = time.time() - start
+		print '%-16s %d commands in %.2f seconds; panel confused by %d' % (label, count, elapsed, sim.stats['confused'])
@@ -0,0 +1,240 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Control of DSC PowerSeries system.
+#
+# This module is the codec for the panel's integration protocol (the IT-100/Envisalink "TPI"):
+# encoding commands with their checksum, verifying checksums, and parsing each line into a
+# TpiRecord whose fields are filled in according to the code table below. DscPanelServer parses
+# each line from the panel once and hands the same record to its handlers and the reflector;
+# the reflector and simulator use it for the lines their clients send.
+#
+# Every line is 3 digit code, data (0 or more characters, format depends on the code), and 2 hex
+# digit checksum: the sum of the code and data characters, modulo 256.
+#
+# Run as a script (from the stargate directory: python -m gateways.powerseries.dsc_tpi) to
+# benchmark parsing against the old encode-and-compare checksum check.
+#
+# Terminology note: 'cmdline' variable holds encoded command with checksum but no CRLF terminator
+
+import collections
+
+
+# checksum byte -> its 2 character encoding
+_checksum_hex = ['%02X' % i for i in range(256)]
+
+
+# Data formats, by what they tell us. Each fills in some of TpiRecord's partition, zone and value.
+NONE = 'none'                   # no data
+TEXT = 'text'                   # data we don't crack; see TpiRecord.data
+NUMBER = 'number'               # value: the whole data field, as a number (command, error, login response)
+ZONE = 'zone'                   # zone: 3 digits
+PARTITION = 'partition'         # partition: 1 digit
+PARTITION_ZONE = 'partition_zone'   # partition: 1 digit, zone: 3 digits
+PARTITION_VALUE = 'partition_value' # partition: 1 digit, value: the rest, as a number (arming mode, user, output)
+PARTITION_TEXT = 'partition_text'   # partition: 1 digit, then data we don't crack (access codes, keystrokes)
+
+
+# code -> (name, data format). Codes below 500 are commands to the panel; 500 and up are what it
+# sends back.
+codes = {
+	# application to panel
+	0: ('poll', NONE),
+	1: ('status_report', NONE),
+	2: ('labels_request', NONE),
+	5: ('network_login', TEXT),
+	8: ('dump_zone_timers', NONE),
+	10: ('set_time_and_date', TEXT),
+	20: ('command_output_control', PARTITION_VALUE),
+	30: ('partition_arm_away', PARTITION),
+	31: ('partition_arm_stay', PARTITION),
+	32: ('partition_arm_zero_entry_delay', PARTITION),
+	33: ('partition_arm_with_code', PARTITION_TEXT),
+	40: ('partition_disarm', PARTITION_TEXT),
+	55: ('time_stamp_control', NUMBER),
+	56: ('time_broadcast_control', NUMBER),
+	57: ('temperature_broadcast_control', NUMBER),
+	60: ('trigger_panic_alarm', NUMBER),
+	70: ('single_keystroke', TEXT),
+	71: ('send_keystroke_string', PARTITION_TEXT),
+	72: ('enter_user_code_programming', PARTITION),
+	73: ('enter_user_programming', PARTITION),
+	74: ('keep_alive', PARTITION),
+	200: ('code_send', TEXT),
+
+	# panel to application: command responses and system
+	500: ('command_acknowledge', NUMBER),
+	501: ('command_error', NONE),
+	502: ('system_error', NUMBER),
+	505: ('login_interaction', NUMBER),
+	510: ('keypad_led_state', TEXT),
+	511: ('keypad_led_flash_state', TEXT),
+	550: ('time_date_broadcast', TEXT),
+	560: ('ring_detected', NONE),
+	561: ('indoor_temperature_broadcast', TEXT),
+	562: ('outdoor_temperature_broadcast', TEXT),
+	# zones
+	601: ('zone_alarm', PARTITION_ZONE),
+	602: ('zone_alarm_restore', PARTITION_ZONE),
+	603: ('zone_tamper', PARTITION_ZONE),
+	604: ('zone_tamper_restore', PARTITION_ZONE),
+	605: ('zone_fault', ZONE),
+	606: ('zone_fault_restore', ZONE),
+	609: ('zone_open', ZONE),
+	610: ('zone_restored', ZONE),
+	615: ('zone_timer_dump', TEXT),
+	616: ('bypassed_zones_dump', TEXT),
+	# keypad alarms
+	620: ('duress_alarm', TEXT),
+	621: ('fire_key_alarm', NONE),
+	622: ('fire_key_restored', NONE),
+	623: ('auxiliary_key_alarm', NONE),
+	624: ('auxiliary_key_restored', NONE),
+	625: ('panic_key_alarm', NONE),
+	626: ('panic_key_restored', NONE),
+	631: ('smoke_aux_alarm', NONE),
+	632: ('smoke_aux_restored', NONE),
+	# partitions
+	650: ('partition_ready', PARTITION),
+	651: ('partition_not_ready', PARTITION),
+	652: ('partition_armed', PARTITION_VALUE),
+	653: ('partition_ready_force_arming', PARTITION),
+	654: ('partition_in_alarm', PARTITION),
+	655: ('partition_disarmed', PARTITION),
+	656: ('exit_delay', PARTITION),
+	657: ('entry_delay', PARTITION),
+	658: ('keypad_lockout', PARTITION),
+	659: ('partition_failed_to_arm', PARTITION),
+	660: ('pgm_output_in_progress', PARTITION),
+	663: ('chime_enabled', PARTITION),
+	664: ('chime_disabled', PARTITION),
+	670: ('invalid_access_code', PARTITION),
+	671: ('function_not_available', PARTITION),
+	672: ('failure_to_arm', PARTITION),
+	673: ('partition_busy', PARTITION),
+	674: ('system_arming_in_progress', PARTITION),
+	680: ('installers_mode', NONE),
+	# arming and disarming (DSC terminology is partition opening/closing)
+	700: ('user_closing', PARTITION_VALUE),
+	701: ('special_closing', PARTITION),
+	702: ('partial_closing', PARTITION),
+	750: ('user_opening', PARTITION_VALUE),
+	751: ('special_opening', PARTITION),
+	# troubles
+	800: ('panel_battery_trouble', NONE),
+	801: ('panel_battery_trouble_restore', NONE),
+	802: ('panel_ac_trouble', NONE),
+	803: ('panel_ac_restore', NONE),
+	806: ('system_bell_trouble', NONE),
+	807: ('system_bell_trouble_restore', NONE),
+	814: ('ftc_trouble', NONE),
+	816: ('buffer_near_full', NONE),
+	829: ('general_system_tamper', NONE),
+	830: ('general_system_tamper_restore', NONE),
+	840: ('trouble_led_on', PARTITION),
+	841: ('trouble_led_off', PARTITION),
+	842: ('fire_trouble_alarm', NONE),
+	843: ('fire_trouble_alarm_restore', NONE),
+	849: ('verbose_trouble_status', TEXT),
+	# prompts and command output
+	900: ('code_required', TEXT),
+	912: ('command_output_pressed', PARTITION_VALUE),
+	921: ('master_code_required', TEXT),
+	922: ('installers_code_required', TEXT),
+}
+
+
+# A parsed line. partition, zone and value are None unless the code's data format has them.
+TpiRecord = collections.namedtuple('TpiRecord', 'code name data partition zone value cmdline')
+
+
+def checksum(cmd):
+	# cmd is code and data, without checksum
+	return _checksum_hex[sum(bytearray(cmd)) & 0xff]
+
+
+def encode(code, data = ''):
+	# data is a string, or a list of single-character strings
+	cmd = '%03d%s' % (code, ''.join(data))
+	return cmd + _checksum_hex[sum(bytearray(cmd)) & 0xff]
+
+
+def verify(cmdline):
+	return len(cmdline) >= 5 and _checksum_hex[sum(bytearray(cmdline[:-2])) & 0xff] == cmdline[-2:].upper()
+
+
+def parse(cmdline):
+	# Returns a TpiRecord, or None if cmdline is malformed or its checksum is wrong.
+	if not verify(cmdline):
+		return None
+	try:
+		code = int(cmdline[:3])
+	except ValueError:
+		return None
+	data = cmdline[3:-2]
+	(name, data_format) = codes.get(code, ('unknown', TEXT))
+	partition = zone = value = None
+	try:
+		if data_format == ZONE:
+			zone = int(data[:3])
+		elif data_format == PARTITION or data_format == PARTITION_TEXT:
+			partition = int(data[0])
+		elif data_format == PARTITION_ZONE:
+			partition = int(data[0])
+			zone = int(data[1:4])
+		elif data_format == PARTITION_VALUE:
+			partition = int(data[0])
+			value = int(data[1:])
+		elif data_format == NUMBER:
+			value = int(data)
+	except (ValueError, IndexError):
+		return None
+	return TpiRecord(code, name, data, partition, zone, value, cmdline)
+
+
+if __name__ == '__main__':
+	# Benchmark: lines/sec through parse(), over a capture of panel traffic (one cmdline per line)
+	# if given, else a synthetic monitoring mix, versus the old check (re-encode one character at
+	# a time through a list, compare, then int() the code).
+	import sys
+	import time
+
+	def old_encode(command, data_bytes):
+		cmd_bytes = '%03d' % command
+		cmd = []
+		checksum = 0
+		for byte in cmd_bytes:
+			cmd.append(byte)
+			checksum += ord(byte)
+		for byte in data_bytes:
+			cmd.append(byte)
+			checksum += ord(byte)
+		checksum = checksum % 256
+		cmd.extend([hex(nibble)[-1].upper() for nibble in [ checksum / 16, checksum % 16]])
+		return ''.join(cmd)
+
+	def old_check(cmdline):
+		(cmd_num, cmd_data, checksum) = (int(cmdline[:3]), cmdline[3:-2], cmdline[-2:])
+		if cmdline != old_encode(cmd_num, cmd_data):
+			return None
+		return cmd_num
+
+	if len(sys.argv) > 1:
+		lines = [line.strip() for line in open(sys.argv[1]) if line.strip()]
+	else:
+		lines = []
+		for i in range(1000):
+			lines.append(encode(609 + i % 2, '%03d' % (1 + i % 64)))
+			lines.append(encode(650 + (i % 3) * 11, str(1 + i % 8)))
+			lines.append(encode(601 + i % 4, '%d%03d' % (1 + i % 8, 1 + i % 64)))
+			lines.append(encode(500, '%03d' % (i % 100)))
+			lines.append(encode(510, '81'))
+			lines.append(encode(550, '1234071112'))
+	assert all([old_check(line) == parse(line).code for line in lines])
+
+	for (label, fn) in (('old encode-compare', old_check), ('dsc_tpi.parse', parse)):
+		start = time.time()
+		for rep in range(20):
+			for line in lines:
+				fn(line)
+		elapsed = time.time() - start
+		print '%-20s %d lines/sec' % (label, 20 * len(lines) / elapsed)
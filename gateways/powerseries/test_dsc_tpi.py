@@ -0,0 +1,84 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Control of DSC PowerSeries system.
+#
+# Tests for the dsc_tpi codec. Run from the stargate directory:
+# python -m unittest discover -s gateways/powerseries -p 'test_*.py'
+
+import unittest
+
+import dsc_tpi
+
+
+class ChecksumTest(unittest.TestCase):
+	def test_checksum(self):
+		# sum of the code and data characters, modulo 256, as 2 uppercase hex digits
+		self.assertEqual(dsc_tpi.checksum('000'), '90')
+		self.assertEqual(dsc_tpi.checksum('6501'), 'CC')
+		self.assertEqual(dsc_tpi.checksum('51081'), 'FF')
+
+	def test_encode(self):
+		self.assertEqual(dsc_tpi.encode(0), '00090')
+		self.assertEqual(dsc_tpi.encode(1), '00191')
+		self.assertEqual(dsc_tpi.encode(500, '001'), '50000126')
+		self.assertEqual(dsc_tpi.encode(5, ['u', 's', 'e', 'r']), '005user54')
+
+	def test_verify(self):
+		self.assertTrue(dsc_tpi.verify('00191'))
+		self.assertTrue(dsc_tpi.verify('6501CC'))
+		self.assertTrue(dsc_tpi.verify('6501cc')) # the checksum's case doesn't matter
+		self.assertFalse(dsc_tpi.verify('00192'))
+		self.assertFalse(dsc_tpi.verify('6502CC'))
+		self.assertFalse(dsc_tpi.verify('001'))
+		self.assertFalse(dsc_tpi.verify(''))
+
+
+class ParseTest(unittest.TestCase):
+	def assertRecord(self, cmdline, code, name, data, partition = None, zone = None, value = None):
+		record = dsc_tpi.parse(cmdline)
+		self.assertEqual(record, dsc_tpi.TpiRecord(code, name, data, partition, zone, value, cmdline))
+
+	def test_bad_lines(self):
+		self.assertEqual(dsc_tpi.parse('00192'), None) # bad checksum
+		self.assertEqual(dsc_tpi.parse('60900535'), None)
+		self.assertEqual(dsc_tpi.parse('91'), None) # too short
+		self.assertEqual(dsc_tpi.parse('abc' + dsc_tpi.checksum('abc')), None) # code isn't a number
+		self.assertEqual(dsc_tpi.parse('609abcC5'), None) # zone isn't a number
+		self.assertEqual(dsc_tpi.parse(dsc_tpi.encode(650)), None) # partition missing
+
+	def test_none(self):
+		self.assertRecord('00090', 0, 'poll', '')
+		self.assertRecord('00191', 1, 'status_report', '')
+
+	def test_number(self):
+		self.assertRecord('50000126', 500, 'command_acknowledge', '001', value = 1)
+		self.assertRecord(dsc_tpi.encode(505, '3'), 505, 'login_interaction', '3', value = 3)
+
+	def test_zone(self):
+		self.assertRecord('60900534', 609, 'zone_open', '005', zone = 5)
+		self.assertRecord(dsc_tpi.encode(610, '064'), 610, 'zone_restored', '064', zone = 64)
+
+	def test_partition(self):
+		self.assertRecord('6501CC', 650, 'partition_ready', '1', partition = 1)
+
+	def test_partition_zone(self):
+		self.assertRecord('60110055D', 601, 'zone_alarm', '1005', partition = 1, zone = 5)
+
+	def test_partition_value(self):
+		self.assertRecord('6521200', 652, 'partition_armed', '12', partition = 1, value = 2)
+		self.assertRecord(dsc_tpi.encode(912, '14'), 912, 'command_output_pressed', '14', partition = 1, value = 4)
+
+	def test_partition_text(self):
+		self.assertRecord('040112348F', 40, 'partition_disarm', '11234', partition = 1)
+
+	def test_text(self):
+		self.assertRecord('550123407111290', 550, 'time_date_broadcast', '1234071112')
+		self.assertRecord('005user54', 5, 'network_login', 'user')
+
+	def test_unknown_code(self):
+		# passed through as text, so the reflector can still relay it
+		self.assertRecord('999xyz16', 999, 'unknown', 'xyz')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -4,21 +4,35 @@
 
 import ra_gateway
 import ra_layout
+import ra_reflector
 import ra_repeater
 
 def get_dependencies(gateway_config):
 	return set()
 
-def init(house, instance_name, gateway_config):
-	repeater_config = gateway_config.repeater
+def load_layout(repeater_config):
 	layout = ra_layout.RaLayout(ignore_devices = repeater_config.layout.ignore_keypads)
 	if repeater_config.has_key('cached_database'):
 		layout.read_cached_db(repeater_config.cached_database)
+		compiled_file = repeater_config.cached_database + '.compiled'
 	else:
 		layout.get_live_db(repeater_config.hostname)
-	layout.map_db()
+		compiled_file = 'DbXmlInfo-%s.compiled' % repeater_config.hostname
+	if repeater_config.has_key('compiled_database'):
+		compiled_file = repeater_config.compiled_database
+	layout.map_db(compiled_file)
+	return layout
+
+def init(house, instance_name, gateway_config):
+	repeater_config = gateway_config.repeater
+	layout = load_layout(repeater_config)
 
 	repeater = ra_repeater.RaRepeater(house.watchdog)
 	repeater.connect(repeater_config.hostname, repeater_config.username, repeater_config.password)
+	if repeater_config.get('reflector_port'):
+		repeater.reflector = ra_reflector.Reflector(repeater, repeater_config.reflector_port,
+			repeater_config.username, repeater_config.password)
 
-	return ra_gateway.RaGateway(house, instance_name, repeater, layout)
+	gateway = ra_gateway.RaGateway(house, instance_name, repeater, layout, repeater_config.get('query_timeout', 5))
+	gateway.start_layout_refresh(lambda: load_layout(repeater_config), repeater_config.layout.get('refresh_interval'))
+	return gateway
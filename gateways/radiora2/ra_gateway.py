@@ -6,8 +6,11 @@
 # RadioRa2 devices.
 
 import logging
+import threading
 
+import connections
 import sg_house
+import sg_signal
 import ra_layout
 import ra_repeater
 
@@ -32,10 +35,16 @@ class LutronDevice(sg_house.StargateDevice):
 	def on_user_action(self, level, synthetic, comp_id):
 		self.house.events.on_device_state_change(self, synthetic) # state
 
+	def _unregister(self):
+		# device was removed from the layout
+		self.gateway._unregister_device(self)
+		self.area.unregister_device(self)
+
 
 class OutputDevice(LutronDevice):
 	# Common device subclass for controllable outputs (lights, shades, appliances).
 	level_step = 100
+	state_levels = {} # map from state to the level that means, for states that are a level
 
 	def __init__(self, ra_area, device_spec):
 		super(OutputDevice, self).__init__('output', ra_area, device_spec.iid, device_spec.name)
@@ -45,15 +54,28 @@ class OutputDevice(LutronDevice):
 		return self.gateway._get_output_level(self.iid)
 
 	def set_level(self, level):
-		self.gateway._set_output_level(self.iid, level)
+		return self.gateway._set_output_level(self.iid, level)
+
+	def get_pending_level(self):
+		# level we've asked for but the repeater hasn't confirmed yet, or None
+		pending = self.gateway._get_pending_output(self.iid)
+		return pending.level if pending else None
+
+	def wait_until_settled(self, timeout = None):
+		pending = self.gateway._get_pending_output(self.iid)
+		return pending.wait(timeout) if pending else True
 
 	def get_name_for_level(self, level):
 		return 'on' if level > 0 else 'off'
+
+	def get_level_for_state(self, state):
+		return self.state_levels.get(state)
 	
 
 class SwitchedOutput(OutputDevice):
 	devtype = 'light'
 	possible_states = ( 'off', 'on' )
+	state_levels = { 'off': 0, 'on': 100 }
 
 	def __init__(self, ra_area, device_spec):
 		super(SwitchedOutput, self).__init__(ra_area, device_spec)
@@ -73,6 +95,7 @@ class SwitchedOutput(OutputDevice):
 
 class DimmedOutput(SwitchedOutput):
 	possible_states = ( 'off', 'half', 'on' )
+	state_levels = { 'off': 0, 'half': 50, 'on': 100 }
 	level_step = 1
 
 	def __init__(self, ra_area, device_spec):
@@ -85,6 +108,7 @@ class DimmedOutput(SwitchedOutput):
 class ShadeOutput(OutputDevice):
 	devtype = 'shade'
 	possible_states = ( 'open', 'half', 'closed' )
+	state_levels = { 'open': 100, 'half': 50, 'closed': 0 }
 	level_step = 1
 
 	def __init__(self, ra_area, device_spec):
@@ -94,13 +118,15 @@ class ShadeOutput(OutputDevice):
 		self.set_level(50)
 
 	def is_closed(self):
-		return self.get_level() <= 0.5 # some slop
+		level = self.get_level()
+		return level is not None and level <= 0.5 # some slop
 	
 	def be_closed(self):
 		self.set_level(0)
 
 	def is_open(self):
-		return not self.is_closed()
+		level = self.get_level()
+		return level is not None and level > 0.5
 
 	def is_fully_open(self):
 		return self.get_level() >= 99.5 # I've seen 99.61, 100.01... allow some slop
@@ -115,6 +141,7 @@ class ShadeOutput(OutputDevice):
 class ContactClosureOutput(OutputDevice):
 	devtype = 'contactclosure'
 	possible_states = ( 'active', 'inactive' )
+	state_levels = { 'active': 100, 'inactive': 0 }
 
 	def __init__(self, ra_area, device_spec):
 		super(ContactClosureOutput, self).__init__(ra_area, device_spec)
@@ -190,14 +217,35 @@ class KeypadDevice(ControlDevice):
 	def __init__(self, ra_area, device_spec):
 		super(KeypadDevice, self).__init__(ra_area, device_spec)
 		self.buttons = dict()
+		self._update_buttons(device_spec)
+
+	def _update_buttons(self, device_spec):
+		# Called at creation, and again if a layout refresh changes this keypad's buttons.
+		for button_id in self.buttons.keys():
+			if not device_spec.buttons.has_key(button_id):
+				self._remove_button(button_id)
 		for button_id in device_spec.buttons.keys():
 			led_cid = button_id + 80 # it just works out that way
 			if not led_cid in device_spec.leds:
 				led_cid = None
-			self._add_button(button_id, device_spec.buttons[button_id], led_cid)
+			if self.buttons.has_key(button_id):
+				button = self.buttons[button_id]
+				button.name = device_spec.buttons[button_id]
+				button.led_cid = led_cid
+			else:
+				self._add_button(button_id, device_spec.buttons[button_id], led_cid)
 
 	def _add_button(self, cid, label, has_led):
 		self.buttons[cid] = KeypadButton(self, cid, label, has_led)
+
+	def _remove_button(self, cid):
+		button = self.buttons.pop(cid)
+		button.area.unregister_device(button)
+
+	def _unregister(self):
+		for button_id in self.buttons.keys():
+			self._remove_button(button_id)
+		super(KeypadDevice, self)._unregister()
 	
 	def get_button_ids(self):
 		return sorted(self.buttons.keys())
@@ -219,7 +267,9 @@ class KeypadDevice(ControlDevice):
 		# by device. So keypad buttons are a Stargate device even though they're not a Lutron
 		# device, and when an event happens to the Lutron keypad device, we proxy it to the
 		# button (Stargate) device for event history.
-		button = self.buttons[comp_id]
+		button = self.buttons.get(comp_id)
+		if button is None:
+			return # removed by a layout refresh while the report was in flight
 		self.house.events.on_device_state_change(button, synthetic) # state
 
 	def get_child_ids(self):
@@ -263,10 +313,10 @@ class MotionSensorDevice(ControlDevice):
 	# can't be queried (I think to extend battery life they're send-only and only on edge triggers).
 
 	def get_level(self):
-		try:
-			return self.gateway._get_button_state(self.iid, 2)
-		except:
-			return -1 # if we haven't heard from the device, the above will get a KeyError; nothing we can do about that.
+		level = self.gateway._get_button_state(self.iid, 2)
+		if level is None:
+			return -1 # we haven't heard from the device (or it's gone); nothing we can do about that.
+		return level
 
 	def is_occupied(self):
 		return self.get_level() > 0
@@ -347,9 +397,54 @@ class RaArea(object):
 		self.members = [create_device_for_output(self, output_spec) for output_spec in area_spec.get_outputs()] + [
 					    create_device_for_control(self, device_spec) for device_spec in area_spec.get_devices()]
 
+	# used by layout refresh to change membership after creation
+	def add_output(self, output_spec):
+		device = create_device_for_output(self, output_spec)
+		self.members.append(device)
+		return device
+
+	def add_control(self, device_spec):
+		device = create_device_for_control(self, device_spec)
+		self.members.append(device)
+		return device
+
+	def remove_member(self, device):
+		self.members.remove(device)
+		device._unregister()
+
+
+class LayoutRefreshThread(threading.Thread):
+	# Reloads the layout every refresh_interval seconds (if set), and whenever poked (on SIGHUP),
+	# and has the gateway apply whatever changed. Reloading goes through load_layout, which
+	# returns a new RaLayout the same way the gateway's original one was built.
+	def __init__(self, gateway, load_layout, refresh_interval = None):
+		super(LayoutRefreshThread, self).__init__(name = 'ra_layout_refresh')
+		self.daemon = True
+		self.gateway = gateway
+		self.load_layout = load_layout
+		self.refresh_interval = refresh_interval
+		self.wakeup = threading.Event()
+
+	def poke(self):
+		self.wakeup.set()
+
+	def run(self):
+		connections.set_thread_priority(connections.Priority.BACKGROUND)
+		while True:
+			self.wakeup.wait(self.refresh_interval)
+			self.wakeup.clear()
+			logger.info('refreshing layout')
+			try:
+				layout = self.load_layout()
+			except Exception as ex:
+				# typically the repeater's web server didn't answer; try again next time
+				logger.warning('layout refresh failed: %s' % ex)
+				continue
+			self.gateway.apply_layout(layout)
+
 
 class RaGateway(sg_house.StargateGateway):
-	def __init__(self, house, gateway_instance_name, repeater, layout):
+	def __init__(self, house, gateway_instance_name, repeater, layout, query_timeout = 5):
 		super(RaGateway, self).__init__(house, gateway_instance_name)
 		self.devices = {}
 		self.areas = {}
@@ -365,14 +460,98 @@ class RaGateway(sg_house.StargateGateway):
 		self.root_area.members = self.members
 
 		# tell repeater object about the layout (which devices to cache)
-		cache = ra_repeater.OutputCache()
-		for iid in layout.get_output_ids():
-			cache.watch_output(iid)
-		for iid in layout.get_device_ids():
-			device = layout.get_device(iid)
-			cache.watch_device(iid, device.get_button_component_ids(), device.get_led_component_ids())
+		cache = self.cache = ra_repeater.OutputCache(query_timeout)
+		for output in layout.get_outputs():
+			cache.watch_output(output.iid, output.area.iid)
+		for device in layout.get_devices():
+			cache.watch_device(device.iid, device.get_button_component_ids(), device.get_led_component_ids(), device.area.iid)
 		cache.subscribe_to_actions(self)
 		repeater.bind_cache(cache)
+		self.layout_refresher = None
+
+	def start_layout_refresh(self, load_layout, refresh_interval = None):
+		# pick up changes from Lutron's programming software without a restart
+		self.layout_refresher = LayoutRefreshThread(self, load_layout, refresh_interval)
+		self.layout_refresher.start()
+		sg_signal.add_hup_listener(self.layout_refresher.poke)
+
+	def apply_layout(self, layout):
+		# Bring the device tree in line with a newly loaded layout, touching only what changed:
+		# removed outputs and keypads go away, new ones are created and their state queried, and
+		# renames and keypad button changes are applied in place. Anything that moved to another
+		# area, changed type, or whose area was renamed is recreated in its new home. Devices
+		# that didn't change keep their cached state, so there's no refresh storm.
+		if layout.db_hash is not None and layout.db_hash == self.layout.db_hash:
+			logger.info('layout unchanged')
+			return
+		# The repeater listener and the getters use the device tables and the cache's watch tables,
+		# so change them all under the cache's lock (which they take too).
+		with self.cache.updated:
+			self._apply_layout_changes(self.layout, layout)
+			self.layout = layout
+		logger.info('layout refresh complete')
+
+	def _apply_layout_changes(self, old, layout):
+		new_areas = dict([(area.iid, area) for area in layout.get_areas()])
+		moved_areas = set([iid for iid in self.areas.keys()
+		                   if iid != 0 and (iid not in new_areas or new_areas[iid].name != self.areas[iid].name)])
+
+		def needs_recreate(old_spec, new_spec):
+			return (new_spec is None or new_spec.get_type() != old_spec.get_type() or
+			        new_spec.area.iid != old_spec.area.iid or new_spec.area.iid in moved_areas)
+
+		# first remove what's gone or moving, and rename what's staying
+		for iid in old.get_output_ids():
+			old_spec = old.outputs[iid]
+			new_spec = layout.outputs.get(iid)
+			device = self.devices[iid]
+			if needs_recreate(old_spec, new_spec):
+				logger.info('layout refresh: remove output %d (%s)' % (iid, device.name))
+				device.ra_area.remove_member(device)
+				self.cache.unwatch_output(iid)
+			elif new_spec.name != device.name:
+				logger.info('layout refresh: rename output %d from %s to %s' % (iid, device.name, new_spec.name))
+				device.name = new_spec.name
+		for iid in old.get_device_ids():
+			old_spec = old.devices[iid]
+			new_spec = layout.devices.get(iid)
+			device = self.devices[iid]
+			if needs_recreate(old_spec, new_spec):
+				logger.info('layout refresh: remove device %d (%s)' % (iid, device.name))
+				device.ra_area.remove_member(device)
+				self.cache.unwatch_device(iid)
+				continue
+			if new_spec.name != device.name:
+				logger.info('layout refresh: rename device %d from %s to %s' % (iid, device.name, new_spec.name))
+				device.name = new_spec.name
+			if new_spec.buttons != old_spec.buttons or new_spec.leds != old_spec.leds:
+				logger.info('layout refresh: update buttons for device %d (%s)' % (iid, device.name))
+				if hasattr(device, '_update_buttons'):
+					device._update_buttons(new_spec)
+				self.cache.watch_device(iid, new_spec.get_button_component_ids(), new_spec.get_led_component_ids(), new_spec.area.iid)
+
+		# areas that went away or were renamed are now empty (of our devices, anyway; the house
+		# keeps the area while other gateways still have devices in it)
+		for iid in moved_areas:
+			ra_area = self.areas.pop(iid)
+			self.members.remove(ra_area)
+			self.house.release_area(ra_area.sg_area)
+
+		# then create what's new (including what moved)
+		for area_spec in layout.get_areas():
+			if not self.areas.has_key(area_spec.iid):
+				logger.info('layout refresh: add area %d (%s)' % (area_spec.iid, area_spec.name))
+				self.members.append(RaArea(self, ra_layout.Area(area_spec.iid, area_spec.name)))
+		for output_spec in layout.get_outputs():
+			if not self.devices.has_key(output_spec.iid):
+				logger.info('layout refresh: add output %d (%s)' % (output_spec.iid, output_spec.name))
+				self.areas[output_spec.area.iid].add_output(output_spec)
+				self.cache.watch_output(output_spec.iid, output_spec.area.iid)
+		for device_spec in layout.get_devices():
+			if not self.devices.has_key(device_spec.iid):
+				logger.info('layout refresh: add device %d (%s)' % (device_spec.iid, device_spec.name))
+				self.areas[device_spec.area.iid].add_control(device_spec)
+				self.cache.watch_device(device_spec.iid, device_spec.get_button_component_ids(), device_spec.get_led_component_ids(), device_spec.area.iid)
 		
 	# public interface to StargateHouse
 	def get_device_by_gateway_id(self, gateway_devid):
@@ -380,15 +559,62 @@ class RaGateway(sg_house.StargateGateway):
 		iid = int(gateway_devid)
 		return self.devices[iid]
 
+	def get_connection_state(self):
+		return self.repeater.get_connection_state()
+
+	def get_sync_progress(self):
+		return self.repeater.get_sync_progress()
+
+	def set_devices_to_state(self, devices, state):
+		# bulk interface from StargateHouse: outputs whose state is just a level go through
+		# set_output_levels together; anything else the usual way
+		levels = {}
+		for device in devices:
+			level = device.get_level_for_state(state) if isinstance(device, OutputDevice) else None
+			if level is None:
+				device.go_to_state(state)
+			else:
+				levels[device.iid] = level
+		self.set_output_levels(levels)
+
+	def set_output_levels(self, levels):
+		# levels: map from output iid to level. Sends the fewest commands that get there: one
+		# #AREA command for each area whose outputs are all being set to the same level, and an
+		# #OUTPUT for everything else. The area command is only used for areas containing nothing
+		# but lights, since its effect on shades and contact closures isn't something we want to
+		# depend on. Returns PendingLevel handles for all the outputs.
+		remaining = dict(levels)
+		handles = []
+		for ra_area in self.areas.values():
+			outputs = [d for d in ra_area.members if isinstance(d, OutputDevice)]
+			if len(outputs) < 2 or not all([isinstance(d, SwitchedOutput) for d in outputs]):
+				continue
+			targets = set([remaining.get(d.iid) for d in outputs])
+			if len(targets) != 1 or None in targets:
+				continue
+			level = targets.pop()
+			logger.debug('set_output_levels: area %d (%s) all to %g' % (ra_area.iid, ra_area.name, level))
+			handles.extend(self.repeater.set_area_level(ra_area.iid, level, [d.iid for d in outputs]))
+			for d in outputs:
+				del remaining[d.iid]
+		for (iid, level) in remaining.items():
+			handles.append(self.repeater.set_output_level(iid, level))
+		return handles
+
 	# repeater action callback
 	def on_user_action(self, iid, state, refresh, comp_id):
 		logger.debug('repeater action iid %d cid %d' % (iid, comp_id))
-		device = self.devices[iid]
+		device = self.devices.get(iid)
+		if device is None:
+			return # removed by a layout refresh while a reply was in flight
 		device.on_user_action(state, refresh, comp_id)
 	
 	# private interface for owned objects to populate node tree
 	def _register_device(self, device):
 		self.devices[device.iid] = device
+
+	def _unregister_device(self, device):
+		del self.devices[device.iid]
 		
 	def _register_area(self, ra_area):
 		self.areas[ra_area.iid] = ra_area
@@ -402,6 +628,9 @@ class RaGateway(sg_house.StargateGateway):
 	
 	def _set_output_level(self, iid, level):
 		return self.repeater.set_output_level(iid, level)
+
+	def _get_pending_output(self, iid):
+		return self.repeater.get_pending_output(iid)
 	
 	def _pulse_output(self, iid):
 		return self.repeater.pulse_output(iid)
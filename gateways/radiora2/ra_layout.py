@@ -16,9 +16,13 @@
 # the way Lutron's XML file does. Then RaHouse can reinterpret and model
 # things differently if it so chooses.
 
+import cPickle
+import cStringIO
+import hashlib
 import httplib
 import logging
-import xml.dom.minidom
+import os
+import xml.etree.cElementTree as ElementTree
 
 
 logger = logging.getLogger(__name__)
@@ -48,9 +52,9 @@ class Area(LayoutBase):
 		self.devices = list()
 
 	@staticmethod
-	def from_xml(area_element):
-		area_name = area_element.attributes['Name'].value
-		area_iid = int(area_element.attributes['IntegrationID'].value)
+	def from_element(area_element):
+		area_name = area_element.get('Name')
+		area_iid = int(area_element.get('IntegrationID'))
 		return Area(area_iid, area_name)
 
 	def add_output(self, output):
@@ -76,10 +80,10 @@ class Output(LayoutBase):
 		area.add_output(self)
 	
 	@staticmethod
-	def from_xml(output_element, area):
-		output_name = output_element.attributes['Name'].value
-		output_iid = int(output_element.attributes['IntegrationID'].value)
-		output_type = output_element.attributes['OutputType'].value
+	def from_element(output_element, area):
+		output_name = output_element.get('Name')
+		output_iid = int(output_element.get('IntegrationID'))
+		output_type = output_element.get('OutputType')
 		return Output(output_iid, output_name, output_type, area)
 
 	def get_type(self):
@@ -99,7 +103,7 @@ class Device(LayoutBase):
 		self.leds = list()
 
 	@staticmethod
-	def from_xml(device_element, area):
+	def from_element(device_element, area):
 		def get_fixed_button_name(devtype, comp):
 			map = None
 			if devtype == 'PICO_KEYPAD': # up to 5 buttons, no engraving, relatively fixed function
@@ -115,26 +119,24 @@ class Device(LayoutBase):
 				return '[%s]' % map[comp]
 			return None
 
-		device_name = device_element.attributes['Name'].value
-		device_iid = int(device_element.attributes['IntegrationID'].value)
-		device_type = device_element.attributes['DeviceType'].value
+		device_name = device_element.get('Name')
+		device_iid = int(device_element.get('IntegrationID'))
+		device_type = device_element.get('DeviceType')
 		device = Device(device_iid, device_name, device_type, area)
-		for component_element in device_element.getElementsByTagName('Component'):
-			comp_number = int(component_element.attributes['ComponentNumber'].value)
-			comp_type = component_element.attributes['ComponentType'].value
+		for component_element in device_element.iter('Component'):
+			comp_number = int(component_element.get('ComponentNumber'))
+			comp_type = component_element.get('ComponentType')
 			if comp_type == 'BUTTON':
-				button_element = component_element.getElementsByTagName('Button')[0]
-				try:
-					label = button_element.attributes['Engraving'].value
-				except KeyError:
+				button_element = next(component_element.iter('Button'))
+				label = button_element.get('Engraving')
+				if label is None:
 					label = get_fixed_button_name(device_type, comp_number)
 					if not label:
-						label = button_element.attributes['Name'].value
+						label = button_element.get('Name')
 				device.buttons[comp_number] = label
 			elif comp_type == 'LED':
 				device.leds.append(comp_number)
 			elif comp_type == 'CCI':
-				cci_element = component_element.getElementsByTagName('CCI')[0]
 				label = get_fixed_button_name(device_type, comp_number)
 				device.buttons[comp_number] = label
 		return device
@@ -154,65 +156,152 @@ class Device(LayoutBase):
 
 
 class RaLayout(object):
+	# Version of the compiled layout format written by _save_compiled; bump this whenever
+	# the tuples it stores change shape, so stale compiled files are ignored and rebuilt.
+	compiled_version = 1
+
 	def __init__(self, ignore_devices = None):
-		self.db_dom = None
-		self.db_xml = None
+		self.db_stream = None # file-like object to read DbXmlInfo from, until map_db() consumes it
+		self.db_hash = None # sha1 hex digest of the DbXmlInfo contents
 		self.areas = {} # map from iid (int) to object (Area)
 		self.outputs = {} # map from iid (int) to object (Output)
 		self.devices = {} # map from iid (int) to object (Device)
 		self.ignore_devices = ignore_devices
 	
 	def read_cached_db(self, cacheFileName):
-		logger.info('Read DbXmlInfo from local file')
+		logger.info('Read DbXmlInfo from local file %s' % cacheFileName)
 		# XXX would be nice if we could just do a HEAD request, but the
 		# repeater's HTTP server doesn't respond to that. TBD how we
 		# figure out when to cache, and when to get the file from the
 		# repeater.
-		cache = open('DbXmlInfo.xml')
-		self._setDbXml(cache.read())
-
-	def _setDbXml(self, xmlData):
-		self.db_xml = xmlData
-		logger.info('Parse DbXmlInfo')
-		self.db_dom = xml.dom.minidom.parseString(self.db_xml)
-		logger.info('Done parsing DbXmlInfo')
+		digest = hashlib.sha1()
+		with open(cacheFileName, 'rb') as cache:
+			for chunk in iter(lambda: cache.read(65536), ''):
+				digest.update(chunk)
+		self.db_hash = digest.hexdigest()
+		self.db_stream = open(cacheFileName, 'rb')
 
 	def get_live_db(self, hostname):
 		logger.info('Read DbXmlInfo from repeater')
 		conn = httplib.HTTPConnection(hostname, 80)
 		conn.request('GET', '/DbXmlInfo.xml')
-		response = conn.getresponse()
-		self._setDbXml(response.read())
-
-	def map_db(self):
-		logger.info('Build map from DbXmlInfo')
-		for area_element in self.db_dom.getElementsByTagName('Area'):
-			area = Area.from_xml(area_element)
-			if area.name == 'Root Area':
-				# I'm not sure what if anything I want to do with the root area --
-				# naive use of the DOM means it "contains" all the device groups and
-				# outputs, which is kinda true, but losing the info about how they
-				# group into areas/rooms. So for now at least, I'll skip this,
-				# iterate the leaf areas, and then rebuild an "all" zone.
-				#
-				# Note for RadioRa, there's only one level of hierarchy, with a bunch
-				# of leaf areas inside the root area. For Homeworks, this probably
-				# isn't true (judging from the Lutron sample scenes in their app),
-				# so likely the data format actually is a general tree where containment
-				# means something, and I should try to model that -- by noting which
-				# areas contain areas, but not by flattening areas->outputs entirely
-				# the way the DOM getElementsByTagName does.
+		# need the whole thing to hash it before deciding whether to parse it
+		db_xml = conn.getresponse().read()
+		self.db_hash = hashlib.sha1(db_xml).hexdigest()
+		self.db_stream = cStringIO.StringIO(db_xml)
+
+	def map_db(self, compiled_file = None):
+		# If compiled_file holds a compiled layout for this exact DbXmlInfo, load that and
+		# skip parsing entirely; otherwise parse, and (re)write compiled_file for next time.
+		if compiled_file and self._load_compiled(compiled_file):
+			self.db_stream.close()
+			self.db_stream = None
+		else:
+			self._parse_db()
+			if compiled_file:
+				self._save_compiled(compiled_file)
+		self._apply_ignores()
+
+	def _parse_db(self):
+		# Build the map in one streaming pass over the XML, creating each Output and Device
+		# when its element ends and then discarding the element, so we never hold the whole
+		# document in memory.
+		#
+		# Areas contain outputs and devices (inside device groups), and for Homeworks may also
+		# contain other areas. Each output and device belongs to the innermost area containing
+		# it. I'm not sure what if anything I want to do with the root area, which contains
+		# all the others, so it's not in the map, and neither is anything directly inside it.
+		logger.info('Parse and map DbXmlInfo')
+		elements = [] # stack of open elements
+		area_stack = [] # stack of open Areas
+		building = 0 # number of open Output/Device elements, whose children we need until they end
+		for (event, element) in ElementTree.iterparse(self.db_stream, events = ('start', 'end')):
+			tag = element.tag
+			if event == 'start':
+				elements.append(element)
+				if tag == 'Area':
+					area = Area.from_element(element)
+					area_stack.append(area)
+					if area.name != 'Root Area':
+						self._add_area(area)
+				elif tag == 'Output' or tag == 'Device':
+					building += 1
 				continue
-			self._add_area(area)
 
-			for output_element in area_element.getElementsByTagName('Output'):
-				self._add_output(Output.from_xml(output_element, area))
-
-			for device_element in area_element.getElementsByTagName('Device'):
-				self._add_device(Device.from_xml(device_element, area))
-				
+			elements.pop()
+			area = area_stack[-1] if area_stack else None
+			if tag == 'Output':
+				building -= 1
+				if area and area.name != 'Root Area':
+					self._add_output(Output.from_element(element, area))
+			elif tag == 'Device':
+				building -= 1
+				if area and area.name != 'Root Area':
+					self._add_device(Device.from_element(element, area))
+			elif tag == 'Area':
+				area_stack.pop()
+			# done with this element (unless it's part of an output/device still being read)
+			if not building and elements:
+				elements[-1].remove(element)
+		self.db_stream.close()
+		self.db_stream = None
 		logger.info('Done building DbXmlInfo map')
 
+	def _load_compiled(self, compiled_file):
+		# The compiled layout is a pickle of plain tuples (no classes, so it doesn't depend
+		# on this module's internals), tagged with the format version and the hash of the
+		# DbXmlInfo it was built from.
+		try:
+			with open(compiled_file, 'rb') as f:
+				compiled = cPickle.load(f)
+		except IOError:
+			logger.info('No compiled layout in %s' % compiled_file)
+			return False
+		except Exception as ex:
+			logger.warning('Unreadable compiled layout in %s: %s' % (compiled_file, ex))
+			return False
+		if compiled.get('version') != self.compiled_version or compiled.get('hash') != self.db_hash:
+			logger.info('Compiled layout in %s is out of date' % compiled_file)
+			return False
+
+		logger.info('Load compiled layout from %s' % compiled_file)
+		for (iid, name) in compiled['areas']:
+			self._add_area(Area(iid, name))
+		for (iid, name, outputType, area_iid) in compiled['outputs']:
+			self._add_output(Output(iid, name, outputType, self.areas[area_iid]))
+		for (iid, name, deviceType, area_iid, buttons, leds) in compiled['devices']:
+			device = Device(iid, name, deviceType, self.areas[area_iid])
+			device.buttons = buttons
+			device.leds = leds
+			self._add_device(device)
+		logger.info('Done loading compiled layout')
+		return True
+
+	def _save_compiled(self, compiled_file):
+		compiled = {
+			'version': self.compiled_version,
+			'hash': self.db_hash,
+			'areas': [(a.iid, a.name) for a in self.areas.values()],
+			'outputs': [(o.iid, o.name, o.outputType, o.area.iid) for o in self.outputs.values()],
+			'devices': [(d.iid, d.name, d.deviceType, d.area.iid, dict(d.buttons), list(d.leds)) for d in self.devices.values()],
+		}
+		# write to a temp file and rename, so a crash never leaves a truncated compiled layout
+		temp_file = compiled_file + '.tmp'
+		try:
+			with open(temp_file, 'wb') as f:
+				cPickle.dump(compiled, f, cPickle.HIGHEST_PROTOCOL)
+			os.rename(temp_file, compiled_file)
+			logger.info('Saved compiled layout to %s' % compiled_file)
+		except (IOError, OSError) as ex:
+			logger.warning('Could not save compiled layout to %s: %s' % (compiled_file, ex))
+
+	def _apply_ignores(self):
+		# Done after loading/saving the compiled layout, so it always holds the full layout
+		# and changes to the ignore list don't require rebuilding it.
+		for iid in self.ignore_devices or []:
+			if self.devices.has_key(iid):
+				self.devices[iid].ignore()
+
 	def _add_area(self, area):
 		self.areas[area.iid] = area
 
@@ -220,8 +309,6 @@ class RaLayout(object):
 		self.outputs[output.iid] = output
 
 	def _add_device(self, device):
-		if device.iid in self.ignore_devices:
-			device.ignore()
 		self.devices[device.iid] = device
 
 	def get_output_ids(self):
@@ -0,0 +1,186 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Control of Lutron RadioRa2 system.
+#
+# This module handles providing additional telnet connections to the repeater's integration
+# interface, by chaining through the one we control (since the repeater allows one session
+# per login, and a new session for the same login evicts the old one).
+#
+# Each chained client logs in the way it would to the repeater itself, and gets its own
+# monitoring subscriptions (#MONITORING is answered here, not passed on; our own connection
+# stays subscribed to everything). Other commands and queries are passed on to the repeater;
+# replies to a query go to the client(s) that asked, and monitoring reports go to every client
+# subscribed to their type. Each client's output is buffered and written by its own thread,
+# so a slow client can't stall RaRepeater's listener.
+#
+# BUGS:
+# - ~ERROR replies can't be attributed to whoever caused them, so they're not passed on
+
+import logging
+import socket
+import threading
+
+import connections
+
+
+logger = logging.getLogger(__name__)
+logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
+
+
+# Integration protocol monitoring types, for the replies we know how to classify
+MONITOR_BUTTON = 3
+MONITOR_LED = 4
+MONITOR_ZONE = 5
+MONITOR_OCCUPANCY = 6
+MONITOR_ALL = 255
+
+
+class ReflectorThread(threading.Thread):
+	def __init__(self, parent, socket, client_address):
+		super(ReflectorThread, self).__init__(name = 'ra_reflector')
+		self.daemon = True
+		self.parent = parent
+		self.reflector = parent.reflector
+		self.connected_socket = socket
+		self.client_address = client_address
+		self.authenticated = False
+		self.monitoring = set() # monitoring types this client subscribed to
+		self.writer = connections.BufferedClientWriter(socket, 'ra_reflector')
+
+	def run(self):
+		# Login uses simple blocking calls, like RaRepeater.connect does on the other side.
+		s = self.connected_socket
+		buffer = connections.CrlfSocketBuffer(s)
+		try:
+			s.send('login: ')
+			username = self._read_line(buffer)
+			s.send('password: ')
+			password = self._read_line(buffer)
+			if username != self.reflector.username or password != self.reflector.password:
+				logger.warning('RA reflector: child connection failed authentication')
+				s.send('bad login\r\nlogin: \x00')
+				raise Exception('bad login')
+			s.send('\r\nGNET> \x00')
+			logger.info('RA reflector: child connection authenticated')
+
+			# from here on everything we send goes through the writer
+			self.writer.start()
+			self.authenticated = True
+			while True:
+				for line in buffer.read_lines():
+					if line:
+						self.handle_command(line.strip())
+		except:
+			logger.info('RA reflector: child %s went away' % str(self.client_address))
+
+		self.writer.close()
+		self.parent.child_exit(self)
+
+	def _read_line(self, buffer):
+		while True:
+			lines = buffer.read_lines()
+			if lines:
+				return lines[0].strip()
+
+	def handle_command(self, line):
+		fields = line.split(',')
+		if fields[0] == '#MONITORING' and len(fields) >= 3:
+			# subscriptions are per client, so handle these here instead of changing ours
+			monitor_type = int(fields[1])
+			if fields[2] == '1':
+				self.monitoring.add(monitor_type)
+			else:
+				self.monitoring.discard(monitor_type)
+			self.send('~MONITORING,%s,%s\r\n' % (fields[1], fields[2]))
+		elif fields[0][:1] == '?' and len(fields) >= 2:
+			self.reflector.query_from_child(self, line, ('~' + fields[0][1:], fields[1]))
+		elif fields[0][:1] == '#':
+			self.reflector.command_from_child(line)
+		else:
+			logger.warning('RA reflector: ignoring child command %s' % repr(line))
+		self.send('GNET> ')
+
+	def is_monitoring(self, monitor_type):
+		return MONITOR_ALL in self.monitoring or monitor_type in self.monitoring
+
+	def send(self, data):
+		self.writer.write(data)
+
+
+class ReflectorParentThread(threading.Thread):
+	def __init__(self, reflector):
+		super(ReflectorParentThread, self).__init__(name = 'ra_reflector_listen')
+		self.daemon = True
+		self.reflector = reflector
+		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listen_socket.bind(('', self.reflector.port))
+		self.listen_socket.listen(5)
+		self.children = []
+		self.lock = threading.Lock()
+
+	def run(self):
+		# Listen for connections, and handle them in new threads
+		while True:
+			connected_socket, client_address = self.listen_socket.accept()
+			logger.info('reflector accepted chained connection from %s' % str(client_address))
+			child = ReflectorThread(self, connected_socket, client_address)
+			with self.lock:
+				self.children.append(child)
+			child.start()
+
+	def get_children(self):
+		with self.lock:
+			return [child for child in self.children if child.authenticated]
+
+	def child_exit(self, child):
+		logger.info('reflector lost chained connection to %s' % str(child.client_address))
+		with self.lock:
+			self.children.remove(child)
+
+
+class Reflector(object):
+	def __init__(self, repeater, port, username, password):
+		self.repeater = repeater
+		self.port = port
+		self.username = username
+		self.password = password
+		self.pending_queries = {} # map from expected reply (prefix, iid) to set of children waiting for it
+		self.lock = threading.Lock()
+		self.reflect_thread = ReflectorParentThread(self)
+		self.reflect_thread.start()
+
+	def to_children(self, line):
+		# Called from the repeater's listener thread for every reply (prompt already stripped), so
+		# it must not block; the children's writers take care of that.
+		fields = line.split(',', 3)
+		if fields[0] == '~MONITORING':
+			return # answer to our own subscription; children get answers to theirs from us
+		key = (fields[0], fields[1] if len(fields) > 1 else '')
+		with self.lock:
+			waiting = self.pending_queries.pop(key, ())
+		monitor_type = self._get_monitor_type(fields)
+		for child in self.reflect_thread.get_children():
+			if child in waiting or (monitor_type and child.is_monitoring(monitor_type)):
+				child.send(line + '\r\n')
+
+	def query_from_child(self, child, line, reply_key):
+		with self.lock:
+			self.pending_queries.setdefault(reply_key, set()).add(child)
+		self.repeater.send_repeater_command(line, connections.Priority.AUTOMATION)
+
+	def command_from_child(self, line):
+		self.repeater.send_repeater_command(line, connections.Priority.AUTOMATION)
+
+	@staticmethod
+	def _get_monitor_type(fields):
+		# Replies we can't classify only go to clients monitoring everything (or waiting for them).
+		if fields[0] == '~OUTPUT':
+			return MONITOR_ZONE
+		if fields[0] == '~DEVICE' and len(fields) > 3:
+			return MONITOR_LED if fields[3].split(',')[0] == '9' else MONITOR_BUTTON
+		if fields[0] == '~GROUP':
+			return MONITOR_OCCUPANCY
+		if fields[0] in ('~HVAC', '~TIMECLOCK'):
+			return MONITOR_ALL
+		return None
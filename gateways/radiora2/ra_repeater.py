@@ -8,10 +8,11 @@
 # interface for querying and changing the state of outputs
 # and devices.
 
+import collections
+import collections
 import logging
-import Queue
-import re
 import socket
+import threading
 import time
 
 import connections
@@ -21,92 +22,317 @@ logger = logging.getLogger(__name__)
 logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
 
 
+class PendingLevel(object):
+	# Handle for an output level we've asked the repeater to set. It resolves when the repeater
+	# reports the output at that level (confirmed), or when a later command for the same output
+	# replaces it (not confirmed); it expires, unconfirmed, after timeout seconds.
+	tolerance = 1 # shades in particular report close to, but not exactly, what we asked for
+
+	def __init__(self, iid, level, timeout):
+		self.iid = iid
+		self.level = level
+		self.expires = time.time() + timeout
+		self.confirmed = False
+		self.done = threading.Event()
+
+	def wait(self, timeout = None):
+		# returns whether the repeater confirmed the level; by default waits until expiry
+		if timeout is None:
+			timeout = self.expires - time.time()
+		if timeout > 0:
+			self.done.wait(timeout)
+		return self.confirmed
+
+	def is_pending(self):
+		return not self.done.is_set() and time.time() < self.expires
+
+	def _matches(self, level):
+		return abs(level - self.level) <= self.tolerance
+
+	def _resolve(self, confirmed):
+		self.confirmed = confirmed
+		self.done.set()
+
+
 class OutputCache(object):
 	# Low-level cache of last seen level for each device (output, button, led)
 
 	# client public interface
-	def __init__(self):
+	def __init__(self, query_timeout = 5):
 		self.repeater = None
+		self.query_timeout = query_timeout # default seconds a getter waits for the repeater to answer
 		self.output_levels = {} # map from output iid to level
 		self.button_states = {} # map from device iid to map from button component id to state
 		self.led_states = {} # map from device iid to map from led component id to state
 		self.refresh_count = dict() # map of iids for which we have a refresh in progress, to number of refreshes
 		self.subscribers = [] # list of objects on which we will call on_user_action()
-
-	def watch_output(self, output_iid):
-		self.output_levels[output_iid] = 'stale'
+		self.resync_levels = {} # map from output iid being resynced to its level before the resync
+		self.syncing_outputs = set() # output iids we're still waiting to hear from before the repeater is live
+		self.queries_sent = {} # map from ('output', iid) or ('led', iid, cid) to when we asked the repeater, until it answers
+		self.updated = threading.Condition() # notified when a reply updates an output level or LED state
+		self.output_areas = {} # map from output iid to area iid, for ordering refreshes
+		self.device_areas = {} # map from device iid to area iid, for ordering refreshes
+		self.area_order = {} # map from area iid to its position in the layout
+		self.planner = None # RefreshPlanner, once bound to a repeater
+		self.pending_levels = {} # map from output iid to PendingLevel for the last level we set
+
+	# The watch tables can change after startup (layout refresh) while the listener and getters
+	# are using them, so changes are made holding updated.
+	def watch_output(self, output_iid, area_iid = None):
+		with self.updated:
+			self.output_levels[output_iid] = 'stale'
+			self._note_area(self.output_areas, output_iid, area_iid)
+			if self.repeater: # added after startup (layout refresh); go find out its level
+				self._refresh_output(output_iid)
 	
-	def watch_device(self, device_iid, button_cids, led_cids):
-		button = self.button_states[device_iid] = dict()
-		for cid in button_cids:
-			button[cid] = 'stale'
-		led = self.led_states[device_iid] = dict()
-		for cid in led_cids:
-			led[cid] = 'stale'
+	def unwatch_output(self, output_iid):
+		with self.updated:
+			self.output_levels.pop(output_iid, None)
+			self.resync_levels.pop(output_iid, None)
+			self.refresh_count.pop(output_iid, None)
+			self.updated.notify_all() # getters waiting on it give up
+			sync_complete = self._sync_heard_from(output_iid)
+		if sync_complete:
+			self.repeater._on_sync_complete()
+
+	def watch_device(self, device_iid, button_cids, led_cids, area_iid = None):
+		# Can be called again for an already-watched device whose components changed (layout
+		# refresh); state already known for components it still has is kept.
+		with self.updated:
+			self._note_area(self.device_areas, device_iid, area_iid)
+			old_buttons = self.button_states.get(device_iid, {})
+			self.button_states[device_iid] = dict([(cid, old_buttons.get(cid, 'stale')) for cid in button_cids])
+			old_leds = self.led_states.get(device_iid, {})
+			led = self.led_states[device_iid] = dict([(cid, old_leds.get(cid, 'stale')) for cid in led_cids])
+			self.updated.notify_all()
+			if self.repeater:
+				for cid in led_cids:
+					if led[cid] == 'stale':
+						self._refresh_led(device_iid, cid)
+
+	def unwatch_device(self, device_iid):
+		with self.updated:
+			self.button_states.pop(device_iid, None)
+			self.led_states.pop(device_iid, None)
+			self.refresh_count.pop(device_iid, None)
+			self.updated.notify_all()
 
 	def subscribe_to_actions(self, subscriber):
 		assert hasattr(subscriber, 'on_user_action')
 		self.subscribers.append(subscriber)
 
-	def get_output_level(self, output_iid):
-		level = self.output_levels[output_iid]
-		while level == 'stale':
-			self._refresh_output(output_iid)
-			time.sleep(0.1)
-			level = self.output_levels[output_iid]
-		return level
+	def get_refresh_progress(self):
+		# (done, total) queries in the current refresh sweep; done == total when it's finished
+		if self.planner is None:
+			return (0, 0)
+		return self.planner.get_progress()
+
+	# The getters return the cached value, or if it's stale, ask the repeater and wait up to timeout
+	# seconds (default query_timeout) for the answer. If there's no answer in time, or the repeater
+	# isn't connected so there's no point asking, or the device is gone (layout refresh), they
+	# return None, meaning unknown.
+	def get_output_level(self, output_iid, timeout = None):
+		return self._wait_for_value(('output', output_iid), timeout)
+
+	# Levels we've set but the repeater hasn't confirmed yet. Readers can show the target right
+	# away; the cached level only changes when the repeater reports it.
+	def set_pending_level(self, output_iid, level):
+		handle = PendingLevel(output_iid, level, self.query_timeout)
+		with self.updated:
+			old = self.pending_levels.get(output_iid)
+			if old:
+				old._resolve(False)
+			self.pending_levels[output_iid] = handle
+		return handle
+
+	def get_pending(self, output_iid):
+		# the PendingLevel for output_iid, or None if there's nothing still pending
+		handle = self.pending_levels.get(output_iid)
+		if handle and handle.is_pending():
+			return handle
+		return None
+
+	def get_pending_level(self, output_iid):
+		handle = self.get_pending(output_iid)
+		return handle.level if handle else None
 
 	def get_button_state(self, device_iid, button_cid):
-		state = self.button_states[device_iid][button_cid]
-		while state == 'stale':
+		state = self.button_states.get(device_iid, {}).get(button_cid)
+		if state == 'stale':
+			# can't actually ask; this just assumes unpressed (see _refresh_button)
 			self._refresh_button(device_iid, button_cid)
-			time.sleep(0.1)
-			state = self.button_states[device_iid][button_cid]
+			state = self.button_states.get(device_iid, {}).get(button_cid)
 		return state
 
-	def get_led_state(self, device_iid, led_cid):
-		state = self.led_states[device_iid][led_cid]
-		while state == 'stale':
-			self._refresh_led(device_iid, led_cid)
-			time.sleep(0.1)
-			state = self.led_states[device_iid][led_cid]
-		return state
+	def get_led_state(self, device_iid, led_cid, timeout = None):
+		return self._wait_for_value(('led', device_iid, led_cid), timeout)
+
+	def _wait_for_value(self, query_key, timeout):
+		value = self._get_cached(query_key)
+		if value != 'stale':
+			return value
+		if self.repeater is None or not self.repeater.is_online():
+			return None
+		if timeout is None:
+			timeout = self.query_timeout
+		deadline = time.time() + timeout
+		with self.updated:
+			while True:
+				value = self._get_cached(query_key)
+				if value != 'stale':
+					return value
+				now = time.time()
+				if now >= deadline:
+					logger.warning('no answer from repeater for %s after %g seconds' % (str(query_key), timeout))
+					return None
+				# Concurrent readers (and the background resync) share one query; we only ask
+				# again if the outstanding one has gone unanswered so long it must be lost.
+				# A key the refresh sweep hasn't got to yet jumps the line: we take it out of
+				# the plan and ask for it ourselves, at this thread's priority.
+				sent = self.queries_sent.get(query_key)
+				if sent is None or now - sent > self.query_timeout:
+					if self.planner:
+						self.planner.promote(query_key)
+					self._send_query(query_key, None)
+				self.updated.wait(deadline - now)
 
 	# RaRepeater private interface
 	def _record_output_level(self, output_iid, level):
 		# should be called only by RaRepeater.receive_repeater_reply()
-		logger.info('record_output_level: output %d level %d' % (output_iid, level))
-		self.output_levels[output_iid] = level
-		self._broadcast_change(output_iid, level)
+		logger.info('record_output_level: output %d level %d', output_iid, level)
+		with self.updated:
+			if not self.output_levels.has_key(output_iid):
+				return # not (or no longer) in the layout
+			self.output_levels[output_iid] = level
+			self.queries_sent.pop(('output', output_iid), None)
+			pending = self.pending_levels.get(output_iid)
+			if pending and pending._matches(level):
+				del self.pending_levels[output_iid]
+				pending._resolve(True)
+			self.updated.notify_all()
+			# if the level changed while we were disconnected, our resync query finds out about a
+			# real change, and it should be reported as one
+			old_level = self.resync_levels.pop(output_iid, level)
+			refresh = self._take_refresh(output_iid, changed_offline = (old_level != level))
+			sync_complete = self._sync_heard_from(output_iid)
+		self._broadcast_change(output_iid, level, refresh)
+		if sync_complete:
+			self.repeater._on_sync_complete()
 
 	def _record_button_state(self, device_iid, button_cid, state):
 		# should be called only by RaRepeater.receive_repeater_reply()
-		logger.info('record_button_state: device %d button %d state %d' % (device_iid, button_cid, state))
-		self.button_states[device_iid][button_cid] = state
-		self._broadcast_change(device_iid, state, button_cid)
+		logger.info('record_button_state: device %d button %d state %d', device_iid, button_cid, state)
+		with self.updated:
+			if not self.button_states.has_key(device_iid):
+				return # not (or no longer) in the layout
+			self.button_states[device_iid][button_cid] = state
+			refresh = self._take_refresh(device_iid)
+		self._broadcast_change(device_iid, state, refresh, button_cid)
 
 	def _record_led_state(self, device_iid, led_cid, state):
 		# should be called only by RaRepeater.receive_repeater_reply()
-		logger.info('record_led_state: device %d led %d state %d' % (device_iid, led_cid, state))
-		self.led_states[device_iid][led_cid] = state
+		logger.info('record_led_state: device %d led %d state %d', device_iid, led_cid, state)
+		with self.updated:
+			if not self.led_states.has_key(device_iid):
+				return # not (or no longer) in the layout
+			self.led_states[device_iid][led_cid] = state
+			self.queries_sent.pop(('led', device_iid, led_cid), None)
+			self.updated.notify_all()
 		# XXX for now at least, we don't send state change notifications for LEDs
 
 	def _bind_repeater(self, repeater):
 		self.repeater = repeater
 		# now that we have a repeater, do an async/background refresh of all cacheable state
-		for iid in self.output_levels.keys():
-			self._refresh_output(iid)
-		for iid in self.button_states.keys():
-			for bid in self.button_states[iid].keys():
-				self._refresh_button(iid, bid)
-		for iid in self.led_states.keys():
-			for lid in self.led_states[iid].keys():
-				self._refresh_led(iid, lid)
+		self.planner = RefreshPlanner(self)
+		self.planner.start()
+		self._resync()
+
+	def _resync(self):
+		# Called when the repeater (re)connects. Anything we could have missed while not connected
+		# is marked stale and queried again: every output and LED, and any button we think is
+		# pressed (we may have missed its release; unpressed buttons can't have changed without
+		# us hearing the press when we reconnect). We remember the old output levels so a level
+		# that changed in the meantime gets reported as a change, not a refresh.
+		with self.updated:
+			# Queries still queued when the connection went down went with the old send queue,
+			# so their answers aren't coming: forget them, or their refresh marks would swallow
+			# the next real change, and getters wouldn't ask again until they timed out.
+			self.refresh_count.clear()
+			self.queries_sent.clear()
+			for iid in self.output_levels.keys():
+				level = self.output_levels[iid]
+				if level != 'stale':
+					self.resync_levels[iid] = level
+				self.output_levels[iid] = 'stale'
+			self.syncing_outputs = set(self.output_levels.keys())
+			pressed = []
+			for iid in self.button_states.keys():
+				for bid in self.button_states[iid].keys():
+					if self.button_states[iid][bid] != 0:
+						pressed.append((iid, bid))
+			for iid in self.led_states.keys():
+				for lid in self.led_states[iid].keys():
+					self.led_states[iid][lid] = 'stale'
+			# the planner sends the actual queries, paced and in a sensible order
+			keys = [('output', iid) for iid in self.output_levels.keys()]
+			for iid in self.led_states.keys():
+				keys.extend([('led', iid, lid) for lid in self.led_states[iid].keys()])
+			self.planner.set_plan(sorted(keys, key = self._refresh_order))
+			sync_complete = not self.syncing_outputs
+		# (outside the lock: these broadcast to subscribers)
+		for (iid, bid) in pressed:
+			self._refresh_button(iid, bid)
+		if sync_complete:
+			self.repeater._on_sync_complete()
+
+	def _note_area(self, areas, iid, area_iid):
+		if area_iid is None:
+			return
+		areas[iid] = area_iid
+		if not self.area_order.has_key(area_iid):
+			self.area_order[area_iid] = len(self.area_order)
+
+	def _refresh_order(self, key):
+		# outputs before LEDs (outputs are what people mostly look at), then area by area in
+		# layout order, so each room fills in together
+		if key[0] == 'output':
+			stage, area = 0, self.output_areas.get(key[1])
+		else:
+			stage, area = 1, self.device_areas.get(key[1])
+		return (stage, self.area_order.get(area, len(self.area_order)), key)
+
+	def _get_cached(self, key):
+		# key is ('output', iid) or ('led', iid, cid); None if it's not (or no longer) watched
+		if key[0] == 'output':
+			return self.output_levels.get(key[1])
+		return self.led_states.get(key[1], {}).get(key[2])
+
+	def _send_query(self, key, priority = connections.Priority.BACKGROUND):
+		if key[0] == 'output':
+			self._refresh_output(key[1], priority)
+		else:
+			self._refresh_led(key[1], key[2], priority)
+
+	def _abandon_query(self, key):
+		# the planner gave up on hearing back about key; don't hold up going live for it. Requires
+		# lock; returns whether that completes the sync (for the caller to report, without the lock).
+		self.queries_sent.pop(key, None)
+		return key[0] == 'output' and self._sync_heard_from(key[1])
+
+	def _sync_heard_from(self, output_iid):
+		# requires lock; returns whether output_iid was the last one the sync was waiting for
+		if output_iid not in self.syncing_outputs:
+			return False
+		self.syncing_outputs.discard(output_iid)
+		return not self.syncing_outputs
 
 	# internal private interface
-	def _refresh_output(self, iid):
+	# Queries default to background priority; a getter waiting on the answer passes None, to use
+	# its thread's priority instead (interactive, for the web server).
+	def _refresh_output(self, iid, priority = connections.Priority.BACKGROUND):
 		self._mark_refresh_pending(iid)
-		self.repeater.send_repeater_command('?OUTPUT,%d,1' % iid) # async
+		self.queries_sent[('output', iid)] = time.time()
+		self.repeater.send_repeater_command('?OUTPUT,%d,1' % iid, priority) # async
 
 	def _refresh_button(self, iid, bid):
 		self._mark_refresh_pending(iid)
@@ -119,50 +345,152 @@ class OutputCache(object):
 		# that all buttons are unpressed at startup.
 		self._record_button_state(iid, bid, 0)
 
-	def _refresh_led(self, iid, lid):
-		self._mark_refresh_pending(iid)
-		self.repeater.send_repeater_command('?DEVICE,%d,%d,9' % (iid, lid)) # async
+	def _refresh_led(self, iid, lid, priority = connections.Priority.BACKGROUND):
+		# (no _mark_refresh_pending: LED replies don't broadcast, so nothing would consume the
+		# mark, and the keypad's next button press would be taken for a refresh)
+		self.queries_sent[('led', iid, lid)] = time.time()
+		self.repeater.send_repeater_command('?DEVICE,%d,%d,9' % (iid, lid), priority) # async
 
 	def _mark_refresh_pending(self, iid):
 		# Record that we're asking the repeater for status, so when a status message
 		# arrives, it came from us and not a user action -- so don't broadcast an
 		# on_update message
 		logger.debug('mark_for_refresh: setting ignore flag for iid %d' % iid)
-		self.refresh_count[iid] = self.refresh_count.get(iid, 0) + 1;
+		with self.updated:
+			self.refresh_count[iid] = self.refresh_count.get(iid, 0) + 1;
 
-	def _broadcast_change(self, iid, state, comp_id = 0):
+	def _take_refresh(self, iid, changed_offline = False):
+		# requires lock; returns whether a status message for iid answers our refresh
 		if iid in self.refresh_count:
 			# if we had a refresh in progress, don't send an update, but decrement
-			# the count of refreshes in progress
-			refresh = True
+			# the count of refreshes in progress (unless the refresh found a change
+			# we missed while disconnected, which is an update after all)
+			refresh = not changed_offline
 			self.refresh_count[iid] = self.refresh_count[iid] - 1;
 			if self.refresh_count[iid] == 0:
 				del self.refresh_count[iid]
 				logger.debug('broadcast_change: removed ignore flag for iid %d' % iid)
 		else: # the normal case, where a refresh is not in progress
 			refresh = False
+		return refresh
+
+	def _broadcast_change(self, iid, state, refresh, comp_id = 0):
+		# called without the lock, so subscribers can call back into the cache
 		logger.debug('broadcast_change: sending on_user_action(iid=%d, refresh=%s)' % (iid, str(refresh)))
 		for subscriber in self.subscribers:
 			subscriber.on_user_action(iid, state, refresh, comp_id)
 
 
-class RaRepeater(object):
+class RefreshPlanner(threading.Thread):
+	# Paces OutputCache's refresh of everything after (re)connect, instead of queueing a query for
+	# every output and LED at once (over a thousand on a big system, all ahead of anything a user
+	# does). Works through the plan in the order given (see OutputCache._refresh_order), keeping
+	# at most `window` queries outstanding. A query that goes unanswered for query_timeout is
+	# retried at the end of the plan, up to max_attempts times. Anything a reader is waiting for
+	# is promoted: taken out of the plan, for the reader to ask for right away.
+	window = 4
+	max_attempts = 3
+
+	def __init__(self, cache):
+		super(RefreshPlanner, self).__init__(name = 'ra_refresh_planner')
+		self.daemon = True
+		self.cache = cache
+		self.lock = cache.updated # shared with the cache, so replies wake us up
+		self.plan = collections.deque() # keys still to query, in order
+		self.in_flight = {} # map from key to time we asked
+		self.attempts = {} # map from key to attempt number, for keys being retried
+		self.total = 0
+		self.done_logged = True
+
+	def set_plan(self, keys):
+		with self.lock:
+			self.plan = collections.deque(keys)
+			self.in_flight = {}
+			self.attempts = {}
+			self.total = len(keys)
+			self.done_logged = False
+			self.lock.notify_all()
+		logger.info('refresh planner: %d queries planned' % len(keys))
+
+	def promote(self, key):
+		with self.lock:
+			try:
+				self.plan.remove(key)
+			except ValueError:
+				pass
+
+	def get_progress(self):
+		with self.lock:
+			return (self.total - len(self.plan) - len(self.in_flight), self.total)
+
+	def run(self):
+		connections.set_thread_priority(connections.Priority.BACKGROUND)
+		while True:
+			with self.lock:
+				sync_complete = self._retire_answered()
+				self._send_more()
+				if not self.plan and not self.in_flight and not self.done_logged:
+					logger.info('refresh planner: all %d queries done' % self.total)
+					self.done_logged = True
+				# replies notify the lock; the timeout is for noticing lost queries
+				if not sync_complete:
+					self.lock.wait(1 if self.in_flight else None)
+			if sync_complete: # (reported without the lock, like the cache does)
+				self.cache.repeater._on_sync_complete()
+
+	def _is_stale(self, key):
+		# (not if it was unwatched by a layout refresh)
+		return self.cache._get_cached(key) == 'stale'
+
+	def _retire_answered(self):
+		# returns whether giving up on a query completed the cache's sync
+		sync_complete = False
+		now = time.time()
+		for (key, sent) in self.in_flight.items():
+			if not self._is_stale(key):
+				del self.in_flight[key]
+			elif now - sent > self.cache.query_timeout:
+				del self.in_flight[key]
+				attempt = self.attempts.get(key, 1)
+				if attempt < self.max_attempts:
+					logger.warning('refresh planner: no answer for %s, will retry' % str(key))
+					self.attempts[key] = attempt + 1
+					self.plan.append(key)
+				else:
+					logger.warning('refresh planner: no answer for %s, giving up' % str(key))
+					sync_complete = self.cache._abandon_query(key) or sync_complete
+		return sync_complete
+
+	def _send_more(self):
+		while self.plan and len(self.in_flight) < self.window:
+			key = self.plan.popleft()
+			if not self._is_stale(key):
+				continue # heard about it already (monitoring report, or someone asked)
+			self.cache._send_query(key)
+			self.in_flight[key] = time.time()
+
+
+class RaRepeater(connections.GatewayConnection):
 	def __init__(self, watchdog):
+		super(RaRepeater, self).__init__()
 		self.watchdog = watchdog
-		self.state = None
 		self.cache = None
+		self.reflector = None
 		self._prep_response_handlers()
 	
 	def bind_cache(self, cache):
 		self.cache = cache
 		self.cache._bind_repeater(self)
 	
-	def connect(self, hostname, username, password):
+	def connect(self, hostname, username, password, port = 23):
 		self.hostname = hostname
+		self.set_connection_state(connections.ConnectionState.CONNECTING)
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket.connect((hostname, 23))
+		self.socket.connect((hostname, port))
+		connections.enable_keepalive(self.socket)
 
 		# authenticate to repeater using simple blocking calls
+		self.set_connection_state(connections.ConnectionState.AUTHENTICATING)
 		buf = self.socket.recv(1024)
 		assert(buf == 'login: ')
 		self.socket.send(username + '\r\n')
@@ -175,24 +503,49 @@ class RaRepeater(object):
 
 		# then put socket in nonblocking mode and start reader/writer threads
 		self.socket.setblocking(0)
+		self.last_rx_time = self.last_tx_time = time.time()
 		self.listen_thread = connections.ListenerThread(self, 'ra')
 		self.listen_thread.start()
-		self.send_queue = Queue.Queue()
+		self.send_queue = connections.PrioritySendQueue()
 		self.send_thread = connections.SenderThread(self, 'ra')
 		self.send_thread.start()
 
 		# enable automatic reconnect
 		self.watchdog.add([self.listen_thread, self.send_thread], self.socket,
-			lambda: self.connect(hostname, username, password))
+			lambda: self.connect(hostname, username, password, port), self)
 
-		# finally kick off by requesting further updates
+		# finally kick off by requesting further updates, and if this is a reconnect, catch
+		# up on anything that happened while we were disconnected. (On first connect, the
+		# cache isn't bound yet; it will sync when it is.)
+		self.set_connection_state(connections.ConnectionState.SYNCING)
 		self.enable_monitoring()
+		if self.cache:
+			self.cache._resync()
+
+	def _on_sync_complete(self):
+		# called by OutputCache when it has heard back about every output
+		logger.info('repeater cache sync complete')
+		if self.connection_state == connections.ConnectionState.SYNCING:
+			self.set_connection_state(connections.ConnectionState.LIVE)
 		
-	def get_output_level(self, output_iid):
-		return self.cache.get_output_level(output_iid)
+	def get_output_level(self, output_iid, timeout = None):
+		return self.cache.get_output_level(output_iid, timeout)
 
 	def set_output_level(self, output_iid, level):
+		# returns a PendingLevel, which resolves when the repeater echoes the new level
+		handle = self.cache.set_pending_level(output_iid, level)
 		self.send_repeater_command('#OUTPUT,%d,1,%g' % (output_iid, level))
+		return handle
+
+	def set_area_level(self, area_iid, level, output_iids):
+		# One command for every output in the area; output_iids are the outputs we expect to
+		# hear back about. Returns their PendingLevels.
+		handles = [self.cache.set_pending_level(iid, level) for iid in output_iids]
+		self.send_repeater_command('#AREA,%d,1,%g' % (area_iid, level))
+		return handles
+
+	def get_pending_output(self, output_iid):
+		return self.cache.get_pending(output_iid)
 
 	def pulse_output(self, output_iid):
 		self.send_repeater_command('#OUTPUT,%d,6' % (output_iid))
@@ -204,74 +557,193 @@ class RaRepeater(object):
 		action = 3 if pressed else 4
 		self.send_repeater_command('#DEVICE,%d,%d,%d' % (device_iid, button_cid, action))
 
-	def get_led_state(self, device_iid, led_cid):
-		return self.cache.get_led_state(device_iid, led_cid)
+	def get_led_state(self, device_iid, led_cid, timeout = None):
+		return self.cache.get_led_state(device_iid, led_cid, timeout)
+
+	def get_sync_progress(self):
+		return self.cache.get_refresh_progress()
 
 	def set_led_state(self, device_iid, led_cid, on):
 		state = 1 if on else 0
 		self.send_repeater_command('#DEVICE,%d,%d,9,%d' % (device_iid, led_cid, state))
 
-	def _match_output_response(self, match):
-		output = int(match.group(1))
-		level = float(match.group(2))
-		logger.debug('match %s -> output %d set level %g' % (match.group(), output, level))
-		self.cache._record_output_level(output, level)
-
-	def _match_button_response(self, match):
-		device = int(match.group(1))
-		component = int(match.group(2))
-		action = int(match.group(3))
-		logger.debug('match %s -> device %d button %d action %d' % (match.group(), device, component, action))
-		state = True if action == 3 else False
-		self.cache._record_button_state(device, component, state)
-
-	def _match_led_response(self, match):
-		device = int(match.group(1))
-		component = int(match.group(2))
-		parameter = int(match.group(3))
-		logger.debug('match %s -> device %d led %d to %d' % (match.group(), device, component, parameter))
-		# XXX doesn't handle LED flashing state
-		state = True if parameter == 1 else False
-		self.cache._record_led_state(device, component, state)
-
-	def _match_monitoring_response(self, match):
+	# Reply handlers. Each gets the reply's comma-separated fields after the first (the '~XXX'
+	# part it was dispatched on), as strings.
+	def _handle_output_reply(self, fields):
+		iid = int(fields[0])
+		action = fields[1]
+		if action == '1': # level
+			level = float(fields[2])
+			logger.debug('reply -> output %d set level %g', iid, level)
+			self.cache._record_output_level(iid, level)
+		else: # raise/lower/stop/flash and such; the level report that follows is what we track
+			logger.debug('reply -> output %d action %s %s', iid, action, fields[2:])
+
+	def _handle_device_reply(self, fields):
+		iid = int(fields[0])
+		component = int(fields[1])
+		action = fields[2]
+		if action == '3' or action == '4': # press, release
+			logger.debug('reply -> device %d button %d action %s', iid, component, action)
+			self.cache._record_button_state(iid, component, action == '3')
+		elif action == '9': # LED state: 0 off, 1 on, 2 flashing, 3 flashing rapidly
+			state = int(fields[3])
+			logger.debug('reply -> device %d led %d to %d', iid, component, state)
+			self.cache._record_led_state(iid, component, state)
+		else: # hold, multi-tap, scene and such; we don't model these
+			logger.debug('reply -> device %d component %d action %s %s', iid, component, action, fields[3:])
+
+	def _handle_group_reply(self, fields):
+		# occupancy groups: 3 occupied, 4 unoccupied, 255 unknown; we get the individual
+		# sensors' reports as ~DEVICE, so there's nothing more to track here.
+		logger.debug('reply -> occupancy group %s state %s', fields[0], fields[2])
+
+	def _handle_hvac_reply(self, fields):
+		# we don't know about HVAC
+		logger.debug('reply -> hvac %s action %s %s', fields[0], fields[1], fields[2:])
+
+	def _handle_timeclock_reply(self, fields):
+		logger.debug('reply -> timeclock %s action %s %s', fields[0], fields[1], fields[2:])
+
+	def _handle_system_reply(self, fields):
+		# reply to our heartbeat query; the listener already noted that we heard from the repeater
+		logger.debug('reply -> system %s', fields)
+
+	def _handle_monitoring_reply(self, fields):
 		# we catch this just to avoid complaint about unhandled command; we don't need to do anything
-		logger.debug('match %s -> monitoring mode now %s,%s' % (match.group(), match.group(1), match.group(2)))
+		logger.debug('reply -> monitoring mode now %s', fields)
+
+	def _handle_error_reply(self, fields):
+		# 1 parameter count mismatch, 2 object does not exist, 3 invalid action, 4 parameter out of range
+		logger.warning('repeater reported error %s' % fields[0])
 
 	def _prep_response_handlers(self):
-		self.prompt_re = re.compile('^\s*(GNET> )+(.*)$')
-		self.response_handler_list = [
-			(re.compile('~OUTPUT,(\d+),1,(\d+.\d+)'), self._match_output_response),
-			(re.compile('~DEVICE,(\d+),(\d+),9,(\d)'), self._match_led_response), # XXX: depend on order, since button regex will match led action too
-			(re.compile('~DEVICE,(\d+),(\d+),(\d)'), self._match_button_response),
-			(re.compile('~MONITORING,(\d+),(\d+)'), self._match_monitoring_response),
-		]
+		# Dispatch on the reply's first field. Monitoring everything (255) gets us a lot of traffic,
+		# so this is a dict lookup and a split rather than a list of regexes to try in order.
+		self.response_handlers = {
+			'~OUTPUT': self._handle_output_reply,
+			'~DEVICE': self._handle_device_reply,
+			'~GROUP': self._handle_group_reply,
+			'~HVAC': self._handle_hvac_reply,
+			'~TIMECLOCK': self._handle_timeclock_reply,
+			'~SYSTEM': self._handle_system_reply,
+			'~MONITORING': self._handle_monitoring_reply,
+			'~ERROR': self._handle_error_reply,
+		}
 
 	def enable_monitoring(self):
 		self.send_repeater_command('#MONITORING,255,1')
 
-	def send_repeater_command(self, cmd):
+	def send_heartbeat(self):
+		# Called by the watchdog when the connection has been quiet; any reply proves it's alive.
+		# Asking for the system time is about the cheapest query the repeater answers.
+		self.send_repeater_command('?SYSTEM,1', connections.Priority.INTERACTIVE)
+
+	def send_repeater_command(self, cmd, priority = None):
+		# priority is a connections.Priority; default depends on the calling thread
 		logger.debug('send_repeater_command: enqueue %s' % repr(cmd))
-		self.send_queue.put(str(cmd))
+		self.send_queue.put(str(cmd), priority)
 
 	def receive_from_listener(self, cmd):
 		self.receive_repeater_reply(cmd)
 
 	def receive_repeater_reply(self, line):
-		logger.debug('receive_repeater_reply: reply %s' % repr(line))
+		# (logging here and in the handlers formats lazily; this is the hot path)
+		logger.debug('receive_repeater_reply: reply %r', line)
 		# Prompts can occur on a line by themself, or as the prefix of a line containing additional
 		# data. So we look for the prompt as a prefix, if found strip it off, then continue handling
 		# the rest of the line.
-		match = self.prompt_re.match(line)
+		line = line.lstrip()
+		while line.startswith('GNET> '):
+			line = line[6:]
+
+		if len(line) > 0:
+			if self.reflector:
+				self.reflector.to_children(line)
+			fields = line.split(',')
+			handler = self.response_handlers.get(fields[0])
+			if handler is None:
+				logger.warning('unmatched repeater reply: %s' % repr(line))
+				return
+			try:
+				handler(fields[1:])
+			except (IndexError, ValueError):
+				logger.warning('malformed repeater reply: %s' % repr(line))
+
+
+if __name__ == '__main__':
+	# Benchmark: reply dispatch throughput, over a capture of repeater traffic (one reply per
+	# line, as logged by receive_repeater_reply) if given, else a synthetic monitoring-mode mix.
+	# Run from the stargate directory: python -m gateways.radiora2.ra_repeater [capture]
+	import re
+	import sys
+
+	logging.basicConfig(level = logging.ERROR)
+
+	if len(sys.argv) > 1:
+		lines = [line.rstrip('\r\n') for line in open(sys.argv[1])]
+	else:
+		lines = []
+		for i in range(10000):
+			iid = i % 200
+			lines.extend([
+				'GNET> ~OUTPUT,%d,1,%d.00' % (iid, i % 101),
+				'~DEVICE,%d,3,3' % iid,
+				'~DEVICE,%d,3,4' % iid,
+				'~DEVICE,%d,83,9,%d' % (iid, i % 4),
+				'~GROUP,%d,3,%d' % (iid, 3 + i % 2),
+				'~SYSTEM,1,12:00:%02d' % (i % 60),
+				'~OUTPUT,%d,29,%d' % (iid, i % 4),
+				'GNET> ',
+			])
+
+	class NullCache(object):
+		# measure the parsing and dispatch, not the cache
+		def _record_output_level(self, iid, level):
+			pass
+		def _record_button_state(self, iid, cid, state):
+			pass
+		def _record_led_state(self, iid, cid, state):
+			pass
+	cache = NullCache()
+	repeater = RaRepeater(None)
+	repeater.cache = cache
+
+	# the old way (regex per reply type, tried in order, eager log formatting), for comparison
+	def old_output(match):
+		logger.debug('match %s -> output %d set level %g' % (match.group(), int(match.group(1)), float(match.group(2))))
+		cache._record_output_level(int(match.group(1)), float(match.group(2)))
+	def old_led(match):
+		logger.debug('match %s -> device %d led %d to %d' % (match.group(), int(match.group(1)), int(match.group(2)), int(match.group(3))))
+		cache._record_led_state(int(match.group(1)), int(match.group(2)), int(match.group(3)) == 1)
+	def old_button(match):
+		logger.debug('match %s -> device %d button %d action %d' % (match.group(), int(match.group(1)), int(match.group(2)), int(match.group(3))))
+		cache._record_button_state(int(match.group(1)), int(match.group(2)), int(match.group(3)) == 3)
+	def old_other(match):
+		logger.debug('match %s' % match.group())
+	prompt_re = re.compile('^\s*(GNET> )+(.*)$')
+	regex_handlers = [
+		(re.compile('~OUTPUT,(\d+),1,(\d+.\d+)'), old_output),
+		(re.compile('~DEVICE,(\d+),(\d+),9,(\d)'), old_led),
+		(re.compile('~DEVICE,(\d+),(\d+),(\d)'), old_button),
+		(re.compile('~MONITORING,(\d+),(\d+)'), old_other),
+		(re.compile('~SYSTEM,1,(.*)'), old_other),
+	]
+	def regex_dispatch(line):
+		logger.debug('receive_repeater_reply: reply %s' % repr(line))
+		match = prompt_re.match(line)
 		if match:
 			line = match.group(2)
-
 		if len(line) > 0:
-			# Try to parse remainder as monitoring response
-			for (pattern, handler) in self.response_handler_list:
+			for (pattern, handler) in regex_handlers:
 				match = pattern.match(line)
 				if match:
 					handler(match)
 					break
-			if not match:
-				logger.warning('unmatched repeater reply: %s' % repr(line))
+
+	for (label, dispatch) in (('regex list', regex_dispatch), ('prefix table', repeater.receive_repeater_reply)):
+		start = time.time()
+		for line in lines:
+			dispatch(line)
+		elapsed = time.time() - start
+		print '%-12s %d replies in %.3f seconds (%d/sec)' % (label, len(lines), elapsed, len(lines) / elapsed)
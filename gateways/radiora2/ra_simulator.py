@@ -0,0 +1,286 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Control of Lutron RadioRa2 system.
+#
+# This module provides a local stand-in for the repeater's integration (telnet) interface,
+# for exercising RaRepeater, OutputCache and everything downstream without a real repeater.
+# It serves the login exchange and GNET> prompt, and the parts of the protocol Stargate uses
+# (monitoring, ?OUTPUT/#OUTPUT, #AREA, #DEVICE presses and LEDs, ?SYSTEM), for the outputs and
+# devices in an RaLayout. It can also generate event storms (keypad presses, shades ramping)
+# to see how the rest of the system keeps up.
+#
+# Run as a script (from the stargate directory: python -m gateways.radiora2.ra_simulator
+# [DbXmlInfo.xml]) to benchmark event ingestion and command round trip through RaRepeater.
+
+import logging
+import random
+import select
+import socket
+import threading
+import time
+
+import connections
+import ra_layout
+
+
+logger = logging.getLogger(__name__)
+logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
+
+
+def make_layout(areas = 10, outputs_per_area = 8, keypads_per_area = 2, shades_per_area = 1):
+	# Synthesize a layout, for when there's no DbXmlInfo.xml handy.
+	layout = ra_layout.RaLayout([])
+	iid = 1
+	for a in range(areas):
+		area = ra_layout.Area(iid, 'Area %d' % a)
+		layout._add_area(area)
+		iid += 1
+		for o in range(outputs_per_area):
+			output_type = 'SYSTEM_SHADE' if o < shades_per_area else 'INC'
+			layout._add_output(ra_layout.Output(iid, 'Output %d-%d' % (a, o), output_type, area))
+			iid += 1
+		for k in range(keypads_per_area):
+			device = ra_layout.Device(iid, 'Keypad %d-%d' % (a, k), 'SEETOUCH_KEYPAD', area)
+			for b in range(1, 7):
+				device.buttons[b] = 'Button %d' % b
+				device.leds.append(80 + b)
+			layout._add_device(device)
+			iid += 1
+	return layout
+
+
+class RepeaterSimulator(threading.Thread):
+	def __init__(self, layout, username = 'lutron', password = 'integration', port = 0):
+		super(RepeaterSimulator, self).__init__(name = 'ra_simulator')
+		self.daemon = True
+		self.layout = layout
+		self.username = username
+		self.password = password
+		self.levels = dict([(iid, 0.0) for iid in layout.get_output_ids()]) # map from output iid to level
+		self.leds = {} # map from (device iid, led cid) to state
+		for device in layout.get_devices():
+			for cid in device.get_led_component_ids():
+				self.leds[(device.iid, cid)] = 0
+		self.clients = [] # list of logged-in clients, each a dict of socket, monitoring flag, send lock
+		self.stats = { 'commands': 0, 'queries': 0, 'events': 0, 'errors': 0 }
+		self.lock = threading.Lock()
+		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listen_socket.bind(('localhost', port))
+		self.listen_socket.listen(5)
+		self.port = self.listen_socket.getsockname()[1]
+
+	def run(self):
+		while True:
+			conn, address = self.listen_socket.accept()
+			logger.info('simulator accepted connection from %s' % str(address))
+			t = threading.Thread(target = self.serve, args = (conn,), name = 'ra_simulator_client')
+			t.daemon = True
+			t.start()
+
+	def serve(self, conn):
+		# The client does simple blocking reads during login and expects each prompt to arrive
+		# by itself, so we don't send anything until it has answered the previous one.
+		buffer = connections.CrlfSocketBuffer(conn)
+		client = { 'socket': conn, 'monitoring': False, 'lock': threading.Lock() }
+		try:
+			conn.send('login: ')
+			username = self._read_line(buffer)
+			conn.send('password: ')
+			password = self._read_line(buffer)
+			if username != self.username or password != self.password:
+				conn.send('bad login\r\nlogin: \x00')
+				raise Exception('bad login')
+			conn.send('\r\nGNET> \x00')
+			with self.lock:
+				self.clients.append(client)
+			while True:
+				select.select([conn], [], [])
+				for line in buffer.read_lines():
+					if line:
+						self.handle(client, line)
+		except Exception as ex:
+			logger.info('simulator client went away: %s' % ex)
+		with self.lock:
+			if client in self.clients:
+				self.clients.remove(client)
+		conn.close()
+
+	def _read_line(self, buffer):
+		while True:
+			lines = buffer.read_lines()
+			if lines:
+				return lines[0]
+
+	def handle(self, client, line):
+		with self.lock:
+			self.stats['commands'] += 1
+		fields = line.split(',')
+		try:
+			if fields[0] == '?OUTPUT':
+				iid = int(fields[1])
+				self._count('queries')
+				self._reply(client, '~OUTPUT,%d,1,%.2f' % (iid, self.levels[iid]))
+			elif fields[0] == '#OUTPUT' and fields[2] == '1':
+				self.set_level(int(fields[1]), float(fields[3]))
+			elif fields[0] == '#OUTPUT' and fields[2] == '6': # pulse
+				iid = int(fields[1])
+				self.set_level(iid, 100)
+				threading.Timer(0.5, self.set_level, (iid, 0)).start()
+			elif fields[0] == '#AREA' and fields[2] == '1':
+				area_iid = int(fields[1])
+				level = float(fields[3])
+				for output in self.layout.areas[area_iid].get_outputs():
+					self.set_level(output.iid, level)
+			elif fields[0] == '#DEVICE' and fields[3] in ('3', '4'):
+				self.broadcast('~DEVICE,%s,%s,%s' % (fields[1], fields[2], fields[3]))
+			elif fields[0] == '#DEVICE' and fields[3] == '9':
+				self.set_led(int(fields[1]), int(fields[2]), int(fields[4]))
+			elif fields[0] == '?DEVICE' and fields[3] == '9':
+				self._count('queries')
+				key = (int(fields[1]), int(fields[2]))
+				self._reply(client, '~DEVICE,%d,%d,9,%d' % (key[0], key[1], self.leds[key]))
+			elif fields[0] == '?SYSTEM' and fields[1] == '1':
+				self._reply(client, '~SYSTEM,1,%s' % time.strftime('%H:%M:%S'))
+			elif fields[0] == '#MONITORING':
+				client['monitoring'] = True
+				self._reply(client, '~MONITORING,%s,%s' % (fields[1], fields[2]))
+			else:
+				raise KeyError(line)
+		except (KeyError, IndexError, ValueError):
+			self._count('errors')
+			self._reply(client, '~ERROR,2')
+		self._send(client, 'GNET> ')
+
+	def set_level(self, iid, level):
+		self.levels[iid] = level
+		self.broadcast('~OUTPUT,%d,1,%.2f' % (iid, level))
+
+	def set_led(self, iid, cid, state):
+		self.leds[(iid, cid)] = state
+		self.broadcast('~DEVICE,%d,%d,9,%d' % (iid, cid, state))
+
+	def broadcast(self, line):
+		# report a change to every client in monitoring mode
+		self._count('events')
+		with self.lock:
+			clients = list(self.clients)
+		for client in clients:
+			if client['monitoring']:
+				self._reply(client, line)
+
+	def _reply(self, client, line):
+		self._send(client, line + '\r\n')
+
+	def _send(self, client, data):
+		try:
+			with client['lock']:
+				connections.send_all(client['socket'], data)
+		except Exception:
+			pass # serve() notices and cleans up
+
+	def _count(self, stat):
+		with self.lock:
+			self.stats[stat] += 1
+
+	# event storms
+	def storm_presses(self, rate, duration):
+		# rate presses per second (each a press and a release) on random keypad buttons
+		buttons = [(d.iid, cid) for d in self.layout.get_devices() for cid in d.get_button_component_ids()]
+		def press():
+			(iid, cid) = random.choice(buttons)
+			self.broadcast('~DEVICE,%d,%d,3' % (iid, cid))
+			self.broadcast('~DEVICE,%d,%d,4' % (iid, cid))
+		return self._storm(press, rate, duration)
+
+	def storm_shades(self, rate, duration):
+		# every shade ramps open and closed, reporting its level rate times a second
+		shades = [o.iid for o in self.layout.get_outputs() if o.get_type() == 'SYSTEM_SHADE']
+		step = dict([(iid, 5) for iid in shades])
+		def ramp():
+			for iid in shades:
+				level = self.levels[iid] + step[iid]
+				if level <= 0 or level >= 100:
+					step[iid] = -step[iid]
+				self.set_level(iid, max(0, min(100, level)))
+		return self._storm(ramp, rate, duration)
+
+	def _storm(self, action, rate, duration):
+		def run():
+			start = time.time()
+			count = 0
+			while time.time() - start < duration:
+				action()
+				count += 1
+				# stay on schedule rather than drifting by however long action() took
+				delay = start + count / float(rate) - time.time()
+				if delay > 0:
+					time.sleep(delay)
+		t = threading.Thread(target = run, name = 'ra_simulator_storm')
+		t.daemon = True
+		t.start()
+		return t
+
+
+if __name__ == '__main__':
+	# Benchmark: event ingestion rate through RaRepeater and OutputCache during a keypad press
+	# storm (with shades ramping too), and #OUTPUT round trip latency (command to confirmed
+	# ~OUTPUT) while it's going on.
+	import sys
+	import ra_repeater
+
+	logging.basicConfig(level = logging.ERROR)
+
+	if len(sys.argv) > 1:
+		layout = ra_layout.RaLayout([])
+		layout.read_cached_db(sys.argv[1])
+		layout.map_db()
+	else:
+		layout = make_layout()
+	sim = RepeaterSimulator(layout)
+	sim.start()
+
+	class Counter(object):
+		def __init__(self):
+			self.actions = 0
+		def on_user_action(self, iid, state, refresh, comp_id):
+			if comp_id and not refresh: # keypad button events, not our own output changes
+				self.actions += 1
+
+	watchdog = connections.SgWatchdog()
+	watchdog.start()
+	repeater = ra_repeater.RaRepeater(watchdog)
+	repeater.connect('localhost', sim.username, sim.password, sim.port)
+	cache = ra_repeater.OutputCache()
+	for output in layout.get_outputs():
+		cache.watch_output(output.iid, output.area.iid)
+	for device in layout.get_devices():
+		cache.watch_device(device.iid, device.get_button_component_ids(), device.get_led_component_ids(), device.area.iid)
+	counter = Counter()
+	cache.subscribe_to_actions(counter)
+	start = time.time()
+	repeater.bind_cache(cache)
+	while cache.get_refresh_progress()[0] < cache.get_refresh_progress()[1]:
+		time.sleep(0.01)
+	print 'initial sync of %d outputs and LEDs: %.2f seconds' % (cache.get_refresh_progress()[1], time.time() - start)
+
+	rate = 500
+	duration = 5
+	storm = sim.storm_presses(rate, duration)
+	sim.storm_shades(10, duration) # background noise
+	outputs = [o.iid for o in layout.get_outputs() if o.get_type() != 'SYSTEM_SHADE']
+	latencies = []
+	for i in range(50):
+		iid = outputs[i % len(outputs)]
+		sent = time.time()
+		if repeater.set_output_level(iid, (i * 7) % 101).wait(2):
+			latencies.append(time.time() - sent)
+		time.sleep(duration / 60.0)
+	storm.join()
+	time.sleep(0.5) # let the listener drain
+	expected = rate * duration * 2
+	print 'press storm: %d of %d events ingested (%d/sec)' % (counter.actions, expected, counter.actions / float(duration))
+	latencies.sort()
+	if latencies:
+		print '#OUTPUT round trip during storm: %d confirmed, median %.1fms, p95 %.1fms' % (len(latencies),
+			1000 * latencies[len(latencies) / 2], 1000 * latencies[int(len(latencies) * 0.95)])
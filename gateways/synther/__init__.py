@@ -2,6 +2,7 @@
 #
 # stargate.gateways.synther package init
 
+import rules
 import synthesizer
 
 def get_dependencies(gateway_config):
@@ -11,27 +12,29 @@ def get_dependencies(gateway_config):
 	# dependencies, and do what the constructor currently does later in init.
 	deps = set()
 
-	# These are all hardcoded, because they are.
-	if gateway_config.get('bridges'):
-		deps.add('radiora2')
-		deps.add('powerseries')
-	if gateway_config.get('ledbridges'):
-		deps.add('radiora2')
-		deps.add('powerseries')
-	if gateway_config.get('delays'):
-		deps.add('radiora2')
+	# The gateway types are hardcoded, because they are; which instance of each is per entry.
+	# (an empty section reads as None, not an empty list)
+	for params in (gateway_config.get('bridges') or []) + (gateway_config.get('ledbridges') or []):
+		deps.add(synthesizer.gateway_instance(params, 'radiora2'))
+		deps.add(synthesizer.gateway_instance(params, 'powerseries'))
+	for params in gateway_config.get('delays') or []:
+		deps.add(synthesizer.gateway_instance(params, 'radiora2'))
 
 	# Paranoid is more complicated, but less hardcoded here, because its dependencies
 	# actually vary according to the specific configuration.
-	paranoid_watches = gateway_config.get('paranoid')
+	paranoid_watches = gateway_config.get('paranoid') or []
 	for pw in paranoid_watches:
 		deps.add(pw['gateway'])
 
+	# Rules name their gateways, like paranoid does.
+	deps |= rules.get_dependencies(gateway_config.get('rules') or [])
+
 	return deps
 
 def init(house, instance_name, gateway_config):
 	return synthesizer.Synthesizer(house, instance_name,
-		gateway_config.get('bridges', []),
-		gateway_config.get('ledbridges', []),
-		gateway_config.get('delays', []),
-		gateway_config.get('paranoid', []))
+		gateway_config.get('bridges') or [],
+		gateway_config.get('ledbridges') or [],
+		gateway_config.get('delays') or [],
+		gateway_config.get('paranoid') or [],
+		gateway_config.get('rules') or [])
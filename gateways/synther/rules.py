@@ -0,0 +1,253 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Cross-device control for Stargate.
+#
+# This module provides declarative automation rules, for any device of any gateway: when a
+# device enters a state (optionally from a given state, optionally staying there for some
+# time), and some other devices are in given states, put devices into states and/or send
+# notifications. Everything goes through the generic StargateDevice interface (is_in_state,
+# go_to_state via StargateHouse.set_devices_to_state), so nothing here knows about gateway
+# types; see the synther section of config-example.yaml for the syntax.
+#
+# Rules are compiled once, at load time, into a dispatch table: device -> state -> rules that
+# trigger on entering it. We subscribe once per watched device, and on each event only check
+# that device's watched states and run the rules keyed by the ones that changed, so the cost of
+# an event doesn't depend on how many rules watch other devices or states.
+#
+# Run as a script (python gateways/synther/rules.py [number of rules]) to benchmark dispatch
+# with many rules.
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
+
+
+def _state_name(state):
+	# YAML reads unquoted on/off as booleans
+	if state is True:
+		return 'on'
+	if state is False:
+		return 'off'
+	return str(state)
+
+
+def get_dependencies(rules):
+	# gateway instances named by the rules' device references
+	deps = set()
+	for rule in rules:
+		for ref in [rule['when']] + list(rule.get('if') or []) + list(rule.get('do') or []):
+			if 'gateway' in ref:
+				deps.add(ref['gateway'])
+	return deps
+
+
+class Rule(object):
+	# A compiled rule: devices looked up and states checked, actions grouped by state so each
+	# group is one bulk request per gateway.
+	def __init__(self, house, params):
+		self.house = house
+		self.name = params.get('name', str(params['when']))
+		(self.device, self.state) = self._get_device_state(params['when'])
+		self.from_state = None
+		if 'from' in params['when']:
+			self.from_state = _state_name(params['when']['from'])
+			self._check_state(self.device, self.from_state)
+		self.hold = params.get('for', 0) # seconds the trigger state must last before we act
+		self.conditions = [self._get_device_state(cond) for cond in params.get('if') or []]
+		self.actions = [] # list of (state, list of devices), in order of first appearance
+		self.notifications = [] # list of (alias, subject, message)
+		for action in params.get('do') or []:
+			if 'notify' in action:
+				# Check up front and fail early if notifications aren't configured, like paranoid does.
+				assert house.notify.can_notify(action['notify'])
+				self.notifications.append((action['notify'],
+					action.get('subject', 'Stargate: %s' % self.name),
+					action.get('message', 'Stargate rule "%s" was triggered.' % self.name)))
+				continue
+			(device, state) = self._get_device_state(action)
+			for (action_state, devices) in self.actions:
+				if action_state == state:
+					devices.append(device)
+					break
+			else:
+				self.actions.append((state, [device]))
+		if not self.actions and not self.notifications:
+			raise Exception('synther rule "%s" does nothing' % self.name)
+		self.timer_token = None # pending hold timer; guarded by the engine's lock
+
+	def _get_device_state(self, ref):
+		device = self.house.get_device_by_gateway_and_id(ref['gateway'], ref['device'])
+		state = _state_name(ref['state'])
+		self._check_state(device, state)
+		return (device, state)
+
+	def _check_state(self, device, state):
+		if state not in device.get_possible_states() and state not in (device.devclass, device.devtype):
+			raise Exception('synther rule "%s": device %s has no state "%s" (has %s)' %
+				(self.name, device.get_internal_name(), state, ', '.join(sorted(device.get_possible_states()))))
+
+	def conditions_hold(self):
+		return all([device.is_in_state(state) for (device, state) in self.conditions])
+
+	def run(self):
+		if not self.conditions_hold():
+			logger.debug('synther.rules: rule "%s" triggered but conditions not met' % self.name)
+			return
+		logger.info('synther.rules: rule "%s" firing' % self.name)
+		for (state, devices) in self.actions:
+			self.house.set_devices_to_state(devices, state)
+		for (alias, subject, message) in self.notifications:
+			self.house.notify.notify(alias, message, subject)
+
+
+class RuleEngine(object):
+	def __init__(self, house, rules):
+		self.house = house
+		self.rules = [Rule(house, params) for params in rules]
+		self.dispatch = {} # map from device to map from state to list of rules triggered by entering it
+		self.watched = {} # map from device to list of states we follow for it (triggers and from states)
+		self.last_states = {} # map from (device, state) to whether device was last seen in state
+		self.lock = threading.Lock()
+
+		for rule in self.rules:
+			self.dispatch.setdefault(rule.device, {}).setdefault(rule.state, []).append(rule)
+			for state in (rule.state, rule.from_state):
+				if state is not None and state not in self.watched.setdefault(rule.device, []):
+					self.watched[rule.device].append(state)
+		for (device, states) in self.watched.items():
+			for state in states:
+				self.last_states[(device, state)] = device.is_in_state(state)
+			self.house.events.subscribe(device, lambda synthetic, device = device: self.on_device_change(device))
+		logger.info('synther.rules: %d rules watching %d states of %d devices' %
+			(len(self.rules), len(self.last_states), len(self.watched)))
+
+		# Rules that wait for a state that already holds start counting now (an immediate rule
+		# only fires on a change, and loading isn't one).
+		with self.lock:
+			for rule in self.rules:
+				if rule.hold and self.last_states[(rule.device, rule.state)]:
+					self._start_hold(rule)
+
+	def on_device_change(self, device):
+		# Called on the reporting gateway's thread. Ask the device outside the lock (asking may
+		# take a while), then work out transitions under it, then act outside it again.
+		current = [(state, device.is_in_state(state)) for state in self.watched[device]]
+		ready = []
+		with self.lock:
+			previous = dict([(state, self.last_states[(device, state)]) for (state, now) in current])
+			for (state, now) in current:
+				self.last_states[(device, state)] = now
+			for (state, now) in current:
+				if now == previous[state]:
+					continue
+				for rule in self.dispatch[device].get(state, []):
+					if not now:
+						self._cancel_hold(rule)
+					elif rule.from_state is not None and not previous[rule.from_state]:
+						continue
+					elif rule.hold:
+						self._start_hold(rule)
+					else:
+						ready.append(rule)
+		for rule in ready:
+			self._run(rule)
+
+	def _start_hold(self, rule):
+		# requires lock
+		if rule.timer_token is None:
+			rule.timer_token = self.house.timer.add_event(rule.hold, lambda: self._on_hold_elapsed(rule))
+
+	def _cancel_hold(self, rule):
+		# requires lock
+		if rule.timer_token is not None:
+			self.house.timer.cancel_event(rule.timer_token)
+			rule.timer_token = None
+
+	def _on_hold_elapsed(self, rule):
+		with self.lock:
+			rule.timer_token = None
+			if not self.last_states[(rule.device, rule.state)]:
+				return # left the state just as the timer went off
+		self._run(rule)
+
+	def _run(self, rule):
+		# one rule's failure (a gateway offline, say) shouldn't keep the others from running
+		try:
+			rule.run()
+		except:
+			logger.exception('synther.rules: rule "%s" failed' % rule.name)
+
+
+if __name__ == '__main__':
+	# Benchmark: time per event dispatched, with rules spread over many devices, versus each
+	# rule subscribing to every device's events (SgEvents.subscribe_all) and checking whether it
+	# cares, the way a rule that isn't tied to a device at load time would have to.
+	import sys
+
+	class FakeDevice(object):
+		devclass = 'sensor'
+		devtype = 'closure'
+		def __init__(self, house, n):
+			self.n = n
+			self.open = False
+		def get_internal_name(self):
+			return 'fake:%d' % self.n
+		def get_possible_states(self):
+			return set(['open', 'closed'])
+		def is_in_state(self, state):
+			return self.open == (state == 'open')
+
+	class FakeHouse(object):
+		def __init__(self, devices):
+			self.devices = devices
+			self.subscribers = {}
+			self.broadcast_subscribers = []
+			self.events = self
+			self.actions = 0
+		def subscribe(self, device, handler):
+			self.subscribers.setdefault(device, []).append(handler)
+		def subscribe_all(self, handler):
+			self.broadcast_subscribers.append(handler)
+		def get_device_by_gateway_and_id(self, gateway, devid):
+			return self.devices[devid]
+		def set_devices_to_state(self, devices, state):
+			self.actions += 1
+		def notify_subscribers(self, device):
+			for handler in self.subscribers.get(device, []):
+				handler(False)
+			for handler in self.broadcast_subscribers:
+				handler(device, False)
+
+	logging.basicConfig(level = logging.WARNING)
+	n_rules = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	n_devices = 500
+	devices = [FakeDevice(None, i) for i in range(n_devices)]
+	rules = [{ 'when': { 'gateway': 'fake', 'device': i % n_devices, 'state': 'open' },
+		'do': [ { 'gateway': 'fake', 'device': (i + 1) % n_devices, 'state': 'closed' } ] } for i in range(n_rules)]
+	events = 2000
+
+	def run_events(house):
+		start = time.time()
+		for i in range(events):
+			device = devices[i % n_devices]
+			device.open = not device.open
+			house.notify_subscribers(device)
+		return (time.time() - start) / events
+
+	house = FakeHouse(devices)
+	for params in rules:
+		def on_change(device, synthetic, trigger = devices[params['when']['device']]):
+			if device is trigger and device.is_in_state('open'):
+				house.actions += 1
+		house.subscribe_all(on_change)
+	per_event = run_events(house)
+	print '%-24s %d rules: %.1f usec/event, %d actions' % ('broadcast per rule', n_rules, per_event * 1e6, house.actions)
+
+	house = FakeHouse(devices)
+	RuleEngine(house, rules)
+	per_event = run_events(house)
+	print '%-24s %d rules: %.1f usec/event, %d actions' % ('dispatch table', n_rules, per_event * 1e6, house.actions)
@@ -11,6 +11,7 @@ import time
 import traceback
 
 from sg_util import AttrDict
+import rules
 import sg_house
 
 
@@ -18,6 +19,13 @@ logger = logging.getLogger(__name__)
 logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
 
 
+def gateway_instance(params, gateway_type):
+	# Which gateway instance a bridge/ledbridge/delay means by 'radiora2' or 'powerseries': the
+	# entry can name one with radiora2_gateway/powerseries_gateway, else it's the one named
+	# after its type.
+	return params.get(gateway_type + '_gateway', gateway_type)
+
+
 class Bridge(object):
 	def __init__(self, synthesizer, params):
 		logger.info('create bridge for %s' % str(params))
@@ -26,8 +34,8 @@ class Bridge(object):
 
 		# Locate devices to operate on
 		# XXX for now, behavior is hardcoded to handle radiora2<>powerseries the way I'm using them
-		ra_dev = house.get_device_by_gateway_and_id('radiora2', params['radiora2'])
-		dsc_zone = house.get_device_by_gateway_and_id('powerseries', 'zone:%d' % params['dsc_zone'])
+		ra_dev = house.get_device_by_gateway_and_id(gateway_instance(params, 'radiora2'), params['radiora2'])
+		dsc_zone = house.get_device_by_gateway_and_id(gateway_instance(params, 'powerseries'), 'zone:%d' % params['dsc_zone'])
 		(dsc_partition, dsc_cmd_id) = map(int, str(params['dsc_cmd'])) # split out the digits
 
 		# Suck initial state from DSC and push into Lutron
@@ -61,9 +69,9 @@ class LedBridge(object):
 
 		# Locate devices to operate on
 		# XXX for now, behavior is hardcoded to handle powerseries zone -> radiora2 keypad button led
-		ra_keypad = house.get_device_by_gateway_and_id('radiora2', params['radiora2_keypad'])
+		ra_keypad = house.get_device_by_gateway_and_id(gateway_instance(params, 'radiora2'), params['radiora2_keypad'])
 		ra_button = ra_keypad.get_button(params['radiora2_button_cid'])
-		dsc_zone = house.get_device_by_gateway_and_id('powerseries', 'zone:%d' % params['dsc_zone'])
+		dsc_zone = house.get_device_by_gateway_and_id(gateway_instance(params, 'powerseries'), 'zone:%d' % params['dsc_zone'])
 		negate = params['negate']
 		if negate:
 			map_state = lambda state: not state
@@ -87,9 +95,9 @@ class Delay(object):
 
 		# Locate device to operate on
 		# XXX for now, behavior is hardcoded to handle radiora2 keypad -> radiora2 device
-		ra_keypad = house.get_device_by_gateway_and_id('radiora2', params['radiora2_keypad'])
+		ra_keypad = house.get_device_by_gateway_and_id(gateway_instance(params, 'radiora2'), params['radiora2_keypad'])
 		ra_button = ra_keypad.get_button(params['radiora2_button_cid'])
-		ra_output = house.get_device_by_gateway_and_id('radiora2', params['radiora2_output'])
+		ra_output = house.get_device_by_gateway_and_id(gateway_instance(params, 'radiora2'), params['radiora2_output'])
 		delay = params['delay']
 		value = params['value']
 
@@ -203,7 +211,7 @@ class Paranoid(object):
 
 
 class Synthesizer(sg_house.StargateGateway):
-	def __init__(self, house, gateway_instance_name, bridges, ledbridges, delays, paranoids):
+	def __init__(self, house, gateway_instance_name, bridges, ledbridges, delays, paranoids, rule_list):
 		super(Synthesizer, self).__init__(house, gateway_instance_name)
 		self.bridges = []
 		for bridge in bridges:
@@ -221,6 +229,8 @@ class Synthesizer(sg_house.StargateGateway):
 		for paranoid in paranoids:
 			self.paranoids.append(Paranoid(self, paranoid))
 
+		self.rules = rules.RuleEngine(house, rule_list)
+
 	# public interface to StargateHouse
 	def get_device_by_gateway_id(self, gateway_devid):
 		# XXX this is uncalled since we don't create StargateDevices
@@ -0,0 +1,190 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Cross-device control for Stargate.
+#
+# Tests for the synther rule engine, against fake devices and a real SgTimer. Run from the
+# stargate directory: PYTHONPATH=. python -m unittest discover -s gateways/synther -p 'test_*.py'
+
+import time
+import unittest
+
+import events
+import rules
+import timer
+
+
+class FakeDevice(object):
+	devclass = 'sensor'
+	devtype = 'closure'
+
+	def __init__(self, name, states):
+		self.name = name
+		self.states = states
+		self.state = states[0]
+
+	def get_internal_name(self):
+		return self.name
+
+	def get_possible_states(self):
+		return set(self.states)
+
+	def is_in_state(self, state):
+		return self.state == state
+
+
+class FakeNotify(object):
+	def __init__(self):
+		self.sent = []
+
+	def can_notify(self, alias):
+		return alias == 'me'
+
+	def notify(self, alias, message, subject = None):
+		self.sent.append((alias, subject))
+
+
+class FakeHouse(object):
+	def __init__(self, house_timer):
+		self.events = events.SgEvents()
+		self.timer = house_timer
+		self.notify = FakeNotify()
+		self.bulk = [] # (sorted device names, state) for each set_devices_to_state
+		self.devices = {
+			('dsc', 'zone:1'): FakeDevice('dsc:zone:1', ['closed', 'open']),
+			('ra', 2): FakeDevice('ra:2', ['off', 'on']),
+			('ra', 3): FakeDevice('ra:3', ['off', 'on']),
+			('vera', 5): FakeDevice('vera:5', ['locked', 'unlocked']),
+		}
+
+	def get_device_by_gateway_and_id(self, gateway, devid):
+		return self.devices[(gateway, devid)]
+
+	def set_devices_to_state(self, devices, state):
+		self.bulk.append((sorted([device.name for device in devices]), state))
+		for device in devices:
+			device.state = state
+
+	def change(self, gateway, devid, state):
+		device = self.devices[(gateway, devid)]
+		device.state = state
+		self.events.notify_subscribers(device, False)
+
+
+ZONE = { 'gateway': 'dsc', 'device': 'zone:1' }
+
+def ref(base, **kwargs):
+	result = dict(base)
+	result.update(kwargs)
+	return result
+
+
+class RuleEngineTest(unittest.TestCase):
+	timer = timer.SgTimer() # (its thread never exits, so share one)
+
+	def setUp(self):
+		self.house = FakeHouse(self.timer)
+
+	def wait_for(self, predicate, timeout = 2):
+		deadline = time.time() + timeout
+		while not predicate() and time.time() < deadline:
+			time.sleep(0.01)
+		return predicate()
+
+	def test_compile(self):
+		house = self.house
+		engine = rules.RuleEngine(house, [
+			{ 'name': 'lights', 'when': ref(ZONE, state = 'open', **{ 'from': 'closed' }),
+			  'if': [ { 'gateway': 'vera', 'device': 5, 'state': 'locked' } ],
+			  'do': [ { 'gateway': 'ra', 'device': 2, 'state': True }, # YAML's unquoted on
+			          { 'gateway': 'vera', 'device': 5, 'state': 'unlocked' },
+			          { 'gateway': 'ra', 'device': 3, 'state': 'on' } ] },
+			{ 'name': 'alert', 'when': ref(ZONE, state = 'open'), 'for': 10, 'do': [ { 'notify': 'me' } ] },
+		])
+		zone = house.devices[('dsc', 'zone:1')]
+		(lights, alert) = engine.rules
+		self.assertEqual(engine.dispatch, { zone: { 'open': [lights, alert] } })
+		self.assertEqual(engine.watched, { zone: ['open', 'closed'] })
+		self.assertEqual(engine.last_states, { (zone, 'open'): False, (zone, 'closed'): True })
+		self.assertEqual(house.events.subscribers.keys(), [zone])
+		# actions grouped by state, in order of first appearance
+		self.assertEqual(lights.actions, [('on', [house.devices[('ra', 2)], house.devices[('ra', 3)]]),
+		                                  ('unlocked', [house.devices[('vera', 5)]])])
+		self.assertEqual(lights.conditions, [(house.devices[('vera', 5)], 'locked')])
+		self.assertEqual(alert.notifications, [('me', 'Stargate: alert', 'Stargate rule "alert" was triggered.')])
+		self.assertEqual(rules.get_dependencies([{ 'when': ref(ZONE, state = 'open'),
+			'if': [ { 'gateway': 'vera', 'device': 5, 'state': 'locked' } ],
+			'do': [ { 'gateway': 'ra', 'device': 2, 'state': 'on' }, { 'notify': 'me' } ] }]),
+			set(['dsc', 'vera', 'ra']))
+
+	def test_compile_errors(self):
+		self.assertRaises(Exception, rules.RuleEngine, self.house,
+			[ { 'when': ref(ZONE, state = 'on'), 'do': [ { 'notify': 'me' } ] } ]) # no such state
+		self.assertRaises(Exception, rules.RuleEngine, self.house,
+			[ { 'when': ref(ZONE, state = 'open'), 'do': [] } ]) # does nothing
+		self.assertRaises(KeyError, rules.RuleEngine, self.house,
+			[ { 'when': ref(ZONE, device = 'zone:9', state = 'open'), 'do': [ { 'notify': 'me' } ] } ])
+
+	def test_dispatch(self):
+		house = self.house
+		rules.RuleEngine(house, [
+			{ 'when': ref(ZONE, state = 'open'),
+			  'if': [ { 'gateway': 'vera', 'device': 5, 'state': 'locked' } ],
+			  'do': [ { 'gateway': 'ra', 'device': 2, 'state': 'on' }, { 'gateway': 'ra', 'device': 3, 'state': 'on' } ] },
+		])
+		house.change('ra', 2, 'off') # not a watched device
+		self.assertEqual(house.bulk, [])
+		house.change('dsc', 'zone:1', 'open')
+		self.assertEqual(house.bulk, [(['ra:2', 'ra:3'], 'on')])
+		house.change('dsc', 'zone:1', 'open') # no change, no transition
+		self.assertEqual(len(house.bulk), 1)
+		house.change('dsc', 'zone:1', 'closed')
+		house.devices[('vera', 5)].state = 'unlocked'
+		house.change('dsc', 'zone:1', 'open') # condition doesn't hold
+		self.assertEqual(len(house.bulk), 1)
+
+	def test_from_state(self):
+		house = self.house
+		house.devices[('dsc', 'zone:1')].state = 'neither'
+		rules.RuleEngine(house, [
+			{ 'when': ref(ZONE, state = 'open', **{ 'from': 'closed' }), 'do': [ { 'gateway': 'ra', 'device': 2, 'state': 'on' } ] },
+		])
+		house.change('dsc', 'zone:1', 'open') # not from closed
+		self.assertEqual(house.bulk, [])
+		house.change('dsc', 'zone:1', 'closed')
+		house.change('dsc', 'zone:1', 'open')
+		self.assertEqual(house.bulk, [(['ra:2'], 'on')])
+
+	def test_hold_expires(self):
+		house = self.house
+		rules.RuleEngine(house, [
+			{ 'name': 'left open', 'when': ref(ZONE, state = 'open'), 'for': 0.2, 'do': [ { 'notify': 'me' } ] },
+		])
+		house.change('dsc', 'zone:1', 'open')
+		self.assertEqual(house.notify.sent, []) # not yet
+		self.assertTrue(self.wait_for(lambda: house.notify.sent))
+		self.assertEqual(house.notify.sent, [('me', 'Stargate: left open')])
+
+	def test_hold_cancelled(self):
+		house = self.house
+		rules.RuleEngine(house, [
+			{ 'when': ref(ZONE, state = 'open'), 'for': 0.2, 'do': [ { 'notify': 'me' } ] },
+		])
+		house.change('dsc', 'zone:1', 'open')
+		house.change('dsc', 'zone:1', 'closed')
+		time.sleep(0.4)
+		self.assertEqual(house.notify.sent, [])
+
+	def test_hold_starts_at_load(self):
+		# a state that already holds when the rules load starts counting then
+		house = self.house
+		house.devices[('dsc', 'zone:1')].state = 'open'
+		rules.RuleEngine(house, [
+			{ 'when': ref(ZONE, state = 'open'), 'for': 0.1, 'do': [ { 'notify': 'me' } ] },
+			{ 'when': ref(ZONE, state = 'open'), 'do': [ { 'gateway': 'ra', 'device': 2, 'state': 'on' } ] },
+		])
+		self.assertTrue(self.wait_for(lambda: house.notify.sent))
+		self.assertEqual(house.bulk, []) # loading isn't a change
+
+
+if __name__ == '__main__':
+	unittest.main()
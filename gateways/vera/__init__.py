@@ -10,5 +10,8 @@ def get_dependencies(gateway_config):
 def init(house, instance_name, gateway_config):
 	hostname = gateway_config.gateway.hostname
 	poll_interval = gateway_config.gateway.poll_interval
+	poll_timeout = gateway_config.gateway.get('poll_timeout', 60)
+	request_timeout = gateway_config.gateway.get('request_timeout', 10)
+	max_requests = gateway_config.gateway.get('max_requests', 3)
 	
-	return vera_gateway.VeraGateway(house, instance_name, hostname, poll_interval)
+	return vera_gateway.VeraGateway(house, instance_name, hostname, poll_interval, poll_timeout, request_timeout, max_requests)
@@ -16,10 +16,12 @@
 
 import json
 import logging
-import urllib
+import threading
 
+import connections
 from sg_util import AttrDict
 import sg_house
+import vera_luup
 
 
 logger = logging.getLogger(__name__)
@@ -34,9 +36,11 @@ class VeraDevice(sg_house.StargateDevice):
 		super(VeraDevice, self).__init__(gateway.house, self.vera_room.sg_area, gateway, str(self.vera_id), dev_sdata.name)
 
 	def is_pending(self):
-		# Determine whether Vera has any active jobs for this device.
-		# XXX may want to have some concept of the jobs we started, not just all jobs for the device.
-		return self.vera_id in self.gateway._vera_devices_with_jobs_in_progress()
+		# Whether a job we started for this device (with an action) is still running.
+		return self.gateway.jobs.is_pending(self.vera_id)
+
+	def wait_until_settled(self, timeout = None):
+		return self.gateway.jobs.wait(self.vera_id, timeout)
 	
 
 class VeraDoorLock(VeraDevice):
@@ -55,7 +59,7 @@ class VeraDoorLock(VeraDevice):
 		return self.get_level() == 1
 		
 	def is_unlocked(self):
-		return not self.is_locked()
+		return self.get_level() == 0
 		
 	def be_locked(self):
 		self.set_level(1)
@@ -64,16 +68,34 @@ class VeraDoorLock(VeraDevice):
 		self.set_level(0)
 		
 	def get_level(self):
-		return self.gateway._luup_get_variable(VeraDoorLock.service_id, self.vera_id, VeraDoorLock.lock_state_var)
+		# From the poll-fed cache while it's fresh; None if unknown.
+		locked = self.gateway.state_cache.get(self.vera_id, 'locked')
+		if locked is None:
+			return self.refresh_level()
+		return int(locked)
+
+	def refresh_level(self):
+		# Live read from the Vera, for callers that can't trust the cache; None if it fails.
+		try:
+			locked = self.gateway._luup_get_variable(VeraDoorLock.service_id, self.vera_id, VeraDoorLock.lock_state_var)
+		except Exception as ex:
+			logger.warning('unable to read lock state for %s: %s' % (self.name, ex))
+			return None
+		self.gateway.state_cache._record_field(self.vera_id, 'locked', locked)
+		return int(locked)
 		
 	def set_level(self, level):
 		target = 1 if level else 0
 		self.gateway._luup_set_variable_target(VeraDoorLock.service_id, self.vera_id, VeraDoorLock.lock_state_var, target)
 		
 	def get_name_for_level(self, level):
+		if level is None:
+			return 'unknown'
 		return 'locked' if level else 'unlocked'
 		
 	def vera_poll_update(self, dev_sdata):
+		if 'locked' not in dev_sdata:
+			return
 		locked = int(dev_sdata.locked)
 		logger.debug('device %s state last %d now %d' % (self.name, self.last_locked_state, locked))
 		if locked != self.last_locked_state:
@@ -90,27 +112,36 @@ class VeraRoom(object):
 
 
 class VeraGateway(sg_house.StargateGateway):
-	def __init__(self, house, gateway_instance_name, hostname, poll_interval):
+	def __init__(self, house, gateway_instance_name, hostname, poll_interval, poll_timeout = 60, request_timeout = 10, max_requests = 3):
 		super(VeraGateway, self).__init__(house, gateway_instance_name)
 		self.hostname = hostname
 		self.port = 3480
 		self.poll_interval = poll_interval
+		self.poll_timeout = poll_timeout
+		self.pool = vera_luup.LuupConnectionPool(hostname, self.port, max_requests, request_timeout)
+		self.connection_state = connections.ConnectionState.CONNECTING
 		self.devices = {} # map from int id to VeraDevice
 		self.rooms = {} # map from int id to VeraRoom
 		self.catmap = {} # map from int id to AttrDict representing sdata category response
+		# device state, fed by the change feed; fresh as long as a long-poll has come back recently
+		self.state_cache = vera_luup.LuupStateCache(poll_timeout + 2 * poll_interval)
+		self.jobs = vera_luup.LuupJobTracker()
 		
 		# parse sdata to enumerate rooms and devices
 		# XXX ignore "sections"
 		sdata = self._vera_luup_request('sdata')
+		self.state_cache._record_devices(sdata.devices, True)
 		for room in sdata.rooms:
 			self.rooms[room.id] = VeraRoom(self, room)
 		for category in sdata.categories:
 			self.catmap[category.id] = category
 		for device in sdata.devices:
 			self.devices[device.id] = self._create_device(device)
+		self.connection_state = connections.ConnectionState.LIVE
 			
-		# create poll thread to periodically poll Vera for changes
-		self._install_periodic_poller()
+		# follow changes from here on
+		self.change_feed = vera_luup.LuupChangeFeed(self, sdata, self.state_cache, self.poll_timeout, retry_interval = self.poll_interval)
+		self.change_feed.start()
 
 	# public interface to StargateHouse
 	def get_device_by_gateway_id(self, gateway_devid):
@@ -119,6 +150,28 @@ class VeraGateway(sg_house.StargateGateway):
 		vera_id = int(gateway_devid)
 		return self.devices[vera_id]
 		
+	def get_connection_state(self):
+		# There's no connection as such, just HTTP requests; we call ourselves degraded when the last poll failed.
+		return self.connection_state
+
+	def set_devices_to_state(self, devices, state):
+		# Each device is a separate action request, and the Vera is slow to answer them (a lock
+		# action waits for the Z-Wave round trip), so issue them in parallel; the pool limits how
+		# many are actually in flight at once.
+		if len(devices) < 2:
+			return super(VeraGateway, self).set_devices_to_state(devices, state)
+		def go_to_state(device):
+			try:
+				device.go_to_state(state)
+			except Exception as ex:
+				logger.warning('unable to set %s to %s: %s' % (device.name, state, ex))
+		threads = [threading.Thread(target = go_to_state, args = (device,), name = 'vera_action') for device in devices]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		for thread in threads:
+			thread.join()
+
 	# private helper for device creation
 	def _create_device(self, dev_sdata):
 		# map for correct VeraDevice subclass matching Vera device type.
@@ -136,20 +189,17 @@ class VeraGateway(sg_house.StargateGateway):
 			return None
 		return cls(self, dev_sdata)
 
-	# private helper for change-poll-notification
-	def _install_periodic_poller(self):
-		def poll_callback():
-			# read sdata and re-forward every device its current data record
-			try:
-				sdata = self._vera_luup_request('sdata')
-				for device in sdata.devices:
-					if self.devices.has_key(device.id) and self.devices[device.id]:
-						self.devices[device.id].vera_poll_update(device)
-			except Exception as ex:
-				logger.warning('Exception in vera poll: ' + str(ex))
-			# and reinstall this one-shot timer
-			self._install_periodic_poller()
-		self.house.timer.add_event(self.poll_interval, poll_callback)
+	# private interface for vera_luup.LuupChangeFeed
+	def _on_sdata_changes(self, devices, full):
+		# forward each changed device its new data record (a full response has them all)
+		logger.debug('vera reports %d %s device records' % (len(devices), 'full' if full else 'changed'))
+		self.jobs._record_devices(devices)
+		for device in devices:
+			if self.devices.get(device.id):
+				self.devices[device.id].vera_poll_update(device)
+
+	def _set_connection_state(self, state):
+		self.connection_state = state
 
 	# private interface for owned objects to talk to vera gateway
 	def _luup_get_variable(self, service_id, device_num, variable_name):
@@ -160,28 +210,31 @@ class VeraGateway(sg_house.StargateGateway):
 		# XXX note that there's a direct 'setvariable' command which changes the variable value without causing associated physical actions; don't use it.
 		# We need to use the 'action' command with SetTarget verb.
 		action_details = 'action=SetTarget&newTargetValue=%d' % target_value
-		return self._luup_action(service_id, device_num, variable_name, action_details)
+		response = self._luup_action(service_id, device_num, variable_name, action_details)
+		# response is { "u:SetTargetResponse": { "JobID": "NNN" } }; follow the job it started
+		for value in response.values():
+			if isinstance(value, dict) and value.has_key('JobID'):
+				self.jobs.start(device_num, value['JobID'])
+		return response
 	
 	def _luup_action(self, service_id, device_num, variable_name, action_details):
 		device_variable_triad = self._device_variable_triad(device_num, service_id, variable_name)
 		args = '%s&%s' % (device_variable_triad, action_details);
 		return self._vera_luup_request('action', args)
 	
-	def _vera_devices_with_jobs_in_progress(self):
-		status = self._vera_luup_request('status')
-		return [dev.id for dev in status.devices if len(dev.Jobs)]
-		
 	@staticmethod
 	def _device_variable_triad(device_num, service_id, variable_name):
 		return 'DeviceNum=%d&serviceId=%s&Variable=%s' % (device_num, service_id, variable_name)
 	
-	def _vera_luup_request(self, luup_cmd, *args):
-		url = 'http://%s:%d/data_request?id=%s&output_format=json' % (self.hostname, self.port, luup_cmd)
+	def _vera_luup_request(self, luup_cmd, *args, **kwargs):
+		# optional keyword arguments: timeout (socket timeout in seconds, instead of the pool's),
+		# pool (a vera_luup.LuupConnectionPool, instead of ours)
+		path = '/data_request?id=%s&output_format=json' % luup_cmd
 		if len(args):
 			arg_string = '&'.join(args)
-			url += '&' + arg_string
-		logger.debug('vera command: %s' % url)
-		stream = urllib.urlopen(url)
-		response = json.load(stream)
+			path += '&' + arg_string
+		logger.debug('vera command: %s' % path)
+		pool = kwargs.get('pool') or self.pool
+		response = json.loads(pool.request(path, kwargs.get('timeout')))
 		return AttrDict(response) if type(response) == dict else response
 	
@@ -0,0 +1,258 @@
+# (c) 2012 Matt Ginzton, matt@ginzton.net
+#
+# Control of MiCasaVerde Vera system.
+#
+# This module handles the Luup protocol plumbing underneath VeraGateway: HTTP connections to
+# the Vera, following its changes as they happen, caching device state from them, and tracking
+# the jobs our actions start.
+#
+# Rather than fetch the whole sdata document every few seconds, we use sdata's incremental
+# mode: we pass back the loadtime and dataversion from the last response, and the Vera holds
+# the request open until something changes after that (or timeout seconds pass), then returns
+# just the devices that changed. minimumdelay keeps a burst of changes from turning into a burst
+# of requests. If the Vera restarts or reloads its configuration, loadtime changes and the
+# response is a full one (full = 1) again.
+# See http://wiki.micasaverde.com/index.php/Luup_Sdata
+
+import httplib
+import logging
+import socket
+import threading
+import time
+
+import connections
+
+
+logger = logging.getLogger(__name__)
+logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
+
+
+class LuupConnectionPool(object):
+	# Keep-alive HTTP connections to the Vera, at most max_requests of them in use at once (the
+	# Vera is a small box; more concurrency than that just queues up inside it), each request
+	# with a socket timeout so a hung Vera can't hang the caller forever. Thread-safe.
+	def __init__(self, hostname, port, max_requests = 3, timeout = 10):
+		self.hostname = hostname
+		self.port = port
+		self.timeout = timeout
+		self.slots = threading.BoundedSemaphore(max_requests)
+		self.idle = [] # connections open and not in use
+		self.lock = threading.Lock() # guards idle and stats
+		self.stats = { 'requests': 0, 'connects': 0 }
+
+	def request(self, path, timeout = None):
+		# GET path; returns the response body. timeout overrides the pool's default.
+		with self.slots:
+			conn = self._get_connection()
+			try:
+				return self._request(conn, path, timeout)
+			except socket.timeout:
+				raise # the Vera's just not answering; don't make the caller wait twice
+			except (httplib.HTTPException, socket.error):
+				if conn.reused:
+					# the Vera (or something in between) closed an idle connection on us; that's
+					# not the request's fault, so try once more on a new one
+					conn.close()
+					return self._request(self._new_connection(), path, timeout)
+				raise
+
+	def _request(self, conn, path, timeout):
+		try:
+			conn.timeout = timeout or self.timeout
+			if conn.sock:
+				conn.sock.settimeout(conn.timeout)
+			with self.lock:
+				self.stats['requests'] += 1
+			conn.request('GET', path)
+			response = conn.getresponse()
+			body = response.read()
+		except:
+			conn.close()
+			raise
+		if response.status != 200:
+			conn.close()
+			raise httplib.HTTPException('vera returned HTTP %d for %s' % (response.status, path))
+		if response.will_close:
+			conn.close()
+		else:
+			conn.reused = True
+			with self.lock:
+				self.idle.append(conn)
+		return body
+
+	def _get_connection(self):
+		with self.lock:
+			if self.idle:
+				return self.idle.pop()
+		return self._new_connection()
+
+	def _new_connection(self):
+		with self.lock:
+			self.stats['connects'] += 1
+		conn = httplib.HTTPConnection(self.hostname, self.port, timeout = self.timeout)
+		conn.reused = False
+		return conn
+
+
+class LuupStateCache(object):
+	# Device records (sdata fields, by device id) as the change feed last reported them, so reads
+	# don't need a request to the Vera. Since the feed hears about every change, a record is good
+	# for as long as the feed is; it's fresh if the feed has heard from the Vera within max_age
+	# seconds (a long-poll that finds nothing to report still counts), and get() won't serve it
+	# otherwise.
+	def __init__(self, max_age):
+		self.max_age = max_age
+		self.devices = {} # map from device id to dict of sdata fields
+		self.last_contact = 0
+		self.lock = threading.Lock()
+
+	def get(self, device_id, field):
+		# returns None if unknown or not fresh
+		with self.lock:
+			if time.time() - self.last_contact > self.max_age:
+				return None
+			return self.devices.get(device_id, {}).get(field)
+
+	def is_fresh(self):
+		return time.time() - self.last_contact <= self.max_age
+
+	# private interface for LuupChangeFeed, VeraGateway
+	def _record_devices(self, devices, full):
+		with self.lock:
+			self.last_contact = time.time()
+			if full:
+				self.devices = {}
+			for device in devices:
+				# incremental records may carry only some fields; keep the rest
+				self.devices.setdefault(device['id'], {}).update(device)
+
+	def _record_field(self, device_id, field, value):
+		# a live read; doesn't say anything about the rest of the cache's freshness
+		with self.lock:
+			self.devices.setdefault(device_id, {})[field] = value
+
+	def _touch(self):
+		with self.lock:
+			self.last_contact = time.time()
+
+
+class LuupJobTracker(object):
+	# The jobs our actions started, by device, followed to completion through the change feed
+	# (each device record carries the state of its current job), so whether a device is busy is
+	# answered from memory, and callers can wait for a job to finish.
+	#
+	# sdata job states: -1 no job, 0 waiting to start, 1 in progress, 2 error, 3 aborted, 4 done,
+	# 5 waiting for callback, 6 requeued, 7 in progress with pending data. "No job" isn't news
+	# that ours finished (the feed can report it before the job shows up), so a job only ends
+	# in one of the states below, or gives up after max_job_time.
+	succeeded_states = (4,)
+	failed_states = (2, 3)
+	max_job_time = 60 # seconds after which we stop believing a job we never heard finish is running
+
+	def __init__(self):
+		self.jobs = {} # map from device id to (job id, started time)
+		self.results = {} # map from device id to whether its last job succeeded
+		self.updated = threading.Condition()
+
+	def start(self, device_id, job_id):
+		# a newer job for the device supersedes any we were following
+		with self.updated:
+			self.jobs[device_id] = (job_id, time.time())
+			self.results.pop(device_id, None)
+			self.updated.notify_all()
+
+	def is_pending(self, device_id):
+		with self.updated:
+			return self._get_job(device_id) is not None
+
+	def wait(self, device_id, timeout = None):
+		# Waits up to timeout seconds (forever if None) for the device's job to finish; returns
+		# whether it did, successfully. True right away if there's no job.
+		deadline = None if timeout is None else time.time() + timeout
+		with self.updated:
+			while self._get_job(device_id) is not None:
+				if deadline is None:
+					self.updated.wait(self.max_job_time)
+					continue
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return False
+				self.updated.wait(remaining)
+			return self.results.get(device_id, True)
+
+	def _get_job(self, device_id):
+		# requires lock
+		job = self.jobs.get(device_id)
+		if job and time.time() - job[1] > self.max_job_time:
+			logger.warning('vera job %s for device %s never finished; giving up on it' % (job[0], device_id))
+			del self.jobs[device_id]
+			self.results[device_id] = False
+			return None
+		return job
+
+	# private interface for VeraGateway, with the change feed's device records
+	def _record_devices(self, devices):
+		with self.updated:
+			if not self.jobs:
+				return
+			for device in devices:
+				if device['id'] not in self.jobs or 'state' not in device:
+					continue
+				state = int(device['state'])
+				if state in self.succeeded_states or state in self.failed_states:
+					(job_id, started) = self.jobs.pop(device['id'])
+					self.results[device['id']] = state in self.succeeded_states
+					logger.debug('vera job %s for device %s finished in state %d after %.1fs' % (job_id, device['id'], state, time.time() - started))
+					self.updated.notify_all()
+
+
+class LuupChangeFeed(threading.Thread):
+	def __init__(self, gateway, sdata, cache, timeout = 60, minimum_delay = 0.2, retry_interval = 5):
+		# sdata is the full sdata response the gateway built its devices from; we follow changes
+		# after it, keeping cache (a LuupStateCache) up to date
+		super(LuupChangeFeed, self).__init__(name = 'vera_poll')
+		self.daemon = True
+		self.gateway = gateway
+		self.cache = cache
+		self.pool = LuupConnectionPool(gateway.hostname, gateway.port, 1)
+		self.loadtime = sdata.loadtime
+		self.dataversion = sdata.dataversion
+		self.timeout = timeout
+		self.minimum_delay = minimum_delay
+		self.retry_interval = retry_interval
+		self.stats = { 'polls': 0, 'changes': 0, 'errors': 0 }
+
+	def run(self):
+		connections.set_thread_priority(connections.Priority.BACKGROUND)
+		while True:
+			try:
+				sdata = self.poll()
+			except Exception as ex:
+				logger.warning('Exception in vera poll: ' + str(ex))
+				self.stats['errors'] += 1
+				self.gateway._set_connection_state(connections.ConnectionState.DEGRADED)
+				time.sleep(self.retry_interval)
+				continue
+			self.gateway._set_connection_state(connections.ConnectionState.LIVE)
+			devices = sdata.devices if 'devices' in sdata else [] # (AttrDict.get wouldn't wrap them)
+			full = bool(sdata.get('full'))
+			self.stats['changes'] += len(devices)
+			if devices:
+				self.cache._record_devices(devices, full)
+				self.gateway._on_sdata_changes(devices, full)
+			else:
+				self.cache._touch()
+
+	def poll(self):
+		# One long-poll request: returns the (AttrDict) sdata response, after updating where we are.
+		# It has a connection of its own, so it doesn't tie up one of the gateway's for a minute.
+		self.stats['polls'] += 1
+		sdata = self.gateway._vera_luup_request('sdata',
+			'loadtime=%d' % self.loadtime, 'dataversion=%d' % self.dataversion,
+			'timeout=%d' % self.timeout, 'minimumdelay=%d' % (self.minimum_delay * 1000),
+			pool = self.pool, timeout = self.timeout + 10) # socket timeout: longer than the Vera will hold it
+		if sdata.get('loadtime') != self.loadtime:
+			logger.info('vera restarted or reloaded (loadtime %s, was %s)' % (sdata.get('loadtime'), self.loadtime))
+		self.loadtime = sdata.get('loadtime', self.loadtime)
+		self.dataversion = sdata.get('dataversion', self.dataversion)
+		return sdata
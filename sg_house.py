@@ -7,6 +7,7 @@
 
 import datetime
 import logging
+import threading
 
 import connections
 import events
@@ -104,8 +105,13 @@ class StargateDevice(object):
 			return False
 		if devfilter.devtype is not None and devfilter.devtype != self.devtype:
 			return False
-		if devfilter.devstate is not None and not self.is_in_state(devfilter.devstate):
-			return False
+		if devfilter.devstate is not None:
+			# don't block on a gateway that can't tell us the state right now (age= is answered
+			# from our own history, so it doesn't need the gateway)
+			if devfilter.devstate[:4] != 'age=' and not self.gateway.is_online():
+				return False
+			if not self.is_in_state(devfilter.devstate):
+				return False
 		return True
 
 	def is_in_state(self, state):
@@ -132,6 +138,11 @@ class StargateDevice(object):
 	def get_current_states(self):
 		return [state for state in self.get_possible_states() if self.is_in_state(state)]
 
+	# Devices whose commands take effect asynchronously override this to wait (up to timeout
+	# seconds) for the last one to be confirmed, and return whether it was.
+	def wait_until_settled(self, timeout = None):
+		return True
+
 	def get_child_ids(self):
 		return []
 
@@ -187,12 +198,20 @@ class StargateArea(object):
 	def register_device(self, device):
 		self.devices.append(device)
 		return self.house._register_device(device)
+
+	def unregister_device(self, device):
+		self.devices.remove(device)
+		self.house._unregister_device(device)
 		
 	def register_area(self, area):
 		if area != self: # special case for the house which is its own parent
 			self.areas.append(area)
 		return self.house._register_area(area)
 
+	def unregister_area(self, area):
+		self.areas.remove(area)
+		self.house._unregister_area(area)
+
 	def get_recent_events(self, count = 10):
 		dev_ids = [dev.device_id for dev in self._get_all_devices_below(force_enumerate = True)]
 		return self.house.persist.get_recent_events(dev_ids, count)
@@ -262,6 +281,7 @@ class StargateHouse(StargateArea):
 		self.areas_by_id = {}										# Map from area id to area object
 		self.devtype_order_by_devclass = {}  						# Map from devclass to list of devtype values, in sort order
 		self.devstate_order_by_tc = {}       						# Map from devclass:devtype to list of devstate values, in sort order
+		self.registry_lock = threading.RLock()						# Guards the maps above; gateways initialize in parallel
 		super(StargateHouse, self).__init__(self, config.house.name)
 
 		# XXX should we start watchdog before or after loading gateways?
@@ -278,29 +298,70 @@ class StargateHouse(StargateArea):
 			raise Exception("No gateways were loaded")
 		logger.info('Stargate is alive')
 	
+	def get_gateway_states(self):
+		# map from gateway name to connections.ConnectionState, for status display
+		return dict([(name, gateway.get_connection_state()) for (name, gateway) in self.gateways.items()])
+
+	def set_devices_to_state(self, devices, state):
+		# Bulk version of go_to_state: each gateway gets its devices as a group, so it can
+		# change them with fewer commands than one per device if it knows how.
+		by_gateway = {}
+		for device in devices:
+			by_gateway.setdefault(device.gateway, []).append(device)
+		for (gateway, gateway_devices) in by_gateway.items():
+			gateway.set_devices_to_state(gateway_devices, state)
+
 	def get_device_by_gateway_and_id(self, gateway_id, gateway_device_id):
-		gateway = self.gateways[gateway_id]
+		# gateway_id is the gateway's instance name (its section name in the gateways config)
+		gateway = self.gateways.get(gateway_id)
+		if gateway is None:
+			raise KeyError('no gateway instance named "%s" (have %s)' % (gateway_id, ', '.join(sorted(self.gateways.keys()))))
 		return gateway.get_device_by_gateway_id(gateway_device_id)
 	
 	def get_area_by_name(self, area_name):
 		# XXX currently creates all areas as direct children of the root area; no facility for deeper nesting
-		if not self.areas_by_name.has_key(area_name):
-			self.areas_by_name[area_name] = StargateArea(self, area_name)
-		return self.areas_by_name[area_name]
+		with self.registry_lock:
+			if not self.areas_by_name.has_key(area_name):
+				self.areas_by_name[area_name] = StargateArea(self, area_name)
+			return self.areas_by_name[area_name]
+
+	def release_area(self, area):
+		# For gateways whose areas can go away at runtime: the counterpart of get_area_by_name.
+		# Areas are shared by name between gateways, so it only goes away once nothing is left
+		# in it; like a device's, its persistent id stays reserved in the database.
+		with self.registry_lock:
+			if area.devices or area.areas or self.areas_by_name.get(area.name) is not area:
+				return
+			logger.info('unregister area name %s id %d' % (area.name, area.area_id))
+			del self.areas_by_name[area.name]
+			area.parent.unregister_area(area)
 		
 	def _register_device(self, device):
 		did = self.persist.get_device_id(device.gateway.gateway_id, device.gateway_devid)
-		self.devices_by_id[did] = device
-		logger.info('register dev name %s id %d (gw %s:%s)' % (device.name, did, device.gateway.gateway_id, device.gateway_devid))
-		self._add_devtype_for_ordering(device.devclass, device.devtype)
-		self._add_devstates_for_ordering(device.devclass, device.devtype, device.possible_states)
+		with self.registry_lock:
+			self.devices_by_id[did] = device
+			logger.info('register dev name %s id %d (gw %s:%s)' % (device.name, did, device.gateway.gateway_id, device.gateway_devid))
+			self._add_devtype_for_ordering(device.devclass, device.devtype)
+			self._add_devstates_for_ordering(device.devclass, device.devtype, device.possible_states)
 		return did
+
+	def _unregister_device(self, device):
+		# For gateways whose devices can go away at runtime. The persistent id stays reserved
+		# in the database, so the device gets its history back if it reappears.
+		logger.info('unregister dev name %s id %d (gw %s:%s)' % (device.name, device.device_id, device.gateway.gateway_id, device.gateway_devid))
+		with self.registry_lock:
+			self.devices_by_id.pop(device.device_id, None)
 	
 	def _register_area(self, area):
 		aid = self.persist.get_area_id(area.name)
-		self.areas_by_id[aid] = area
+		with self.registry_lock:
+			self.areas_by_id[aid] = area
 		return aid
 
+	def _unregister_area(self, area):
+		with self.registry_lock:
+			self.areas_by_id.pop(area.area_id, None)
+
 	def get_device_by_id(self, did):
 		return self.devices_by_id[did]
 
@@ -416,3 +477,22 @@ class StargateGateway(object):
 		# Subclass must have:
 		# get_device_by_gateway_id(gateway_devid)
 		assert callable(self.get_device_by_gateway_id)
+
+	# Gateways that talk to a device over a connection override this to report its
+	# connections.ConnectionState; gateways with nothing to lose track of are always live.
+	def get_connection_state(self):
+		return connections.ConnectionState.LIVE
+
+	def is_online(self):
+		return connections.ConnectionState.is_online(self.get_connection_state())
+
+	# Gateways that can change several devices at once more cheaply than one at a time
+	# override this.
+	def set_devices_to_state(self, devices, state):
+		for device in devices:
+			device.go_to_state(state)
+
+	# Gateways that refresh their state in the background after connecting override this to
+	# report (done, total) for the sweep, for status display.
+	def get_sync_progress(self):
+		return (0, 0)
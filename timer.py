@@ -8,6 +8,8 @@ import logging
 import threading
 import time
 
+import connections
+
 
 logger = logging.getLogger(__name__)
 logger.info('%s: init with level %s' % (logger.name, logging.getLevelName(logger.level)))
@@ -62,6 +64,8 @@ class SgTimer(object):
 
 			def run(self):
 				timer = self.timer
+				# anything our handlers send to a gateway is automation, not someone waiting on it
+				connections.set_thread_priority(connections.Priority.AUTOMATION)
 				# Loop forever, waiting for either the next known event or a change in the events to wait for.
 				# When we wake up, for either reason, look for stuff whose time has come, invoke it, then
 				# repeat. It's ok if we wake up too early and nothing is ready.
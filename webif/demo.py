@@ -10,6 +10,7 @@ from flask import Flask, request, render_template, redirect, url_for
 
 app = Flask(__name__)
 house = None # will be set by stash_house()
+settle_timeout = 2 # seconds to wait for a device change to take effect before showing the result
 
 
 @app.route('/')
@@ -87,9 +88,8 @@ def set_output(dev_id):
 		output.set_level(level)
 	else:
 		output.go_to_state(state)
-	# XXX should make this respond to async operation when it completes; for now just wait a bit
-	# and show the device details page
-	time.sleep(0.3)
+	# show the device details page once the change has taken effect (or we give up waiting)
+	output.wait_until_settled(settle_timeout)
 	return redirect(url_for('get_output', dev_id = dev_id))
 
 @app.route('/output/multi/to_state', methods = ['POST'])
@@ -97,12 +97,13 @@ def set_outputs_to_state():
 	params = request.form
 	state = params['state']
 	dev_ids = map(int, params['outputs'].split(','))
-	for dev_id in dev_ids:
-		output = house.get_device_by_id(dev_id)
-		output.go_to_state(state)
-	# XXX should make this respond to async operation when it completes; for now just wait a bit
+	outputs = [house.get_device_by_id(dev_id) for dev_id in dev_ids]
+	house.set_devices_to_state(outputs, state)
+	# wait for the changes to take effect, all within one timeout
+	deadline = time.time() + settle_timeout
+	for output in outputs:
+		output.wait_until_settled(max(0, deadline - time.time()))
 	# hack: show the page for the outputs in the area containing the last device, filtered by device type
-	time.sleep(0.2 * len(dev_ids))
 	return redirect(url_for('enumerate_outputs_by_area', area_id = output.area.area_id, filterdesc = output.devtype))
 
 #####################